@@ -10,7 +10,7 @@ from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_sc
     auc, confusion_matrix
 import numpy as np
 import torch
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler, TensorDataset)
+from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler, Sampler, TensorDataset)
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
@@ -267,6 +267,46 @@ def accuracy(out, labels):
     return np.sum(outputs == labels)
 
 
+def collate_to_longest(batch):
+    """Collates (input_ids, input_mask, segment_ids, label_id) examples into batch tensors whose
+    sequence dimension is cut to the longest sequence in the batch instead of max_seq_length."""
+    input_ids, input_mask, segment_ids, label_ids = (torch.stack(field) for field in zip(*batch))
+    max_length = int(input_mask.sum(-1).max())
+    return (input_ids[:, :max_length].contiguous(), input_mask[:, :max_length].contiguous(),
+            segment_ids[:, :max_length].contiguous(), label_ids)
+
+
+class BucketBatchSampler(Sampler):
+    """Yields batches of example indices such that each batch holds examples of similar length.
+    The examples are shuffled and split into buckets of `bucket_size` batches; each bucket is sorted
+    by length and cut into batches, and the batches of all buckets are shuffled. If `bucket_size` is
+    not given, it is chosen so that an epoch has at least `min_buckets` buckets (and buckets have at
+    most 50 batches), so that batches still change from one epoch to the next on small datasets."""
+
+    def __init__(self, lengths, batch_size, bucket_size=None, min_buckets=8):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        if not bucket_size:
+            n_batches = (len(lengths) + batch_size - 1) // batch_size
+            bucket_size = min(50, max(1, n_batches // min_buckets))
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        random.shuffle(indices)
+        batches = []
+        n_bucket_examples = self.batch_size * self.bucket_size
+        for bucket_start in range(0, len(indices), n_bucket_examples):
+            bucket = sorted(indices[bucket_start:bucket_start + n_bucket_examples], key=lambda idx: self.lengths[idx])
+            batches.extend(bucket[batch_start:batch_start + self.batch_size]
+                           for batch_start in range(0, len(bucket), self.batch_size))
+        random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
 def metrics(preds, scores, labels):
     acc = accuracy_score(labels, preds)
     precision = precision_score(labels, preds)
@@ -344,6 +384,11 @@ def main():
                         default=32,
                         type=int,
                         help="Total batch size for training.")
+    parser.add_argument("--bucket_size",
+                        default=0,
+                        type=int,
+                        help="Number of training batches per length bucket (see BucketBatchSampler). "
+                             "0 picks a size that gives at least 8 buckets per epoch.")
     parser.add_argument("--eval_batch_size",
                         default=32,
                         type=int,
@@ -532,11 +577,15 @@ def main():
         all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
         train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
         if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+            # batch examples of similar length so that little padding is left after collate_to_longest
+            train_dataloader = DataLoader(train_data, num_workers=int(cpu_count() / 2), collate_fn=collate_to_longest,
+                                          batch_sampler=BucketBatchSampler([sum(f.input_mask) for f in train_features],
+                                                                           args.train_batch_size,
+                                                                           bucket_size=args.bucket_size))
         else:
             train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, num_workers=int(cpu_count() / 2),
-                                      sampler=train_sampler, batch_size=args.train_batch_size)
+            train_dataloader = DataLoader(train_data, num_workers=int(cpu_count() / 2), collate_fn=collate_to_longest,
+                                          sampler=train_sampler, batch_size=args.train_batch_size)
 
         eval_examples = processor.get_dev_examples(args.data_dir)
         eval_features = convert_examples_to_features(
@@ -552,7 +601,7 @@ def main():
         # Run prediction for full data
         eval_sampler = SequentialSampler(eval_data)
         eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size,
-                                     num_workers=int(cpu_count() / 2))
+                                     num_workers=int(cpu_count() / 2), collate_fn=collate_to_longest)
 
         max_sum, max_epoch = 0, 0
 
@@ -596,25 +645,18 @@ def main():
                 model.eval()
                 eval_loss, eval_accuracy = 0, 0
                 nb_eval_steps, nb_eval_examples = 0, 0
-                preds, scores, labels = [], [], []
+                logits_all = np.empty((len(eval_data), num_labels), dtype=np.float32)
+                labels = np.empty(len(eval_data), dtype=np.int64)
 
                 for step, batch in enumerate(eval_dataloader):
                     batch = tuple(t.to(device) for t in batch)
                     input_ids, input_mask, segment_ids, label_ids = batch
-                    input_ids = input_ids.to(device)
-                    input_mask = input_mask.to(device)
-                    segment_ids = segment_ids.to(device)
-                    label_ids = label_ids.to(device)
 
                     with torch.no_grad():
-                        tmp_eval_loss = model(input_ids, segment_ids, input_mask, label_ids)
-                        logits = model(input_ids, segment_ids, input_mask)
+                        tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids, return_logits=True)
 
-                    logits = logits.detach().cpu().numpy()
-                    label_ids = label_ids.to('cpu').numpy()
-                    preds += np.argmax(logits, axis=1).tolist()
-                    scores += logits[:, 1].tolist()
-                    labels += label_ids.tolist()
+                    logits_all[nb_eval_examples:nb_eval_examples + input_ids.size(0)] = logits.detach().cpu().numpy()
+                    labels[nb_eval_examples:nb_eval_examples + input_ids.size(0)] = label_ids.to('cpu').numpy()
 
                     # tmp_eval_accuracy = accuracy(logits, label_ids)
                     eval_loss += tmp_eval_loss.mean().item()
@@ -622,6 +664,8 @@ def main():
                     nb_eval_examples += input_ids.size(0)
                     nb_eval_steps += 1
 
+                preds = np.argmax(logits_all, axis=1)
+                scores = logits_all[:, 1]
                 acc, precision, recall, f1, auroc, auprc = metrics(preds, scores, labels)
                 tmp_sum = acc
                 if tmp_sum > max_sum:
@@ -691,41 +735,24 @@ def main():
         eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
         # Run prediction for full data
         eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size,
+                                     collate_fn=collate_to_longest)
 
         model.eval()
         eval_loss, eval_accuracy = 0, 0
         nb_eval_steps, nb_eval_examples = 0, 0
-        preds, scores, labels = [], [], []
-        fp, fn = [], []
+        logits_all = np.empty((len(eval_data), num_labels), dtype=np.float32)
+        labels = np.empty(len(eval_data), dtype=np.int64)
 
         for step, batch in enumerate(eval_dataloader):
             batch = tuple(t.to(device) for t in batch)
             input_ids, input_mask, segment_ids, label_ids = batch
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-            segment_ids = segment_ids.to(device)
-            label_ids = label_ids.to(device)
 
             with torch.no_grad():
-                tmp_eval_loss = model(input_ids, segment_ids, input_mask, label_ids)
-                logits = model(input_ids, segment_ids, input_mask)
-
-            logits = logits.detach().cpu().numpy()
-            label_ids = label_ids.to('cpu').numpy()
-            p = np.argmax(logits, axis=1).tolist()
-            preds += p
-            s = logits[:, 1].tolist()
-            scores += s
-            l = label_ids.tolist()
-            labels += l
-
-            for idx, pair in enumerate(zip(p, l)):
-                eid = step * args.eval_batch_size + idx + 1
-                if pair[1] == 1 and pair[0] == 0:
-                    fn.append(eid)
-                if pair[1] == 0 and pair[0] == 1:
-                    fp.append(eid)
+                tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids, return_logits=True)
+
+            logits_all[nb_eval_examples:nb_eval_examples + input_ids.size(0)] = logits.detach().cpu().numpy()
+            labels[nb_eval_examples:nb_eval_examples + input_ids.size(0)] = label_ids.to('cpu').numpy()
 
             # tmp_eval_accuracy = accuracy(logits, label_ids)
             eval_loss += tmp_eval_loss.mean().item()
@@ -733,6 +760,12 @@ def main():
             nb_eval_examples += input_ids.size(0)
             nb_eval_steps += 1
 
+        preds = np.argmax(logits_all, axis=1)
+        scores = logits_all[:, 1]
+        # ids (1-based positions in the eval set) of false negatives and false positives
+        fn = (np.flatnonzero((labels == 1) & (preds == 0)) + 1).tolist()
+        fp = (np.flatnonzero((labels == 0) & (preds == 1)) + 1).tolist()
+
         FALSE = {'FP': fp, 'FN': fn}
         with open('./FALSE.json', 'w') as f:
             f.write(json.dumps(FALSE) + '\n')
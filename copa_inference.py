@@ -0,0 +1,121 @@
+"""Micro-batching inference engine for BERT multiple-choice COPA models."""
+
+import asyncio
+import logging
+import time
+
+import torch
+
+from run_copa import CopaExample, convert_examples_to_features, pad_choices_features
+
+logger = logging.getLogger(__name__)
+
+
+class MultipleChoiceInferenceEngine(object):
+    """Scores COPA items arriving one at a time with a `BertForMultipleChoice` or
+    `BertForMultipleChoiceMarginLoss` model on CPU.
+
+    Items submitted with `score()` go into an asyncio queue. A single worker takes the first
+    waiting item, then keeps collecting items until `max_batch_size` items are queued or
+    `max_latency` seconds have passed, and runs them through the model in one forward pass.
+    Each batch is padded only to its longest sequence.
+
+    Params:
+        `model`: a fine-tuned multiple-choice model.
+        `tokenizer`: the `BertTokenizer` used to fine-tune the model.
+        `max_seq_length`: maximum number of tokens of a premise/alternative pair (longer pairs are truncated).
+        `max_batch_size`: maximum number of items scored in one forward pass.
+        `max_latency`: maximum time (in seconds) the first item of a batch waits for other items.
+        `num_threads`: number of threads torch uses for intra-op parallelism (None keeps the torch default).
+
+    Example usage:
+    ```python
+    engine = MultipleChoiceInferenceEngine(model, tokenizer)
+    await engine.start()
+    logits, latency = await engine.score("The man fell down.", "He got hurt.", "He laughed.", ask_for='effect')
+    await engine.stop()
+    ```
+    """
+
+    def __init__(self, model, tokenizer, max_seq_length=57, max_batch_size=32, max_latency=0.01, num_threads=None):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model = model.to('cpu')
+        self.model.eval()
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = None
+        self.worker = None
+        self.batch = []  # items taken from the queue by the worker and not scored yet
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops the worker. Items that are still queued or being scored fail with a RuntimeError."""
+        if self.worker is None:
+            return
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        queue, self.queue, self.worker = self.queue, None, None
+        futures = [future for _, future in self.batch]
+        while not queue.empty():
+            futures.append(queue.get_nowait()[1])
+        self.batch = []
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError("The inference engine was stopped before the item was scored"))
+
+    async def score(self, premise, alternative1, alternative2, ask_for='effect'):
+        """Scores one COPA item. Returns the logits of the two alternatives as a numpy array
+        and the latency of the request in seconds."""
+        if self.queue is None:
+            raise RuntimeError("The inference engine is not running; await start() before scoring items")
+        start_time = time.perf_counter()
+        example = CopaExample(None, ask_for, premise, alternative1, alternative2)
+        feature = convert_examples_to_features([example], self.tokenizer, self.max_seq_length, False)[0]
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((feature, future))
+        logits = await future
+        return logits, time.perf_counter() - start_time
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = self.batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            features = [feature for feature, _ in batch]
+            try:
+                # run the forward pass in a thread so new items can be queued in the meantime
+                logits = await loop.run_in_executor(None, self._forward, features)
+            except Exception as error:
+                logger.error("Scoring a batch of {} items failed: {}".format(len(batch), error))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                self.batch = []
+                continue
+            for (_, future), item_logits in zip(batch, logits):
+                if not future.done():
+                    future.set_result(item_logits)
+            self.batch = []
+
+    def _forward(self, features):
+        input_ids, input_mask, segment_ids = pad_choices_features(features)
+        with torch.no_grad():
+            logits = self.model(input_ids, segment_ids, input_mask)
+        return logits.numpy()
@@ -0,0 +1,212 @@
+from __future__ import print_function
+import sys, argparse, json, threading, time, timeit
+
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+sys.path.append('../')
+
+from models.pipeline import *
+
+
+# the alternative is the cause of the premise in 'cause' items and its effect in 'effect' items
+copa_modes = ('cause', 'effect')
+
+
+def get_copa_pair(premise, alt, mode):
+    '''order a COPA premise and alternative as (seq1, seq2) so that seq1 is the cause, as in encoder_decoder.py'''
+    if mode not in copa_modes:
+        raise ValueError("mode must be 'cause' or 'effect', got {!r}".format(mode))
+    if mode == 'cause':
+        return alt, premise
+    return premise, alt
+
+
+class MicroBatchScorer(object):
+    '''scores (premise, alternative, mode) items with an EncoderDecoderPipeline that is loaded once and only used by a
+    single worker thread (which avoids Keras issues with models shared across threads). Items submitted concurrently by
+    different clients are coalesced into one model call of up to max_batch_size items: after the first request arrives,
+    the worker waits at most max_latency seconds for others before scoring'''
+
+    def __init__(self, filepath=None, model=None, max_batch_size=64, max_latency=0.01, candidates_only=False):
+        self.filepath = filepath
+        self.model = model  # if given instead of filepath, this (already loaded) pipeline is used
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.candidates_only = candidates_only
+        self.requests = queue.Queue()
+        self.ready = threading.Event()
+        self.load_error = None
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+        self.ready.wait()
+        if self.load_error is not None:
+            raise self.load_error
+
+    def load(self):
+        if self.model is None:
+            self.model = EncoderDecoderPipeline.load(filepath=self.filepath)
+        if self.candidates_only and self.model.classifier.get_output_weights()[2] != 'sigmoid':
+            # softmax outputs need a pass over the whole lexicon for their normalizer anyway
+            print("model has a softmax output layer, so candidates_only is ignored")
+            self.candidates_only = False
+        # warm up: loads the spaCy model and builds the predict functions before the first request
+        self.model.predict(seqs1=[u"The man fell down."], seqs2=[u"He got hurt."],
+                           candidates_only=self.candidates_only)
+        print("loaded and warmed up model")
+
+    def score(self, items):
+        '''block until the scores of the given (premise, alternative, mode) items are computed; return them along with
+        the latency of the request in seconds; raises ValueError if an item's mode is not cause or effect'''
+        request = {'pairs': [get_copa_pair(*item) for item in items], 'start_time': timeit.default_timer(),
+                   'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['scores'], timeit.default_timer() - request['start_time']
+
+    def run(self):
+        try:
+            self.load()
+        except Exception as error:
+            self.load_error = error
+            return
+        finally:
+            self.ready.set()
+        while True:
+            batch = [self.requests.get()]
+            n_items = len(batch[0]['pairs'])
+            deadline = time.time() + self.max_latency
+            while n_items < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n_items += len(batch[-1]['pairs'])
+            self.score_batch(batch)
+
+    def score_batch(self, batch):
+        pairs = [pair for request in batch for pair in request['pairs']]
+        try:
+            scores = self.model.predict(seqs1=[pair[0] for pair in pairs], seqs2=[pair[1] for pair in pairs],
+                                        candidates_only=self.candidates_only, batch_size=self.max_batch_size)
+        except Exception as error:
+            for request in batch:
+                request['error'] = error
+                request['done'].set()
+            return
+        item_idx = 0
+        for request in batch:
+            request['scores'] = scores[item_idx:item_idx + len(request['pairs'])].tolist()
+            item_idx += len(request['pairs'])
+            request['done'].set()
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(scorer):
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        '''POST /score with {"items": [{"premise": ..., "alternative": ..., "mode": "cause" or "effect"}, ...]} returns
+        {"scores": [...], "latency": seconds}; GET /health returns {"status": "ok"} once the model is loaded'''
+
+        def send_json(self, status, response):
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/health':
+                self.send_json(404, {'error': 'not found'})
+                return
+            self.send_json(200, {'status': 'ok'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                items = [(item['premise'], item['alternative'], item.get('mode', 'effect'))
+                         for item in request['items']]
+                for item in items:
+                    get_copa_pair(*item)  # rejects unknown modes before any item is scored
+            except (ValueError, KeyError, TypeError) as error:
+                self.send_json(400, {'error': "invalid request: {}".format(error)})
+                return
+            try:
+                scores, latency = scorer.score(items)
+            except Exception as error:
+                self.send_json(500, {'error': str(error)})
+                return
+            self.send_json(200, {'scores': scores, 'latency': latency})
+
+        def log_message(self, format, *args):
+            pass  # don't log every request
+
+    return ScoringHandler
+
+
+def serve(scorer, host='127.0.0.1', port=8000):
+    '''start an HTTP server for the scorer in a background thread and return it (call server.shutdown() to stop it);
+    port=0 picks a free port, given by server.server_address'''
+    server = ThreadedHTTPServer((host, port), make_handler(scorer))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serve COPA plausibility scores from a trained encoder-decoder model over HTTP, "
+                    "batching requests from concurrent clients")
+    parser.add_argument("--model_filepath", "-model",
+                        help="Specify the directory filepath where the trained model is stored.",
+                        type=str, default='checkpoints')
+    parser.add_argument("--host",
+                        help="Specify the host the server listens on. Default is 127.0.0.1 (local only).",
+                        required=False, type=str, default='127.0.0.1')
+    parser.add_argument("--port", "-port",
+                        help="Specify the port the server listens on. Default is 8000.",
+                        required=False, type=int, default=8000)
+    parser.add_argument("--max_batch_size", "-batch",
+                        help="Specify the maximum number of items scored together in one model call. Default is 64.",
+                        required=False, type=int, default=64)
+    parser.add_argument("--max_latency", "-latency",
+                        help="Specify the maximum time (in milliseconds) a request waits for other requests to be "
+                             "batched with it. Default is 10.",
+                        required=False, type=float, default=10.0)
+    parser.add_argument("--candidates_only", "-cand",
+                        help="Specify if the output layer should only be computed for the words in the alternatives "
+                             "(see EncoderDecoder.predict()). Only applies to models with a sigmoid output layer "
+                             "(feed-forward models trained without --n_sampled, or models trained with --sampled_loss "
+                             "nce); scores are the same either way.",
+                        required=False, action='store_true')
+    args = parser.parse_args()
+
+    scorer = MicroBatchScorer(filepath=args.model_filepath, max_batch_size=args.max_batch_size,
+                              max_latency=args.max_latency / 1000, candidates_only=args.candidates_only)
+    server = serve(scorer, host=args.host, port=args.port)
+    print("serving scores on http://{}:{}/score".format(*server.server_address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,11 +1,24 @@
 from __future__ import print_function
-import sys, pandas, argparse
+import sys, os, pandas, argparse
 import xml.etree.cElementTree as et
 import pickle as pkl
 import time
 
 sys.path.append('../')
 
+if __name__ == '__main__':
+    # the OpenMP runtime of MKL builds of tensorflow reads these variables when it starts, so they are set from the
+    # thread arguments before tensorflow is imported (configure_threads() may be too late for them)
+    thread_parser = argparse.ArgumentParser(add_help=False)
+    thread_parser.add_argument("--n_intra_op_threads", "-intra", type=int, default=0)
+    thread_parser.add_argument("--pin_threads", "-pin", action='store_true')
+    thread_args = thread_parser.parse_known_args()[0]
+    if thread_args.n_intra_op_threads:
+        os.environ['OMP_NUM_THREADS'] = str(thread_args.n_intra_op_threads)
+    if thread_args.pin_threads:
+        os.environ['KMP_AFFINITY'] = 'granularity=fine,compact,1,0'
+        os.environ['KMP_BLOCKTIME'] = '1'
+
 from models.pipeline import *
 from models.classifier import *
 from models.transformer import *
@@ -92,7 +105,8 @@ def preprocess(args):
                                                     'VB', 'VBD', 'VBG', 'VBN', 'VBP', 'VBZ'])
     # 模型
     classifier = EncoderDecoder(filepath=args.save_filepath, recurrent=args.recurrent, batch_size=args.batch_size,
-                                n_hidden_nodes=args.n_hidden_nodes)
+                                n_hidden_nodes=args.n_hidden_nodes, n_sampled=args.n_sampled,
+                                sampled_loss=args.sampled_loss, sampler=args.sampler)
     model = EncoderDecoderPipeline(transformer, classifier)
 
     if args.chunk_size:  # load training data in chunks
@@ -105,7 +119,8 @@ def preprocess(args):
             print("EPOCH:", epoch + 1)
             for seqs in get_seqs(args.train_seqs, chunk_size=args.chunk_size):
                 seq_pairs = get_adj_sent_pairs(seqs, segment_clauses=False if args.segment_sents else True,
-                                               max_distance=args.max_pair_distance, max_sent_length=args.max_length)
+                                               max_distance=args.max_pair_distance, max_sent_length=args.max_length,
+                                               transformer=transformer)
                 model.fit(seqs1=[pair[0] for pair in seq_pairs], seqs2=[pair[1] for pair in seq_pairs],
                           max_length=args.max_length,
                           eval_fn=lambda model: eval_copa(model, data_filepath=args.val_items), n_epochs=1)
@@ -123,7 +138,8 @@ def preprocess(args):
         print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
         print('Getting adj sent pairs...')
         seq_pairs = get_adj_sent_pairs(seqs, segment_clauses=False if args.segment_sents else True,
-                                       max_distance=args.max_pair_distance, max_sent_length=args.max_length)
+                                       max_distance=args.max_pair_distance, max_sent_length=args.max_length,
+                                       transformer=transformer)
 
         print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
         print('Saving model and sent pairs...')
@@ -182,6 +198,20 @@ if __name__ == '__main__':
     parser.add_argument("--n_hidden_nodes", "-hid",
                         help="Specify number of dimensions in the encoder and decoder layers. Default is 500.",
                         required=False, type=int, default=500)
+    parser.add_argument("--n_sampled", "-sampled",
+                        help="If given, train the output layer against only this number of words sampled from the "
+                             "lexicon's unigram distribution instead of the entire lexicon, which makes training with "
+                             "large vocabularies much faster. Scoring still uses all words. Default (0) trains on all words.",
+                        required=False, type=int, default=0)
+    parser.add_argument("--sampled_loss",
+                        help="Specify the loss used with --n_sampled: sampled softmax or noise-contrastive estimation. "
+                             "Default is sampled_softmax.",
+                        required=False, type=str, choices=['sampled_softmax', 'nce'], default='sampled_softmax')
+    parser.add_argument("--sampler",
+                        help="Specify the distribution negative words are drawn from with --n_sampled: the smoothed "
+                             "unigram distribution of the training words, or a log-uniform distribution over word "
+                             "indices. Default is unigram.",
+                        required=False, type=str, choices=['unigram', 'log_uniform'], default='unigram')
     parser.add_argument("--n_epochs", "-epoch",
                         help="Specify the number of epochs the model should be trained for. Default is 50.",
                         required=False, type=int, default=50)
@@ -191,8 +221,29 @@ if __name__ == '__main__':
                              "For smaller datasets (e.g. the ROCStories corpus), "
                              "it is much faster to load entire dataset prior to training. This will be done by default if chunk size is not given.",
                         required=False, type=int, default=0)
+    parser.add_argument("--n_intra_op_threads", "-intra",
+                        help="Specify number of threads used to run a single operation (e.g. a matrix multiplication) "
+                             "in parallel. Set this to the number of physical cores on CPU-only machines. "
+                             "Default (0) lets TensorFlow decide.",
+                        required=False, type=int, default=0)
+    parser.add_argument("--n_inter_op_threads", "-inter",
+                        help="Specify number of threads used to run independent operations in parallel. "
+                             "Default (0) lets TensorFlow decide.",
+                        required=False, type=int, default=0)
+    parser.add_argument("--pin_threads", "-pin",
+                        help="Specify if compute threads should be pinned to CPU cores (only affects MKL builds of "
+                             "TensorFlow).",
+                        required=False, action='store_true')
+    parser.add_argument("--n_batch_workers", "-workers",
+                        help="Specify number of threads that prepare training batches while the model trains on the "
+                             "current batch. Default is 1.",
+                        required=False, type=int, default=1)
     args = parser.parse_args()
 
+    configure_threads(n_intra_op_threads=args.n_intra_op_threads, n_inter_op_threads=args.n_inter_op_threads,
+                      pin_threads=args.pin_threads)
+    SavedModel.n_batch_workers = args.n_batch_workers
+
     preprocess(args)
 
     with open('./checkpoints/model.pkl', 'rb') as f:
@@ -12,14 +12,159 @@ from keras.layers.recurrent import GRU
 from keras.layers.wrappers import Bidirectional
 from keras.optimizers import RMSprop, SGD, Adagrad, Adam
 from keras.preprocessing.sequence import pad_sequences
+from keras.utils import Sequence, OrderedEnqueuer
 import keras.backend as K
 from scipy.spatial.distance import cosine
+from scipy import sparse
 
 rng = numpy.random.RandomState(0)
 
+session_config = None  # tensorflow session config set by configure_threads(), re-applied whenever the session is reset
+
+
+def configure_threads(n_intra_op_threads=0, n_inter_op_threads=0, pin_threads=False):
+    '''set the size of the thread pools tensorflow uses to run a single op (intra-op) and independent ops (inter-op) in
+    parallel; 0 leaves the choice to tensorflow. If pin_threads=True, OpenMP threads (used by MKL builds of tensorflow)
+    are bound to cores so each keeps its caches and NUMA memory. Call this before any model is created or loaded.
+    Only the tensorflow thread pool sizes are guaranteed to apply: the OpenMP variables set here (OMP_NUM_THREADS,
+    KMP_AFFINITY, KMP_BLOCKTIME) are ignored if the OpenMP runtime has already started, so scripts should set them
+    before importing tensorflow, as encoder_decoder.py does'''
+    global session_config
+    if K.backend() != 'tensorflow':
+        print("thread configuration is only supported for the tensorflow backend, ignoring")
+        return
+    import tensorflow as tf
+    if n_intra_op_threads:
+        os.environ['OMP_NUM_THREADS'] = str(n_intra_op_threads)
+    if pin_threads:
+        os.environ['KMP_AFFINITY'] = 'granularity=fine,compact,1,0'
+        os.environ['KMP_BLOCKTIME'] = '1'
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=n_intra_op_threads,
+                                    inter_op_parallelism_threads=n_inter_op_threads,
+                                    allow_soft_placement=True)
+    K.set_session(tf.Session(config=session_config))
+    print("configured tensorflow with", n_intra_op_threads or "default", "intra-op threads and",
+          n_inter_op_threads or "default", "inter-op threads")
+
+
+def reset_session():
+    '''clear the keras session (e.g. to rebuild models in a different thread) while keeping the thread configuration'''
+    K.clear_session()
+    if session_config is not None:
+        import tensorflow as tf
+        K.set_session(tf.Session(config=session_config))
+
+
+class SampledOutput(Layer):
+    '''output layer over n_classes words whose training cost doesn't grow with the vocabulary. Called on [hidden, labels]
+    it returns the sampled softmax (or NCE) loss of the labels against only n_sampled words drawn from the smoothed
+    unigram distribution of the lexicon (class_counts) or a log-uniform distribution (which assumes frequent words have
+    low indices); called on hidden alone it returns the exact distribution over all words (softmax, or sigmoid for NCE)'''
+
+    def __init__(self, n_classes, n_sampled=1000, loss='sampled_softmax', sampler='unigram', class_counts=None, **kwargs):
+        super(SampledOutput, self).__init__(**kwargs)
+        assert(loss in ('sampled_softmax', 'nce'))
+        assert(sampler in ('unigram', 'log_uniform'))
+        self.n_classes = n_classes
+        self.n_sampled = n_sampled
+        self.loss = loss
+        self.sampler = sampler
+        self.class_counts = class_counts  # only used to initialize the sampler; stored as a (saved) weight after that
+        self.supports_masking = True
+
+    def build(self, input_shape):
+        hidden_shape = input_shape[0] if isinstance(input_shape, list) else input_shape
+        self.kernel = self.add_weight(shape=(self.n_classes, hidden_shape[-1]), initializer='glorot_uniform',
+                                      name='kernel')
+        self.bias = self.add_weight(shape=(self.n_classes,), initializer='zeros', name='bias')
+        if self.sampler == 'unigram':
+            self.sampler_probs = self.add_weight(shape=(self.n_classes,), initializer='ones', name='sampler_probs',
+                                                 trainable=False)
+            if self.class_counts is not None:  # smooth counts as in word2vec so rare words are sampled more often
+                sampler_probs = numpy.asarray(self.class_counts, dtype='float64') ** 0.75
+                K.set_value(self.sampler_probs, sampler_probs / numpy.sum(sampler_probs))
+        super(SampledOutput, self).build(input_shape)
+
+    def call(self, inputs, mask=None):
+        if not isinstance(inputs, list):  # score all words
+            logits = K.bias_add(K.dot(inputs, K.transpose(self.kernel)), self.bias)
+            return K.sigmoid(logits) if self.loss == 'nce' else K.softmax(logits)
+
+        import tensorflow as tf
+        hidden, labels = inputs
+        n_true = K.int_shape(labels)[-1]
+        flat_hidden = K.reshape(hidden, (-1, K.int_shape(hidden)[-1]))
+        flat_labels = K.reshape(K.cast(labels, 'int64'), (-1, n_true))
+        if self.sampler == 'unigram':
+            # floored so that words with no count (e.g. padding index 0) don't get an expected count of 0, whose log
+            # would make the loss (and gradients) NaN even at masked positions
+            sampler_probs = K.maximum(self.sampler_probs / K.sum(self.sampler_probs), K.epsilon())
+            sampled = tf.multinomial(K.log(sampler_probs)[None], self.n_sampled)[0]
+            sampled_values = (sampled, self.n_sampled * K.gather(sampler_probs, flat_labels),
+                              self.n_sampled * K.gather(sampler_probs, sampled))
+        else:
+            sampled_values = tf.nn.log_uniform_candidate_sampler(flat_labels, n_true, self.n_sampled, True,
+                                                                 self.n_classes)
+        loss_fn = tf.nn.nce_loss if self.loss == 'nce' else tf.nn.sampled_softmax_loss
+        losses = loss_fn(weights=self.kernel, biases=self.bias, labels=flat_labels, inputs=flat_hidden,
+                         num_sampled=self.n_sampled, num_classes=self.n_classes, num_true=n_true,
+                         sampled_values=sampled_values)
+        # padded positions (all labels 0) don't contribute to the loss
+        losses *= K.cast(K.any(K.not_equal(flat_labels, 0), axis=-1), K.floatx())
+        return K.reshape(losses, K.shape(labels)[:-1])
+
+    def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            return tuple(input_shape[1][:-1])
+        return tuple(input_shape[:-1]) + (self.n_classes,)
+
+    def compute_mask(self, inputs, mask=None):
+        return None
+
+    def get_config(self):
+        config = {'n_classes': self.n_classes, 'n_sampled': self.n_sampled, 'loss': self.loss, 'sampler': self.sampler}
+        base_config = super(SampledOutput, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def sampled_output_loss(y_true, y_pred):
+    '''a SampledOutput layer called on the labels already outputs the loss, so y_true is just a placeholder'''
+    return y_pred
+
+
+sampled_output_objects = {'SampledOutput': SampledOutput, 'sampled_output_loss': sampled_output_loss}
+
+
+def get_scoring_model(model):
+    '''for a model trained with a SampledOutput layer (whose labels are the last model input), return a model with the
+    same weights that takes the other inputs and outputs the exact distribution over all words instead of the loss'''
+    output_layer = [layer for layer in model.layers if isinstance(layer, SampledOutput)][0]
+    loss_output = output_layer.get_output_at(0)
+    pred_output = output_layer(output_layer.get_input_at(0)[0])
+    outputs = [pred_output if output is loss_output else output for output in model.outputs]
+    return Model(input=model.inputs[:-1], output=outputs if len(outputs) > 1 else outputs[0])
+
+
+def gather_target_probs(inputs):
+    '''given a (batch, timesteps, n_words) probs tensor and the (batch, timesteps) target words, return the
+    (batch, timesteps) probs of the target words, gathered from the flattened probs'''
+    probs, targets = inputs
+    targets = K.flatten(K.cast(targets, 'int32'))
+    n_words = K.shape(probs)[-1]
+    target_probs = K.gather(K.flatten(probs), K.arange(0, K.shape(targets)[0]) * n_words + targets)
+    return K.reshape(target_probs, K.shape(inputs[1]))
+
+
+def get_label_batch(seqs, n_labels):
+    '''target word ids of each sequence as an (n_seqs, n_labels) array for a SampledOutput layer; sequences are truncated
+    or repeated up to n_labels so that padding isn't counted as a target (empty sequences are all 0 and masked)'''
+    return numpy.array([numpy.resize(numpy.array(seq[:n_labels], dtype='int64'), n_labels) for seq in seqs])
+
 
 class SavedModel():
 
+    n_batch_workers = 1  # number of threads preparing upcoming training batches while the model trains on the current one
+
     def save(self):
         if not os.path.isdir(self.filepath):
             os.mkdir(self.filepath)
@@ -42,13 +187,32 @@ class SavedModel():
             del attrs['encoder_model']
         if 'sample_words' in attrs:
             del attrs['sample_words']
+        if 'scoring_model' in attrs:
+            del attrs['scoring_model']
+        if 'hidden_model' in attrs:
+            del attrs['hidden_model']
+        if 'output_weights' in attrs:
+            del attrs['output_weights']
+        if 'target_prob_model' in attrs:
+            del attrs['target_prob_model']
         return attrs
 
+    def get_scoring_model(self):
+        '''model that outputs word probabilities: self.model itself, unless it was trained with a sampled output layer
+        (n_sampled > 0), in which case a model sharing its weights that computes the exact output over all words'''
+        if not getattr(self, 'n_sampled', 0):
+            return self.model
+        if getattr(self, 'scoring_model', None) is None:
+            self.scoring_model = get_scoring_model(self.model)
+            self.scoring_model._make_predict_function()
+        return self.scoring_model
+
     @classmethod
     def load(cls, filepath, custom_objects=None):
         with open(filepath + '/classifier.pkl', 'rb') as f:
             classifier = pickle.load(f)
-        classifier.model = load_model(filepath + '/classifier.h5')
+        classifier.model = load_model(filepath + '/classifier.h5',
+                                      custom_objects=dict(sampled_output_objects, **(custom_objects or {})))
         # Resolves a TensorFlow bug that appears when serving in Flask and CherryPy
         classifier.model._make_predict_function()
         print('loaded classifier from', filepath + '/classifier.pkl')
@@ -85,6 +249,8 @@ def get_vector_batch(seqs, vector_length, binary_values=False):
 
 
 def get_batch_features(features, batch_size=None):
+    if sparse.issparse(features):  # bag-of-words features may be stored as a sparse matrix
+        features = features.toarray()
     if batch_size and len(features) < batch_size:
         # too few sequences for batch, so add extra rows
         batch_padding = numpy.zeros((batch_size - len(features), features.shape[1]), dtype='int64')
@@ -107,6 +273,49 @@ def batch_seqs_to_list(batch_seqs, len_batch, batch_size):
     return batch_seqs
 
 
+class BatchSequence(Sequence):
+    '''keras Sequence over n_items training instances, where make_batch(start_idx, end_idx) prepares the batch
+    (e.g. padded or count vector arrays) for instances start_idx to end_idx; batches are used in order. If shuffle=True,
+    the instances are permuted at the end of each epoch and make_batch(idxs) is given the array of instance indices instead'''
+
+    def __init__(self, n_items, batch_size, make_batch, shuffle=False):
+        self.n_items = n_items
+        self.batch_size = batch_size
+        self.make_batch = make_batch
+        self.shuffle = shuffle
+        if self.shuffle:
+            self.idxs = rng.permutation(self.n_items)
+
+    def __len__(self):
+        return int(numpy.ceil(self.n_items * 1. / self.batch_size))
+
+    def __getitem__(self, batch_num):
+        if self.shuffle:
+            return self.make_batch(self.idxs[batch_num * self.batch_size:(batch_num + 1) * self.batch_size])
+        return self.make_batch(batch_num * self.batch_size, (batch_num + 1) * self.batch_size)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.idxs = rng.permutation(self.n_items)
+
+
+def iter_batches(batches, n_workers=1, max_queue_size=10):
+    '''yield each batch of a BatchSequence in order, with up to max_queue_size upcoming batches prepared by n_workers
+    background threads while the caller trains on the current batch; with n_workers=0 batches are prepared inline'''
+    if not n_workers:
+        for batch_num in range(len(batches)):
+            yield batches[batch_num]
+        return
+    enqueuer = OrderedEnqueuer(batches, use_multiprocessing=False, shuffle=False)
+    enqueuer.start(workers=n_workers, max_queue_size=max_queue_size)
+    try:
+        output = enqueuer.get()
+        for batch_num in range(len(batches)):
+            yield next(output)
+    finally:
+        enqueuer.stop()
+
+
 class LogisticRegressionClassifier():
 
     def __init__(self, n_output_classes, batch_size=100, verbose=True):
@@ -251,7 +460,7 @@ class RNNLM(SavedModel):
 
     def __init__(self, use_features=False, use_pos=False, lexicon_size=None, n_pos_tags=None, n_timesteps=15, n_embedding_nodes=300, n_pos_embedding_nodes=25,
                  n_pos_nodes=100, n_feature_nodes=100, n_hidden_nodes=250, n_hidden_layers=1, embeddings=None, batch_size=1, verbose=1, filepath=None, optimizer='Adam',
-                 lr=0.001, clipvalue=5.0, decay=1e-6):
+                 lr=0.001, clipvalue=5.0, decay=1e-6, n_sampled=0, sampled_loss='sampled_softmax', sampler='unigram'):
         '''Uncomment to use Theano for sampling'''
         # import theano
         # import theano.tensor as T
@@ -277,11 +486,16 @@ class RNNLM(SavedModel):
         self.decay = decay
         self.use_features = use_features
         self.use_pos = use_pos
+        # if n_sampled > 0, train the output layer with sampled_loss ('sampled_softmax' or 'nce') against n_sampled words
+        # from sampler ('unigram' or 'log_uniform') instead of the full softmax over the lexicon
+        self.n_sampled = n_sampled
+        self.sampled_loss = sampled_loss
+        self.sampler = sampler
 
         if self.verbose:
             print("Created model", self.__class__.__name__, ":", self.__dict__)
 
-    def create_model(self, n_timesteps=None, batch_size=1, include_pred_layer=True):
+    def create_model(self, n_timesteps=None, batch_size=1, include_pred_layer=True, word_counts=None):
 
         input_layers = []
 
@@ -324,30 +538,42 @@ class RNNLM(SavedModel):
                                      mode='concat', concat_axis=-1, name='feature_merge_hidden_layer')
 
         output_layers = []
+        losses = []
         if include_pred_layer:
-            pred_layer = TimeDistributed(
-                Dense(self.lexicon_size + 1, activation="softmax", name='pred_layer'))(seq_hidden_layer)
+            if getattr(self, 'n_sampled', 0):  # next words are an extra (last) input, the output is their sampled loss
+                label_input_layer = Input(batch_shape=(batch_size, n_timesteps, 1), name="label_input_layer")
+                input_layers.append(label_input_layer)
+                pred_layer = SampledOutput(self.lexicon_size + 1, n_sampled=self.n_sampled, loss=self.sampled_loss,
+                                           sampler=self.sampler, class_counts=word_counts,
+                                           name='pred_layer')([seq_hidden_layer, label_input_layer])
+                losses.append(sampled_output_loss)
+            else:
+                pred_layer = TimeDistributed(
+                    Dense(self.lexicon_size + 1, activation="softmax", name='pred_layer'))(seq_hidden_layer)
+                losses.append("sparse_categorical_crossentropy")
             output_layers.append(pred_layer)
             if self.use_pos:
                 pred_pos_layer = TimeDistributed(
                     Dense(self.n_pos_tags + 1, activation="softmax", name='pred_pos_layer'))(seq_hidden_layer)
                 output_layers.append(pred_pos_layer)
+                losses.append("sparse_categorical_crossentropy")
 
         model = Model(input=input_layers, output=output_layers)
 
         # select optimizer and compile
-        model.compile(loss="sparse_categorical_crossentropy",
+        model.compile(loss=losses or "sparse_categorical_crossentropy",
                       optimizer=eval(self.optimizer)(clipvalue=self.clipvalue, lr=self.lr, decay=self.decay))
 
         return model
 
-    def fit(self, seqs, pos_seqs=None, feature_vecs=None, lexicon_size=None):
+    def fit(self, seqs, pos_seqs=None, feature_vecs=None, lexicon_size=None, word_counts=None):
+        '''word_counts (counts of each word index) initializes the unigram sampler if the model uses a sampled loss'''
 
         if not hasattr(self, 'model'):
             assert(lexicon_size is not None)
             self.lexicon_size = lexicon_size
             self.model = self.create_model(
-                n_timesteps=self.n_timesteps, batch_size=self.batch_size)
+                n_timesteps=self.n_timesteps, batch_size=self.batch_size, word_counts=word_counts)
             self.start_time = timeit.default_timer()
 
         if self.verbose:
@@ -364,20 +590,25 @@ class RNNLM(SavedModel):
             # assert(numpy.all(numpy.array(len(seq) == len(pos_seq)) for seq, pos_seq in zip(seqs, pos_seqs)))
             pos_seqs = [pos_seqs[idx] for idx in sorted_idxs]
         if self.use_features:
-            assert(len(seqs) == len(feature_vecs))
+            assert(len(seqs) == feature_vecs.shape[0])  # feature_vecs may be a sparse matrix
             feature_vecs = feature_vecs[sorted_idxs]
-        for batch_index in range(0, len(seqs), self.batch_size):
-            batch_inputs = []
-            batch_outputs = []
-            batch = get_seq_batch(seqs=seqs[batch_index:batch_index + self.batch_size],
+
+        def make_batch(start_idx, end_idx):
+            batch = get_seq_batch(seqs=seqs[start_idx:end_idx],
                                   batch_size=self.batch_size, n_timesteps=self.n_timesteps)  # prep batch
+            batch_pos = None
+            batch_features = None
             if self.use_pos:
-                batch_pos = get_seq_batch(seqs=pos_seqs[batch_index:batch_index + self.batch_size],
+                batch_pos = get_seq_batch(seqs=pos_seqs[start_idx:end_idx],
                                           batch_size=self.batch_size, n_timesteps=self.n_timesteps)
             if self.use_features:
-                batch_features = get_batch_features(features=feature_vecs[batch_index:batch_index + self.batch_size],
+                batch_features = get_batch_features(features=feature_vecs[start_idx:end_idx],
                                                     batch_size=self.batch_size)
-                batch_inputs.append(batch_features)
+            return batch, batch_pos, batch_features
+
+        batches = BatchSequence(len(seqs), self.batch_size, make_batch)
+        for batch_num, (batch, batch_pos, batch_features) in enumerate(iter_batches(batches, self.n_batch_workers)):
+            batch_index = batch_num * self.batch_size
             for step_index in range(0, batch.shape[-1] - 1, self.n_timesteps):
                 batch_x = batch[:, step_index:step_index + self.n_timesteps]
                 if not numpy.sum(batch_x):
@@ -395,6 +626,9 @@ class RNNLM(SavedModel):
                     batch_outputs.append(batch_pos_y)
                 if self.use_features:
                     batch_inputs.append(batch_features)
+                if getattr(self, 'n_sampled', 0):  # the model outputs the loss of the next words given as input
+                    batch_inputs.append(batch_y)
+                    batch_outputs[0] = numpy.zeros(batch_y.shape[:-1])
                 train_loss = self.model.train_on_batch(x=batch_inputs, y=batch_outputs)
                 train_losses.append(train_loss)
             self.model.reset_states()
@@ -489,11 +723,14 @@ class RNNLM(SavedModel):
         if not hasattr(self, 'pred_model') or batch_size != self.pred_model.layers[0].batch_input_shape[0]:
             '''Completely reload the model from disk even though it's already loaded.
             This is a hack to avoid threading issues that cause an error when models are loaded in different threads'''
-            K.clear_session()
-            self.model = load_model(self.filepath + '/classifier.h5')
+            reset_session()
+            self.model = load_model(self.filepath + '/classifier.h5', custom_objects=sampled_output_objects)
             self.model._make_predict_function()
+            self.scoring_model = None
             # Transfer weights from trained model to new model used for generation
             self.pred_model = self.create_model(batch_size=batch_size, n_timesteps=1)
+            if getattr(self, 'n_sampled', 0):  # generate from the exact softmax over all words
+                self.pred_model = get_scoring_model(self.pred_model)
             self.pred_model.set_weights(self.model.get_weights())
             self.pred_model._make_predict_function()
             if self.verbose:
@@ -690,17 +927,18 @@ class MLPBinaryClassifier(SavedModel):
         seqs2 = [seqs2[idx] for idx in random_idxs]
         labels = labels[random_idxs]
 
+        def make_batch(start_idx, end_idx):
+            batch_seqs1 = get_vector_batch(seqs1[start_idx:end_idx], vector_length=self.lexicon_size + 1)
+            batch_seqs2 = get_vector_batch(seqs2[start_idx:end_idx], vector_length=self.lexicon_size + 1)
+            return [batch_seqs1, batch_seqs2], labels[start_idx:end_idx]
+
+        batches = BatchSequence(len(seqs1), self.batch_size, make_batch)
         for epoch in range(n_epochs):
             losses = []
             print("EPOCH:", epoch + 1)
-            for batch_idx in range(0, len(seqs1), self.batch_size):
-                batch_seqs1 = get_vector_batch(seqs1[batch_idx:batch_idx + self.batch_size],
-                                               vector_length=self.lexicon_size + 1)
-                batch_seqs2 = get_vector_batch(seqs2[batch_idx:batch_idx + self.batch_size],
-                                               vector_length=self.lexicon_size + 1)
-                batch_labels = labels[batch_idx:batch_idx + self.batch_size]
-                losses.append(self.model.train_on_batch([batch_seqs1, batch_seqs2], batch_labels))
-                if batch_idx and batch_idx % (self.batch_size * 1000) == 0:
+            for batch_num, (batch_inputs, batch_labels) in enumerate(iter_batches(batches, self.n_batch_workers)):
+                losses.append(self.model.train_on_batch(batch_inputs, batch_labels))
+                if batch_num and batch_num % 1000 == 0:
                     print("loss: {:.3f}, accuracy: {:.3f}".format(numpy.mean(numpy.array(losses)[:, 0]),
                                                                   numpy.mean(numpy.array(losses)[:, 1])))
             print("loss: {:.3f}, accuracy: {:.3f}".format(numpy.mean(numpy.array(losses)[:, 0]),
@@ -787,17 +1025,20 @@ class RNNBinaryClassifier(SavedModel):
 
         assert(len(seqs1) == len(seqs2) == len(labels))
 
+        def make_batch(start_idx, end_idx):
+            batch_seqs1 = numpy.array(seqs1[start_idx:end_idx])
+            batch_seqs2 = numpy.array(seqs2[start_idx:end_idx])
+            return [batch_seqs1, batch_seqs2], labels[start_idx:end_idx]
+
+        batches = BatchSequence(len(seqs1), self.batch_size, make_batch)
         for epoch in range(n_epochs):
             losses = []
             if n_epochs > 1:
                 print("EPOCH:", epoch + 1)
-            for batch_idx in range(0, len(seqs1), self.batch_size):
-                batch_seqs1 = numpy.array(seqs1[batch_idx:batch_idx + self.batch_size])
-                batch_seqs2 = numpy.array(seqs2[batch_idx:batch_idx + self.batch_size])
-                batch_labels = labels[batch_idx:batch_idx + self.batch_size]
-                losses.append(self.model.train_on_batch(x=[batch_seqs1, batch_seqs2],
+            for batch_num, (batch_inputs, batch_labels) in enumerate(iter_batches(batches, self.n_batch_workers)):
+                losses.append(self.model.train_on_batch(x=batch_inputs,
                                                         y=batch_labels))
-                if batch_idx and batch_idx % (self.batch_size * 1000) == 0:
+                if batch_num and batch_num % 1000 == 0:
                     print("loss: {:.7f}".format(numpy.mean(numpy.array(losses))))
             print("loss: {:.7f}".format(numpy.mean(numpy.array(losses))))
 
@@ -823,7 +1064,8 @@ class RNNBinaryClassifier(SavedModel):
 class MLPLM(SavedModel):
 
     def __init__(self, n_timesteps, lexicon_size=None, n_embedding_nodes=300, n_hidden_nodes=500, n_hidden_layers=1,
-                 embeddings=None, batch_size=1, verbose=1, filepath=None, optimizer='Adam', lr=0.001, clipvalue=5.0, decay=1e-6):
+                 embeddings=None, batch_size=1, verbose=1, filepath=None, optimizer='Adam', lr=0.001, clipvalue=5.0, decay=1e-6,
+                 n_sampled=0, sampled_loss='sampled_softmax', sampler='unigram'):
         '''Uncomment to use Theano for sampling'''
         # import theano
         # import theano.tensor as T
@@ -843,6 +1085,11 @@ class MLPLM(SavedModel):
         self.lr = lr
         self.clipvalue = clipvalue
         self.decay = decay
+        # if n_sampled > 0, train the output layer with sampled_loss ('sampled_softmax' or 'nce') against n_sampled words
+        # from sampler ('unigram' or 'log_uniform') instead of the full softmax over the lexicon
+        self.n_sampled = n_sampled
+        self.sampled_loss = sampled_loss
+        self.sampler = sampler
 
         if self.verbose:
             print("CREATED MLPLM: embedding layer nodes = {}, hidden layers = {}, "
@@ -851,7 +1098,7 @@ class MLPLM(SavedModel):
                       self.n_embedding_nodes, self.n_hidden_layers, self.n_hidden_nodes,
                       self.optimizer, self.lr, self.clipvalue, self.decay))
 
-    def create_model(self, n_timesteps, batch_size=1, pred_layer=True):
+    def create_model(self, n_timesteps, batch_size=1, pred_layer=True, word_counts=None):
 
         model = Sequential()
 
@@ -865,6 +1112,17 @@ class MLPLM(SavedModel):
                             batch_input_shape=(batch_size, n_timesteps, self.n_embedding_nodes),
                             activation='tanh'))
 
+        if pred_layer and getattr(self, 'n_sampled', 0):  # next words are an extra input, the output is their sampled loss
+            seq_input_layer = Input(batch_shape=(batch_size, n_timesteps), name="seq_input_layer")
+            label_input_layer = Input(batch_shape=(batch_size, 1), name="label_input_layer")
+            pred_layer = SampledOutput(self.lexicon_size + 1, n_sampled=self.n_sampled, loss=self.sampled_loss,
+                                       sampler=self.sampler, class_counts=word_counts,
+                                       name='pred_layer')([model(seq_input_layer), label_input_layer])
+            model = Model(input=[seq_input_layer, label_input_layer], output=pred_layer)
+            model.compile(loss=sampled_output_loss,
+                          optimizer=eval(self.optimizer)(clipvalue=self.clipvalue, lr=self.lr, decay=self.decay))
+            return model
+
         if pred_layer:
             model.add(Dense(self.lexicon_size + 1, activation="softmax"))
 
@@ -874,12 +1132,13 @@ class MLPLM(SavedModel):
 
         return model
 
-    def fit(self, seqs, lexicon_size=None, n_epochs=5):
+    def fit(self, seqs, lexicon_size=None, n_epochs=5, word_counts=None):
+        '''word_counts (counts of each word index) initializes the unigram sampler if the model uses a sampled loss'''
         if not hasattr(self, 'model'):
             assert(lexicon_size is not None)
             self.lexicon_size = lexicon_size
             self.model = self.create_model(n_timesteps=self.n_timesteps,
-                                           batch_size=self.batch_size)
+                                           batch_size=self.batch_size, word_counts=word_counts)
             self.start_time = timeit.default_timer()
 
         assert(type(seqs[0][0]) not in [list, tuple, numpy.ndarray])
@@ -890,14 +1149,27 @@ class MLPLM(SavedModel):
         y = X[:, -1][:, None]
         X = X[:, :-1]
 
-        train_loss = self.model.fit(X, y, nb_epoch=n_epochs, batch_size=self.batch_size)
+        if getattr(self, 'n_sampled', 0):  # the model outputs the loss of the next words given as input
+            batches = BatchSequence(len(X), self.batch_size,
+                                    lambda idxs: ([X[idxs], y[idxs]], numpy.zeros(len(idxs))), shuffle=True)
+        else:
+            batches = BatchSequence(len(X), self.batch_size, lambda idxs: (X[idxs], y[idxs]), shuffle=True)
+        if self.n_batch_workers:
+            train_loss = self.model.fit_generator(batches, steps_per_epoch=len(batches), epochs=n_epochs,
+                                                  workers=self.n_batch_workers, use_multiprocessing=False).history['loss']
+        else:  # this keras version requires workers >= 1, so prepare the batches on the main thread instead
+            train_loss = []
+            for epoch in range(n_epochs):
+                train_loss.append(numpy.mean([self.model.train_on_batch(*batches[batch_num])
+                                              for batch_num in range(len(batches))]))
+                batches.on_epoch_end()
 
         if self.filepath:
             # save model after each epoch if filepath given
             self.save()
         #self.epoch += 1
         if self.verbose:
-            print("loss: {:.3f} ({:.3f}m)".format(numpy.mean(train_loss.history['loss']),
+            print("loss: {:.3f} ({:.3f}m)".format(numpy.mean(train_loss),
                                                   (timeit.default_timer() - self.start_time) / 60))
 
     def pred_next_words(self, p_next_words, mode='max', n_best=1, temp=1.0, prevent_unk=True):
@@ -944,7 +1216,7 @@ class MLPLM(SavedModel):
         X = numpy.array([seq[-1] for seq in X])  # only predict from last ngram in each sequence
 
         for idx in range(max_length):
-            p_next_words = self.model.predict(X[:, -self.n_timesteps:], batch_size=batch_size)
+            p_next_words = self.get_scoring_model().predict(X[:, -self.n_timesteps:], batch_size=batch_size)
             next_words = self.pred_next_words(p_next_words, mode, n_best, temp, prevent_unk)
             X = numpy.append(X, next_words, axis=1)
 
@@ -967,7 +1239,7 @@ class MLPLM(SavedModel):
         y = X[:, -1][:, None]
         X = X[:, :-1]
 
-        p_next_words = self.model.predict(X)[numpy.arange(len(X)), y[:, 0]]
+        p_next_words = self.get_scoring_model().predict(X)[numpy.arange(len(X)), y[:, 0]]
         idx = 0
         for len_seq in len_seqs:  # reshape probs back into sequences to get mean log prob for each sequence
             #p_next_words_ = numpy.mean(numpy.log(p_next_words[idx:idx+len_seq-self.n_timesteps]))
@@ -980,7 +1252,8 @@ class MLPLM(SavedModel):
 
 class EncoderDecoder(SavedModel):
 
-    def __init__(self, n_embedding_nodes=300, n_hidden_nodes=500, recurrent=False, batch_size=100, filepath=None, verbose=True):
+    def __init__(self, n_embedding_nodes=300, n_hidden_nodes=500, recurrent=False, batch_size=100, filepath=None, verbose=True,
+                 n_sampled=0, sampled_loss='sampled_softmax', sampler='unigram'):
 
         self.n_embedding_nodes = n_embedding_nodes
         self.n_hidden_nodes = n_hidden_nodes
@@ -990,8 +1263,13 @@ class EncoderDecoder(SavedModel):
         self.batch_size = batch_size
         self.n_timesteps = None
         self.lexicon_size = None
+        # if n_sampled > 0, train the output layer with sampled_loss ('sampled_softmax' or 'nce') against n_sampled words
+        # from sampler ('unigram' or 'log_uniform') instead of the full softmax (or sigmoid) over the lexicon
+        self.n_sampled = n_sampled
+        self.sampled_loss = sampled_loss
+        self.sampler = sampler
 
-    def create_model(self):
+    def create_model(self, word_counts=None):
 
         if self.recurrent:  # use sequence-to-sequence (RNN) model
             encoder_inputs = Input(shape=(self.n_timesteps,), name='input_seq_layer')
@@ -1004,63 +1282,86 @@ class EncoderDecoder(SavedModel):
             emb_decoder_inputs = emb_layer(decoder_inputs)
             decoder_gru = GRU(self.n_hidden_nodes, name='decoded_seq_layer', return_sequences=True)
             decoder_outputs = decoder_gru(emb_decoder_inputs, initial_state=state_h)
-            decoder_dense = Dense(self.lexicon_size + 1,
-                                  name='output_seq_layer', activation='softmax')
-            decoder_outputs = decoder_dense(decoder_outputs)
-            model = Model([encoder_inputs, decoder_inputs], decoder_outputs)
-            model.compile(loss="sparse_categorical_crossentropy", optimizer='adam')
+            if getattr(self, 'n_sampled', 0):  # output words are an extra input, the output is their sampled loss
+                label_inputs = Input(shape=(self.n_timesteps, 1), name='output_label_layer')
+                decoder_outputs = SampledOutput(self.lexicon_size + 1, n_sampled=self.n_sampled, loss=self.sampled_loss,
+                                                sampler=self.sampler, class_counts=word_counts,
+                                                name='output_seq_layer')([decoder_outputs, label_inputs])
+                model = Model([encoder_inputs, decoder_inputs, label_inputs], decoder_outputs)
+                model.compile(loss=sampled_output_loss, optimizer='adam')
+            else:
+                decoder_dense = Dense(self.lexicon_size + 1,
+                                      name='output_seq_layer', activation='softmax')
+                decoder_outputs = decoder_dense(decoder_outputs)
+                model = Model([encoder_inputs, decoder_inputs], decoder_outputs)
+                model.compile(loss="sparse_categorical_crossentropy", optimizer='adam')
 
         else:  # flat encoder-decoder (no recurrent layer)
 
             input_seq_layer = Input(shape=(self.lexicon_size + 1,), name="input_seq_layer")
             encoded_seq_layer = Dense(output_dim=self.n_hidden_nodes,
                                       activation='sigmoid', name='encoded_seq_layer')(input_seq_layer)
-            output_seq_layer = Dense(output_dim=self.lexicon_size + 1,
-                                     activation='sigmoid', name='output_seq_layer')(encoded_seq_layer)
-            model = Model(input=input_seq_layer, output=output_seq_layer)
-            model.compile(loss="binary_crossentropy", optimizer='adam')
+            if getattr(self, 'n_sampled', 0):  # words in output seq are an extra input, the output is their sampled loss
+                label_seq_layer = Input(shape=(self.n_timesteps,), name="label_seq_layer")
+                output_seq_layer = SampledOutput(self.lexicon_size + 1, n_sampled=self.n_sampled, loss=self.sampled_loss,
+                                                 sampler=self.sampler, class_counts=word_counts,
+                                                 name='output_seq_layer')([encoded_seq_layer, label_seq_layer])
+                model = Model(input=[input_seq_layer, label_seq_layer], output=output_seq_layer)
+                model.compile(loss=sampled_output_loss, optimizer='adam')
+            else:
+                output_seq_layer = Dense(output_dim=self.lexicon_size + 1,
+                                         activation='sigmoid', name='output_seq_layer')(encoded_seq_layer)
+                model = Model(input=input_seq_layer, output=output_seq_layer)
+                model.compile(loss="binary_crossentropy", optimizer='adam')
 
         return model
 
-    def fit(self, seqs1, seqs2, n_timesteps=None, lexicon_size=None, n_epochs=1, save_to_filepath=False):
+    def fit(self, seqs1, seqs2, n_timesteps=None, lexicon_size=None, n_epochs=1, save_to_filepath=False, word_counts=None):
+        '''word_counts (counts of each word index) initializes the unigram sampler if the model uses a sampled loss'''
 
         if not hasattr(self, 'model'):
             assert(lexicon_size is not None)
             self.lexicon_size = lexicon_size
             self.n_timesteps = n_timesteps
-            if self.recurrent and not self.n_timesteps:
+            if (self.recurrent or getattr(self, 'n_sampled', 0)) and not self.n_timesteps:
                 # if n_timesteps not given, set it to length of longest sequence
                 self.n_timesteps = max([len(seq) for seq in seqs1 + seqs2])
-            self.model = self.create_model()
+            self.model = self.create_model(word_counts=word_counts)
             if self.verbose:
                 print("Created model", self.__class__.__name__, ":", self.__dict__)
+        self.output_weights = None  # weights are about to change
 
         assert(len(seqs1) == len(seqs2))
 
+        def make_batch(start_idx, end_idx):
+            if self.recurrent:
+                batch_seqs1 = get_seq_batch(seqs1[start_idx:end_idx], max_length=self.n_timesteps)
+                batch_seqs2 = get_seq_batch(seqs2[start_idx:end_idx], padding='post', max_length=self.n_timesteps)
+                # prepend zeros (not sure if this is necessary)
+                batch_seqs2 = numpy.insert(batch_seqs2, 0,
+                                           numpy.zeros(len(batch_seqs2)),
+                                           axis=-1)
+                if getattr(self, 'n_sampled', 0):  # the model outputs the loss of the output words given as input
+                    return ([batch_seqs1, batch_seqs2[:, :-1], batch_seqs2[:, 1:, None]],
+                            numpy.zeros(batch_seqs2[:, 1:].shape))
+                return [batch_seqs1, batch_seqs2[:, :-1]], batch_seqs2[:, 1:, None]
+            else:
+                batch_seqs1 = get_vector_batch(seqs1[start_idx:end_idx], vector_length=self.lexicon_size + 1)
+                if getattr(self, 'n_sampled', 0):  # the model outputs the loss of the output words given as input
+                    batch_labels = get_label_batch(seqs2[start_idx:end_idx], n_labels=self.n_timesteps)
+                    return [batch_seqs1, batch_labels], numpy.zeros(len(batch_labels))
+                batch_seqs2 = get_vector_batch(seqs2[start_idx:end_idx], vector_length=self.lexicon_size + 1)
+                return batch_seqs1, batch_seqs2
+
+        batches = BatchSequence(len(seqs1), self.batch_size, make_batch)
         for epoch in range(n_epochs):
             losses = []
             if n_epochs > 1:
                 if self.verbose:
                     print("EPOCH:", epoch + 1)
-            for batch_idx in range(0, len(seqs1), self.batch_size):
-                if self.recurrent:
-                    batch_seqs1 = get_seq_batch(seqs1[batch_idx:batch_idx + self.batch_size],
-                                                max_length=self.n_timesteps)
-                    batch_seqs2 = get_seq_batch(seqs2[batch_idx:batch_idx + self.batch_size],
-                                                padding='post', max_length=self.n_timesteps)
-                    # prepend zeros (not sure if this is necessary)
-                    batch_seqs2 = numpy.insert(batch_seqs2, 0,
-                                               numpy.zeros(len(batch_seqs2)),
-                                               axis=-1)
-                    losses.append(self.model.train_on_batch(x=[batch_seqs1, batch_seqs2[:, :-1]],
-                                                            y=batch_seqs2[:, 1:, None]))
-                else:
-                    batch_seqs1 = get_vector_batch(seqs1[batch_idx:batch_idx + self.batch_size],
-                                                   vector_length=self.lexicon_size + 1)
-                    batch_seqs2 = get_vector_batch(seqs2[batch_idx:batch_idx + self.batch_size],
-                                                   vector_length=self.lexicon_size + 1)
-                    losses.append(self.model.train_on_batch(x=batch_seqs1, y=batch_seqs2))
-                if batch_idx and batch_idx % (self.batch_size * 1000) == 0:
+            for batch_num, (batch_x, batch_y) in enumerate(iter_batches(batches, self.n_batch_workers)):
+                losses.append(self.model.train_on_batch(x=batch_x, y=batch_y))
+                if batch_num and batch_num % 1000 == 0:
                     if self.verbose:
                         print("loss: {:.7f}".format(numpy.mean(numpy.array(losses))))
             if self.verbose:
@@ -1068,24 +1369,110 @@ class EncoderDecoder(SavedModel):
             if save_to_filepath and self.filepath:
                 self.save()
 
-    def predict(self, seq1, seq2, pred_method='multiply'):
+    def get_hidden_model(self):
+        '''model sharing the weights of self.model that outputs the input to the output layer (the decoder states for
+        the recurrent model, the encoded seq for the flat model), so the output layer can be applied to candidate words only'''
+        if getattr(self, 'hidden_model', None) is None:
+            output_layer = self.model.get_layer('output_seq_layer')
+            if getattr(self, 'n_sampled', 0):  # labels are the last input to the model and to the output layer
+                self.hidden_model = Model(input=self.model.inputs[:-1], output=output_layer.get_input_at(0)[0])
+            else:
+                self.hidden_model = Model(input=self.model.inputs, output=output_layer.get_input_at(0))
+            self.hidden_model._make_predict_function()
+        return self.hidden_model
+
+    def get_target_prob_model(self):
+        '''model sharing the weights of the scoring model (recurrent model only) that also takes the target word of each
+        decoder timestep and outputs only its prob, so the full (batch, timesteps, lexicon) output isn't returned'''
+        if getattr(self, 'target_prob_model', None) is None:
+            scoring_model = self.get_scoring_model()
+            target_input_layer = Input(shape=(None,), dtype='int32')
+            target_probs = Lambda(gather_target_probs, output_shape=lambda input_shapes: input_shapes[1])(
+                [scoring_model.output, target_input_layer])
+            self.target_prob_model = Model(input=scoring_model.inputs + [target_input_layer], output=target_probs)
+            self.target_prob_model._make_predict_function()
+        return self.target_prob_model
+
+    def get_output_weights(self):
+        '''return the output layer weights as a contiguous (lexicon_size + 1, n_hidden_nodes) array with one row per word,
+        the bias for each word, and the output activation; copied from the model once and kept until it is trained again'''
+        if getattr(self, 'output_weights', None) is None:
+            output_layer = self.model.get_layer('output_seq_layer')
+            if getattr(self, 'n_sampled', 0):  # SampledOutput kernel already has one row per word
+                kernel, bias = output_layer.get_weights()[:2]
+                activation = 'sigmoid' if output_layer.loss == 'nce' else 'softmax'
+            else:
+                kernel, bias = output_layer.get_weights()
+                kernel = numpy.ascontiguousarray(kernel.T)
+                activation = output_layer.get_config()['activation']
+            self.output_weights = kernel, bias, activation
+        return self.output_weights
+
+    def get_log_normalizers(self, hidden, chunk_size=1000):
+        '''log of the softmax normalizer over the whole lexicon (logsumexp of the output logits) for each row of hidden'''
+        kernel, bias, activation = self.get_output_weights()
+        log_normalizers = numpy.zeros((len(hidden),))
+        for idx in range(0, len(hidden), chunk_size):
+            logits = hidden[idx:idx + chunk_size].dot(kernel.T) + bias
+            max_logits = numpy.max(logits, axis=1)
+            log_normalizers[idx:idx + chunk_size] = max_logits + numpy.log(
+                numpy.sum(numpy.exp(logits - max_logits[:, None]), axis=1))
+        return log_normalizers
+
+    def get_candidate_log_probs(self, hidden, words, hidden_idxs=None):
+        '''log probs of the given words, where words[i] is scored against hidden[hidden_idxs[i]] (hidden[i] if hidden_idxs
+        is None; hidden is the output layer input). The words' logits are computed as a gather of their weight rows and a
+        dot product instead of the full output layer; for sigmoid outputs that is all that is needed, while softmax outputs
+        also need the normalizer over the whole lexicon, which is computed once per row of hidden'''
+        kernel, bias, activation = self.get_output_weights()
+        word_hidden = hidden if hidden_idxs is None else hidden[hidden_idxs]
+        logits = numpy.einsum('ij,ij->i', word_hidden, kernel[words]) + bias[words]
+        if activation == 'sigmoid':
+            return -numpy.logaddexp(0, -logits)
+        log_normalizers = self.get_log_normalizers(hidden)
+        return logits - (log_normalizers if hidden_idxs is None else log_normalizers[hidden_idxs])
+
+    def predict(self, seq1, seq2, pred_method='multiply', candidates_only=False):
+        '''return log prob of seq2 given seq1; if candidates_only=True, the output layer is only computed for the words in
+        seq2 (see get_candidate_log_probs()). For sigmoid outputs the cost then depends on the length of seq2 rather than
+        the lexicon size; softmax outputs (recurrent or sampled softmax models) still need one pass over the lexicon per
+        hidden state for the normalizer'''
+
+        return self.predict_batch([seq1], [seq2], candidates_only=candidates_only)[0]
+
+    def predict_batch(self, seqs1, seqs2, candidates_only=False):
+        '''same as predict(), but scores all pairs of seqs1 and seqs2 with a single model call'''
 
         if self.recurrent:
-            seq1 = get_seq_batch([seq1], max_length=self.n_timesteps)
-            seq2 = get_seq_batch([seq2], padding='post', max_length=self.n_timesteps)
+            seqs1 = get_seq_batch(seqs1, max_length=self.n_timesteps)
+            seqs2 = get_seq_batch(seqs2, padding='post', max_length=self.n_timesteps)
             # prepend zeros (not sure if this is necessary)
-            seq2 = numpy.insert(seq2, 0, numpy.zeros(len(seq2)), axis=-1)
-            probs = self.model.predict_on_batch([seq1, seq2[:, :-1]])[0]
-            probs = probs[numpy.arange(self.n_timesteps), seq2[:, 1:]]
-            probs = probs[seq2[:, 1:] > 0]
-        else:
-            seq1 = get_vector_batch([seq1], vector_length=self.lexicon_size + 1)
-            probs = self.model.predict_on_batch(seq1)[0]
-            seq2 = get_vector_batch([seq2], vector_length=self.lexicon_size + 1)
-            probs = probs[seq2[0].astype('bool')]
-
-        prob = numpy.sum(numpy.log(probs))
-        return prob
+            seqs2 = numpy.insert(seqs2, 0, numpy.zeros(len(seqs2)), axis=-1)
+            words = seqs2[:, 1:]
+            is_word = words > 0
+            log_probs = numpy.zeros(words.shape)
+            if candidates_only:
+                hidden = self.get_hidden_model().predict_on_batch([seqs1, seqs2[:, :-1]])
+                log_probs[is_word] = self.get_candidate_log_probs(hidden[is_word], words[is_word])
+            else:
+                probs = self.get_target_prob_model().predict_on_batch([seqs1, seqs2[:, :-1], words])
+                log_probs[is_word] = numpy.log(probs[is_word])
+            return numpy.sum(log_probs, axis=1)
+
+        seqs1 = get_vector_batch(seqs1, vector_length=self.lexicon_size + 1)
+        if candidates_only:
+            hidden = self.get_hidden_model().predict_on_batch(seqs1)
+            words = [numpy.unique(seq2) for seq2 in seqs2]
+            words = [seq_words[seq_words > 0] for seq_words in words]
+            pair_idxs = numpy.repeat(numpy.arange(len(words)), [len(seq_words) for seq_words in words])
+            words = numpy.concatenate(words).astype('int64')
+            log_probs = self.get_candidate_log_probs(hidden, words, hidden_idxs=pair_idxs)
+            return numpy.bincount(pair_idxs, weights=log_probs, minlength=len(seqs1))
+        probs = self.get_scoring_model().predict_on_batch(seqs1)
+        is_word = get_vector_batch(seqs2, vector_length=self.lexicon_size + 1).astype('bool')
+        log_probs = numpy.zeros(probs.shape)
+        log_probs[is_word] = numpy.log(probs[is_word])
+        return numpy.sum(log_probs, axis=1)
 
     def get_most_probable_words(self, seq1, top_n_words=10, unigram_probs=None):
 
@@ -1097,11 +1484,14 @@ class EncoderDecoder(SavedModel):
         else:
             seq1 = get_seq_batch([seq1], max_length=self.n_timesteps)
 
-        probs = self.model.predict_on_batch(seq1)[0]
+        probs = self.get_scoring_model().predict_on_batch(seq1)[0]
         if unigram_probs is not None:  # discount probabilities by unigram frequency if given
             probs = probs / unigram_probs ** 0.66
             probs[numpy.isinf(probs)] = 0.0  # replace inf
-        most_probable_words = numpy.argsort(probs)[::-1][:top_n_words]
+        # select the top words without sorting the whole lexicon, then sort only those
+        top_n_words = min(top_n_words, len(probs))
+        most_probable_words = numpy.argpartition(-probs, top_n_words - 1)[:top_n_words]
+        most_probable_words = most_probable_words[numpy.argsort(-probs[most_probable_words])]
         probs = probs[most_probable_words]  # filter to return only probs for most probable words
 
         return most_probable_words, probs
@@ -1115,6 +1505,33 @@ class EmbeddingSimilarity(SavedModel):
         score = 1 - cosine(seq1, seq2)
         return score
 
+    def pad_seqs(self, seqs):
+        '''stack variable-length sequences of word embeddings into one zero-padded tensor, also returning the lengths'''
+        lengths = numpy.array([len(seq) for seq in seqs])
+        padded_seqs = numpy.zeros((len(seqs), numpy.max(lengths), len(seqs[0][0])))
+        for seq_idx, seq in enumerate(seqs):
+            padded_seqs[seq_idx, :lengths[seq_idx]] = seq
+        return padded_seqs, lengths
+
+    def predict_max_words(self, seqs1, seqs2, batch_size=1000):
+        '''avemax score for each pair of word embedding sequences: the max cosine similarity of each word in seq1 with
+        any word in seq2, averaged over the words in seq1; all word pairs in a batch are scored with a single matmul'''
+        assert (len(seqs1) == len(seqs2))
+        scores = numpy.zeros((len(seqs1),))
+        for batch_idx in range(0, len(seqs1), batch_size):
+            embs1, lengths1 = self.pad_seqs(seqs1[batch_idx:batch_idx + batch_size])
+            embs2, lengths2 = self.pad_seqs(seqs2[batch_idx:batch_idx + batch_size])
+            embs1 = embs1 + 1e-8
+            embs2 = embs2 + 1e-8  # smooth to avoid NaN, same as predict()
+            embs1 /= numpy.linalg.norm(embs1, axis=-1, keepdims=True)
+            embs2 /= numpy.linalg.norm(embs2, axis=-1, keepdims=True)
+            sims = numpy.einsum('bid,bjd->bij', embs1, embs2)
+            mask1 = numpy.arange(embs1.shape[1])[None, :] < lengths1[:, None]
+            mask2 = numpy.arange(embs2.shape[1])[None, :] < lengths2[:, None]
+            max_sims = numpy.max(numpy.where(mask2[:, None, :], sims, -numpy.inf), axis=-1)
+            scores[batch_idx:batch_idx + batch_size] = numpy.sum(numpy.where(mask1, max_sims, 0.0), axis=-1) / lengths1
+        return scores
+
 
 class CausalEmbeddings(SavedModel):
 
@@ -1169,6 +1586,34 @@ class CausalEmbeddings(SavedModel):
         if self.filepath:
             self.save()
 
+    def fit_batches(self, get_batches, lexicon_size=None, embedded_input=False, n_epochs=1):
+        '''same as fit(), but trains on (cause_words, effect_words, labels) batches from the generator returned by
+        get_batches(), which is called again at the start of each epoch'''
+
+        if not hasattr(self, 'model'):
+            self.embedded_input = embedded_input
+            if not self.embedded_input:
+                assert(lexicon_size is not None)
+                self.lexicon_size = lexicon_size
+            self.model = self.create_model()
+            print("Created model", self.__class__.__name__, ":", self.__dict__)
+
+        for epoch in range(n_epochs):
+            losses = []
+            print("EPOCH:", epoch + 1)
+            for batch_idx, (cause_words, effect_words, labels) in enumerate(get_batches()):
+                if not self.embedded_input:
+                    cause_words, effect_words = cause_words[:, None], effect_words[:, None]
+                losses.append(self.model.train_on_batch(x=[cause_words, effect_words], y=labels))
+                if batch_idx and batch_idx % 1000 == 0:
+                    print("loss: {:.3f}, accuracy: {:.3f}".format(numpy.mean(numpy.array(losses)[:, 0]),
+                                                                  numpy.mean(numpy.array(losses)[:, 1])))
+            print("loss: {:.3f}, accuracy: {:.3f}".format(numpy.mean(numpy.array(losses)[:, 0]),
+                                                          numpy.mean(numpy.array(losses)[:, 1])))
+
+        if self.filepath:
+            self.save()
+
     def predict(self, cause_words, effect_words):
 
         probs = self.model.predict(x=[cause_words, effect_words])
@@ -49,44 +49,55 @@ class RNNLMPipeline(Pipeline):
     def fit(self, seqs, n_epochs=1, verbose=True):
         if not self.transformer.lexicon:
             self.transformer.make_lexicon(seqs)
-        if self.transformer.generalize_ents:
-            seqs = [self.transformer.replace_ents_in_seq(seq) for seq in seqs]
-        num_seqs = self.transformer.text_to_nums(seqs)
+        if self.transformer.generalize_ents:  # one parse per seq gives the seqs with entities replaced and their tokens
+            seqs, tok_seqs = zip(*[self.transformer.parse_ents_in_seq(seq)[2:] for seq in seqs])
+            seqs = list(seqs)
+            num_seqs = self.transformer.text_to_nums(list(tok_seqs))
+        else:
+            num_seqs = self.transformer.text_to_nums(seqs)
         pos_seqs = None
         feature_vecs = None
         if self.classifier.use_pos:
             pos_seqs = [get_pos_num_seq(seq) for seq in seqs]
         if self.classifier.use_features:  # include additional context features in RNNLM
             feature_vecs = self.transformer.num_seqs_to_bow(
-                [self.transformer.tok_seq_to_nums(seq) for seq in self.transformer.seqs_to_feature_words(seqs)])
+                [self.transformer.tok_seq_to_nums(seq) for seq in self.transformer.seqs_to_feature_words(seqs)],
+                sparse_output=True)
+        word_counts = self.transformer.get_lexicon_counts() if getattr(self.classifier, 'n_sampled', 0) else None
         for epoch in range(n_epochs):
             if verbose:
                 print('EPOCH', epoch + 1)
             self.classifier.fit(seqs=num_seqs, pos_seqs=pos_seqs,
-                                feature_vecs=feature_vecs, lexicon_size=self.transformer.lexicon_size)
+                                feature_vecs=feature_vecs, lexicon_size=self.transformer.lexicon_size,
+                                word_counts=word_counts)
 
     def predict(self, seqs, max_length=35, mode='random', batch_size=1, n_best=1, temp=1.0, prevent_unk=True,
                 n_context_sents=-1, n_sents_per_seq=None, eos_tokens=[], detokenize=False, capitalize_ents=False,
                 adapt_ents=False):
         # if seq is empty, generate from end-of-sentence marker "."
         seqs = [seq if seq.strip() else u"." for seq in seqs]
-        if capitalize_ents or adapt_ents:  # get named entities in seqs
+        ents = None
+        tok_seqs = None
+        if self.transformer.generalize_ents:  # get numbered entities and replace them in seqs with one parse per seq
+            ents, seqs, tok_seqs = zip(*[self.transformer.parse_ents_in_seq(seq)[1:] for seq in seqs])
+            ents, seqs, tok_seqs = list(ents), list(seqs), list(tok_seqs)
+        elif capitalize_ents or adapt_ents:  # get named entities in seqs
             ents = [number_ents(*get_ents(seq)) for seq in seqs]
-        else:
+        if not (capitalize_ents or adapt_ents):
             ents = None
-        if self.transformer.generalize_ents:
-            seqs = [self.transformer.replace_ents_in_seq(seq) for seq in seqs]
         print("generating sequences...")
         if self.classifier.use_features:  # include additional context features in RNNLM
             feature_vecs = self.transformer.num_seqs_to_bow(
-                [self.transformer.tok_seq_to_nums(seq) for seq in self.transformer.seqs_to_feature_words(seqs)])
+                [self.transformer.tok_seq_to_nums(seq) for seq in self.transformer.seqs_to_feature_words(seqs)],
+                sparse_output=True)
         else:
             feature_vecs = None
         if n_context_sents > -1:
             '''include only most recent n_context_sents in context sequence given to recurrent layer; if -1, all sentences in context will be included;
             regardless of this setting, the whole context sequence is still taken into account in the feature vectors, if using'''
             seqs = [" ".join(segment(seq)[-n_context_sents:]) for seq in seqs]
-        num_seqs = self.transformer.text_to_nums(seqs)
+            tok_seqs = None  # tokens of the whole seqs no longer apply
+        num_seqs = self.transformer.text_to_nums(tok_seqs if tok_seqs is not None else seqs)
         if self.classifier.use_pos:
             num_pos_seqs = [get_pos_num_seq(seq) for seq in seqs]
             gen_seqs = self.predict_with_pos(num_seqs=num_seqs, num_pos_seqs=num_pos_seqs, feature_vecs=feature_vecs,
@@ -167,7 +178,8 @@ class RNNLMPipeline(Pipeline):
             num_pos_seqs = [get_pos_num_seq(seq) for seq in seqs]
         if self.classifier.use_features:
             feature_vecs = self.transformer.num_seqs_to_bow([self.transformer.tok_seq_to_nums(seq)
-                                                             for seq in self.transformer.seqs_to_feature_words(seqs)])
+                                                             for seq in self.transformer.seqs_to_feature_words(seqs)],
+                                                            sparse_output=True)
 
         return self.classifier.get_probs(seqs=num_seqs, pos_seqs=num_pos_seqs, feature_vecs=feature_vecs,
                                          batch_size=batch_size)
@@ -178,21 +190,24 @@ class MLPLMPipeline(Pipeline):
     def fit(self, seqs, n_epochs=5):
         if not self.transformer.lexicon:
             self.transformer.make_lexicon(seqs)
-        if self.transformer.generalize_ents:
-            seqs = [self.transformer.replace_ents_in_seq(seq) for seq in seqs]
+        if self.transformer.generalize_ents:  # tokens with entities replaced, from one parse per seq
+            seqs = [self.transformer.parse_ents_in_seq(seq)[3] for seq in seqs]
         seqs = self.transformer.text_to_nums(seqs)
+        word_counts = self.transformer.get_lexicon_counts() if getattr(self.classifier, 'n_sampled', 0) else None
         self.classifier.fit(seqs=seqs,
-                            lexicon_size=self.transformer.lexicon_size, n_epochs=n_epochs)
+                            lexicon_size=self.transformer.lexicon_size, n_epochs=n_epochs, word_counts=word_counts)
 
     def predict(self, seqs, max_length=35, mode='random', batch_size=1, n_best=1, temp=1.0,
                 prevent_unk=True, n_sents_per_seq=None, eos_tokens=[], detokenize=False, capitalize_ents=False,
                 adapt_ents=False):
-        if capitalize_ents or adapt_ents:  # get named entities in seqs
-            ents = [dict(number_ents(get_ents(seq))) for seq in seqs]
-        else:
+        ents = None
+        if self.transformer.generalize_ents:  # get numbered entities and tokens with them replaced, one parse per seq
+            ents, _, seqs = zip(*[self.transformer.parse_ents_in_seq(seq)[1:] for seq in seqs])
+            ents, seqs = list(ents), list(seqs)
+        elif capitalize_ents or adapt_ents:  # get named entities in seqs
+            ents = [number_ents(*get_ents(seq)) for seq in seqs]
+        if not (capitalize_ents or adapt_ents):
             ents = None
-        if self.transformer.generalize_ents:
-            seqs = [self.transformer.replace_ents_in_seq(seq) for seq in seqs]
         seqs = self.transformer.text_to_nums(seqs)
         gen_seqs = self.classifier.predict(seqs=seqs, max_length=max_length, mode=mode, batch_size=batch_size,
                                            n_best=n_best,
@@ -210,60 +225,112 @@ class MLPLMPipeline(Pipeline):
 
 class CausalEmbeddingsPipeline(Pipeline):
 
-    def get_true_pairs(self, seqs, window_size=1):
-        '''window size indicates for a given sentence, how many sentences after that will be used to get causal words'''
-        pairs = []
+    def make_pair_batch(self, cause_words, effect_words):
+        '''add negative examples to a batch of true word pairs: the reversed pairs and random pairs of the words in the batch'''
+        words = numpy.concatenate([cause_words, effect_words])
+        random_idx_pairs = rng.permutation(len(words)).reshape(-1, 2)
+        cause_words, effect_words = (numpy.concatenate([cause_words, effect_words, words[random_idx_pairs[:, 0]]]),
+                                     numpy.concatenate([effect_words, cause_words, words[random_idx_pairs[:, 1]]]))
+        labels = numpy.concatenate([numpy.ones(len(words) // 2), numpy.zeros(len(words))])
+        return cause_words, effect_words, labels
+
+    def get_story_sents(self, seqs):
+        '''segment each story into sentences and transform these into word indices (or embeddings), so this is only
+        done once rather than every epoch'''
+        embedded_input = True if (
+                self.transformer.word_embeddings or self.transformer.use_spacy_embs) else False
+        story_sents = []
         for seq in seqs:
             seq = segment(seq)
-            if self.transformer.use_spacy_embs or self.transformer.word_embeddings:
-                seq = self.transformer.text_to_embs(seq)
+            if embedded_input:
+                story_sents.append(self.transformer.text_to_embs(seq))
             else:
-                seq = self.transformer.text_to_nums(seq)
+                story_sents.append(self.transformer.text_to_nums(seq))
+        return story_sents
+
+    def get_pair_batches(self, story_sents, batch_size=100, window_size=1):
+        '''generate (cause_words, effect_words, labels) training batches of about batch_size word pairs from the output of
+        get_story_sents(); a third are true pairs, i.e. all pairs of a word in a sentence and a word in the
+        window_size sentences after it, the rest are negatives made from the same batch (see make_pair_batch()), so
+        memory use depends on the batch size rather than the number of pairs in the corpus'''
+        n_true_pairs = max(1, batch_size // 3)
+        buffer1, buffer2, n_buffered = [], [], 0
+        for seq_idx in rng.permutation(len(story_sents)):  # visit stories in random order each epoch
+            seq = story_sents[seq_idx]
             for sent_idx in range(len(seq) - 1):
                 window = seq[sent_idx:sent_idx + window_size + 1]
-                seq1 = window[0]
-                seq2 = [word for sent in window[1:] for word in sent]
-                # get all pairs of words in this sequence window
-                seq_pairs = numpy.array(get_word_pairs(seq1, seq2))
-                pairs.extend(seq_pairs)
-        return pairs
+                seq1 = numpy.asarray(window[0])
+                seq2 = numpy.asarray([word for sent in window[1:] for word in sent])
+                if not len(seq1) or not len(seq2):
+                    continue
+                word1_idxs, word2_idxs, _, _ = get_word_pair_idxs([len(seq1)], [len(seq2)])
+                buffer1.append(seq1[word1_idxs])
+                buffer2.append(seq2[word2_idxs])
+                n_buffered += len(word1_idxs)
+                if n_buffered >= n_true_pairs:
+                    words1 = numpy.concatenate(buffer1)
+                    words2 = numpy.concatenate(buffer2)
+                    n_batched = n_buffered - n_buffered % n_true_pairs
+                    for batch_idx in range(0, n_batched, n_true_pairs):
+                        yield self.make_pair_batch(words1[batch_idx:batch_idx + n_true_pairs],
+                                                   words2[batch_idx:batch_idx + n_true_pairs])
+                    buffer1, buffer2, n_buffered = [words1[n_batched:]], [words2[n_batched:]], n_buffered - n_batched
+        if n_buffered:
+            yield self.make_pair_batch(numpy.concatenate(buffer1), numpy.concatenate(buffer2))
 
     def fit(self, seqs, n_epochs=1):
         embedded_input = True if (
                 self.transformer.word_embeddings or self.transformer.use_spacy_embs) else False
         if not embedded_input and not self.transformer.lexicon:
             self.transformer.make_lexicon(seqs)  # Use true pairs to build lexicon
-        true_pairs = self.get_true_pairs(seqs)
-        reversed_pairs = reverse_pairs(true_pairs)
-        random_pairs = randomize_pairs(true_pairs)
-        false_pairs = reversed_pairs + random_pairs
-        pairs = numpy.array(true_pairs + false_pairs)
-        labels = numpy.concatenate((numpy.ones(len(true_pairs)), numpy.zeros(len(false_pairs))))
-        self.classifier.fit(cause_words=pairs[:, 0], effect_words=pairs[:, 1],
-                            labels=labels, lexicon_size=self.transformer.lexicon_size,
-                            embedded_input=embedded_input, n_epochs=n_epochs)
+        story_sents = self.get_story_sents(seqs)
+        # word pairs are generated batch by batch each epoch instead of all being kept in memory
+        self.classifier.fit_batches(get_batches=lambda: self.get_pair_batches(story_sents,
+                                                                              batch_size=self.classifier.batch_size),
+                                    lexicon_size=self.transformer.lexicon_size,
+                                    embedded_input=embedded_input, n_epochs=n_epochs)
 
     def predict(self, seq1, seq2):
         '''return a total score for the causal relatedness between seq1 and seq2'''
+        return self.predict_batch([seq1], [seq2])[0]
+
+    def predict_batch(self, seqs1, seqs2):
+        '''return the causal relatedness score of each (seq1, seq2) pair; the word pairs of all sequence pairs are scored
+        in a single model call and then averaged per sequence pair (NaN if a pair has no words)'''
+        assert (len(seqs1) == len(seqs2))
         embedded_input = True if (
                 self.transformer.word_embeddings or self.transformer.use_spacy_embs) else False
         if embedded_input:
-            seq1, seq2 = self.transformer.text_to_embs([seq1, seq2])
+            seqs1 = self.transformer.text_to_embs(seqs1)
+            seqs2 = self.transformer.text_to_embs(seqs2)
         else:
-            seq1, seq2 = self.transformer.text_to_nums([seq1, seq2])
-        pairs = numpy.array(get_word_pairs(seq1, seq2))
-        prob = numpy.mean(self.classifier.predict(cause_words=pairs[:, 0],
-                                                  effect_words=pairs[:, 1]))
-        return prob
+            seqs1 = self.transformer.text_to_nums(seqs1)
+            seqs2 = self.transformer.text_to_nums(seqs2)
+        word1_idxs, word2_idxs, pair_starts, n_pairs = get_word_pair_idxs([len(seq) for seq in seqs1],
+                                                                          [len(seq) for seq in seqs2])
+        probs = numpy.full((len(seqs1),), numpy.nan)
+        has_pairs = n_pairs > 0
+        if not numpy.any(has_pairs):
+            return probs
+        words1 = numpy.concatenate([numpy.asarray(seq) for seq in seqs1])
+        words2 = numpy.concatenate([numpy.asarray(seq) for seq in seqs2])
+        if not embedded_input:  # empty sequences would otherwise upcast word indices to float
+            words1 = words1.astype('int64')
+            words2 = words2.astype('int64')
+        pair_probs = self.classifier.predict(cause_words=words1[word1_idxs],
+                                             effect_words=words2[word2_idxs]).ravel()
+        probs[has_pairs] = numpy.add.reduceat(pair_probs, pair_starts[has_pairs]) / n_pairs[has_pairs]
+        return probs
 
 
 class MLPBinaryPipeline(Pipeline):
 
     def get_true_pairs(self, seqs, segment_clauses=False, max_clause_length=15):
         if segment_clauses:
-            seqs = [segment_into_clauses(seq) for seq in seqs]
+            seqs = [segment_into_clauses(seq, as_spans=True) for seq in seqs]
         else:
-            seqs = [segment(seq) for seq in seqs]  # segment by sentence instead of clause
+            seqs = [segment(seq, as_spans=True) for seq in seqs]  # segment by sentence instead of clause
+        # pairs are kept as spans of each seq's parse, so text_to_nums() tokenizes them without parsing them again
         # add 10 to max length to account for grammatical words
         pairs = get_adj_clause_pairs(seqs, max_length=max_clause_length)
         pairs = [self.transformer.text_to_nums(pair) for pair in pairs]
@@ -298,15 +365,22 @@ class MLPBinaryPipeline(Pipeline):
 class RNNBinaryPipeline(Pipeline):
 
     def get_bkwrd_sample_idxs(self, n_seqs, n_bkwrd_sents, n_samples=1):
-        '''get indices of randomly selected sentences in the input seqs (seqs1)'''
-        bkwrd_idxs = numpy.array([rng.choice(n_bkwrd_sents, size=n_samples, replace=False)
-                                  for seq in range(n_seqs)])
+        '''get indices of randomly selected sentences in the input seqs (seqs1), without replacement within each seq;
+        ordering random keys samples for all seqs at once'''
+        bkwrd_idxs = numpy.argsort(rng.random_sample((n_seqs, n_bkwrd_sents)), axis=1)[:, :n_samples]
         return bkwrd_idxs
 
     def get_random_sample_idxs(self, n_seqs, n_idxs, n_samples=1):
-        '''get indices of randomly selected sentences in the output sentences (seqs2)'''
-        random_idxs = numpy.array([rng.choice(n_idxs, size=n_samples, replace=False)
-                                   for seq in range(n_seqs)])
+        '''get indices of randomly selected sentences in the output sentences (seqs2), without replacement within each seq;
+        indices are drawn for all seqs at once and rows with repeated indices are redrawn'''
+        assert (n_samples <= n_idxs)
+        random_idxs = rng.randint(n_idxs, size=(n_seqs, n_samples))
+        while n_samples > 1:
+            sorted_idxs = numpy.sort(random_idxs, axis=1)
+            has_repeats = numpy.any(sorted_idxs[:, 1:] == sorted_idxs[:, :-1], axis=1)
+            if not numpy.any(has_repeats):
+                break
+            random_idxs[has_repeats] = rng.randint(n_idxs, size=(numpy.sum(has_repeats), n_samples))
         return random_idxs
 
     def fit(self, seqs1, seqs2, n_bkwrd=0, n_random=1, n_epochs=1, eval_fn=None, chunk_size=2000):
@@ -342,42 +416,42 @@ class RNNBinaryPipeline(Pipeline):
                 print("EPOCH:", epoch + 1)
             for chunk_idx in range(0, len(seqs1), chunk_size):
 
-                seqs1_chunk = seqs1[chunk_idx:chunk_idx + chunk_size]
-                seqs2_chunk = seqs2[chunk_idx:chunk_idx + chunk_size]
-                labels_chunk = numpy.ones((len(seqs1_chunk),))
+                pos_seqs1 = numpy.asarray(seqs1[chunk_idx:chunk_idx + chunk_size])
+                pos_seqs2 = numpy.asarray(seqs2[chunk_idx:chunk_idx + chunk_size])
+                n_pos = len(pos_seqs1)
+                n_instances = n_pos * (1 + n_bkwrd + n_random)
+
+                # write positive and negative instances straight into their shuffled positions in preallocated arrays
+                shuffle_idxs = rng.permutation(n_instances)
+                seqs1_chunk = numpy.empty((n_instances,) + pos_seqs1.shape[1:], dtype=pos_seqs1.dtype)
+                seqs2_chunk = numpy.empty((n_instances,) + pos_seqs2.shape[1:],
+                                          dtype=numpy.result_type(pos_seqs1, pos_seqs2))
+                labels_chunk = numpy.zeros((n_instances,))
+                seqs1_chunk[shuffle_idxs[:n_pos]] = pos_seqs1
+                seqs2_chunk[shuffle_idxs[:n_pos]] = pos_seqs2
+                labels_chunk[shuffle_idxs[:n_pos]] = 1
+                start_idx = n_pos
 
                 if n_bkwrd:
-                    bkwrd_sample_idxs = self.get_bkwrd_sample_idxs(n_seqs=chunk_size,
+                    bkwrd_sample_idxs = self.get_bkwrd_sample_idxs(n_seqs=n_pos,
                                                                    n_bkwrd_sents=self.classifier.n_input_sents,
                                                                    n_samples=n_bkwrd)
-                    bkwrd_seqs1_chunk, bkwrd_seqs2_chunk = zip(*[[seq1, seq1[idx][None]] for seq1, idxs
-                                                                 in zip(seqs1[chunk_idx:chunk_idx + chunk_size],
-                                                                        bkwrd_sample_idxs)
-                                                                 for idx in idxs])
-                    seqs1_chunk = numpy.concatenate([seqs1_chunk, numpy.array(bkwrd_seqs1_chunk)])
-                    seqs2_chunk = numpy.concatenate([seqs2_chunk, numpy.array(bkwrd_seqs2_chunk)])
-                    labels_chunk = numpy.concatenate([labels_chunk,
-                                                      numpy.zeros((len(bkwrd_seqs1_chunk),))])
+                    seq_idxs = numpy.repeat(numpy.arange(n_pos), n_bkwrd)
+                    instance_idxs = shuffle_idxs[start_idx:start_idx + n_pos * n_bkwrd]
+                    seqs1_chunk[instance_idxs] = pos_seqs1[seq_idxs]
+                    seqs2_chunk[instance_idxs] = pos_seqs1[seq_idxs, bkwrd_sample_idxs.ravel()][:, None]
+                    start_idx += n_pos * n_bkwrd
                 if n_random:
-                    random_sample_idxs = self.get_random_sample_idxs(n_seqs=chunk_size,
+                    random_sample_idxs = self.get_random_sample_idxs(n_seqs=n_pos,
                                                                      n_idxs=len(seqs1),
                                                                      n_samples=n_random)
-                    random_seqs1_chunk, random_seqs2_chunk = zip(*[[seq1, seqs2[idx]] for seq1, idxs
-                                                                   in zip(seqs1[chunk_idx:chunk_idx + chunk_size],
-                                                                          random_sample_idxs)
-                                                                   for idx in idxs])
-                    seqs1_chunk = numpy.concatenate([seqs1_chunk, numpy.array(random_seqs1_chunk)])
-                    seqs2_chunk = numpy.concatenate([seqs2_chunk, numpy.array(random_seqs2_chunk)])
-                    labels_chunk = numpy.concatenate([labels_chunk,
-                                                      numpy.zeros((len(random_seqs1_chunk),))])
-
-                assert (len(seqs1_chunk) == len(seqs2_chunk) == len(labels_chunk))
-
-                # shuffle instances
-                shuffle_idxs = rng.permutation(len(seqs1_chunk))
-                seqs1_chunk = numpy.array([seqs1_chunk[idx] for idx in shuffle_idxs])
-                seqs2_chunk = numpy.array([seqs2_chunk[idx] for idx in shuffle_idxs])
-                labels_chunk = numpy.array(labels_chunk[shuffle_idxs])
+                    seq_idxs = numpy.repeat(numpy.arange(n_pos), n_random)
+                    instance_idxs = shuffle_idxs[start_idx:start_idx + n_pos * n_random]
+                    seqs1_chunk[instance_idxs] = pos_seqs1[seq_idxs]
+                    seqs2_chunk[instance_idxs] = seqs2[random_sample_idxs.ravel()]
+                    start_idx += n_pos * n_random
+
+                assert (start_idx == n_instances)
 
                 self.classifier.fit(seqs1=seqs1_chunk, seqs2=seqs2_chunk,
                                     labels=labels_chunk, n_epochs=1, save_to_filepath=False)
@@ -430,6 +504,7 @@ class EncoderDecoderPipeline(Pipeline):
         seqs2 = self.transformer.text_to_nums(seqs2)
 
         assert (len(seqs1) == len(seqs2))
+        word_counts = self.transformer.get_lexicon_counts() if getattr(self.classifier, 'n_sampled', 0) else None
 
         for epoch in range(n_epochs):
             if n_epochs > 1:
@@ -440,7 +515,7 @@ class EncoderDecoderPipeline(Pipeline):
             for chunk_idx in range(0, len(seqs1), chunk_size):
                 self.classifier.fit(seqs1[chunk_idx:chunk_idx + chunk_size], seqs2[chunk_idx:chunk_idx + chunk_size],
                                     n_timesteps=max_length, lexicon_size=self.transformer.lexicon_size,
-                                    n_epochs=1, save_to_filepath=False)
+                                    n_epochs=1, save_to_filepath=False, word_counts=word_counts)
 
                 if eval_fn:
                     if not hasattr(self, 'best_accuracy'):
@@ -453,18 +528,19 @@ class EncoderDecoderPipeline(Pipeline):
                 elif self.classifier.filepath:
                     self.classifier.save()
 
-    def predict(self, seqs1, seqs2):
-        '''return a total score for the prob that seq2 follows seq1'''
+    def predict(self, seqs1, seqs2, candidates_only=False, batch_size=100):
+        '''return a total score for the prob that seq2 follows seq1; candidates_only=True computes the output layer only
+        for the words in seq2 (see EncoderDecoder.predict()); pairs are scored batch_size at a time'''
 
         seqs1 = self.transformer.text_to_nums(seqs1)
         seqs2 = self.transformer.text_to_nums(seqs2)
 
-        probs = []
-        for seq1, seq2 in zip(seqs1, seqs2):
-            prob = self.classifier.predict(seq1=seq1, seq2=seq2)
-            probs.append(prob)
+        probs = numpy.zeros((len(seqs1),))
+        for batch_idx in range(0, len(seqs1), batch_size):
+            probs[batch_idx:batch_idx + batch_size] = self.classifier.predict_batch(
+                seqs1[batch_idx:batch_idx + batch_size], seqs2[batch_idx:batch_idx + batch_size],
+                candidates_only=candidates_only)
 
-        probs = numpy.array(probs)
         return probs
 
     def get_most_probable_words(self, seqs1, top_n_words=10, unigram_probs=None):
@@ -522,15 +598,7 @@ class EmbeddingSimilarityPipeline(Pipeline):
         if use_max_word:  # avemax
             seqs1 = self.transformer.text_to_embs(seqs1)
             seqs2 = self.transformer.text_to_embs(seqs2)
-            for seq1, seq2 in zip(seqs1, seqs2):
-                word1_scores = []
-                for word1 in seq1:
-                    word2_scores = []
-                    for word2 in seq2:
-                        word2_score = self.classifier.predict(word1, word2)
-                        word2_scores.append(word2_score)
-                    word1_scores.append(numpy.max(word2_scores))
-                scores.append(numpy.mean(word1_scores))
+            scores = self.classifier.predict_max_words(seqs1, seqs2)
         else:
             if self.transformer.__class__.__name__ == 'SkipthoughtsTransformer':
                 seqs1 = self.transformer.text_to_embs(seqs1)[:, 0, :]
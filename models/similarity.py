@@ -1,62 +1,406 @@
-import os, numpy, pickle
+import os, numpy, pickle, copy, glob, shutil, threading
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
 from gensim import corpora, models, similarities
-from gensim.matutils import Dense2Corpus, dense2vec, cossim
+from gensim.matutils import Dense2Corpus, dense2vec, cossim, corpus2dense
 
 from models.transformer import *
 
 
+def normalize_vecs(vecs):
+    norms = numpy.sqrt(numpy.sum(vecs ** 2, axis=-1, keepdims=True))
+    return vecs / numpy.maximum(norms, 1e-8)
+
+
+def normalize_sparse_vecs(vecs):
+    norms = numpy.sqrt(numpy.asarray(vecs.multiply(vecs).sum(axis=1))[:, 0])
+    return sparse.diags(1. / numpy.maximum(norms, 1e-8)).dot(vecs).tocsr()
+
+
+def get_top_n(scores, n_best, first_id=0):
+    '''return (n_rows, n_best) arrays with the ids (column index + first_id) and values of the highest scores in
+    each row, sorted by score; rows with fewer than n_best columns are padded with -1 ids and -inf scores'''
+    n_top = min(n_best, scores.shape[1])
+    top_ids = numpy.full((len(scores), n_best), -1, dtype='int64')
+    top_scores = numpy.full((len(scores), n_best), -numpy.inf, dtype='float32')
+    if n_top:
+        top = numpy.argpartition(-scores, n_top - 1, axis=1)[:, :n_top]
+        top_scores[:, :n_top] = numpy.take_along_axis(scores, top, axis=1)
+        top_ids[:, :n_top] = top + first_id
+        order = numpy.argsort(-top_scores, axis=1)
+        top_ids = numpy.take_along_axis(top_ids, order, axis=1)
+        top_scores = numpy.take_along_axis(top_scores, order, axis=1)
+    return top_ids, top_scores
+
+
+def merge_top_n(results, n_best):
+    '''merge (ids, scores) results from get_top_n() for several shards into the overall top n_best per row;
+    returns float arrays where missing ids and scores are NaN. As with gensim's num_best, hits with a zero score
+    (no terms or topics in common with the query) are dropped, so a row can have fewer than n_best hits'''
+    ids = numpy.concatenate([result_ids for result_ids, result_scores in results], axis=1)
+    scores = numpy.concatenate([result_scores for result_ids, result_scores in results], axis=1)
+    top_ids, top_scores = get_top_n(scores, n_best)
+    top_ids = numpy.take_along_axis(ids, top_ids, axis=1)
+    found = (top_ids >= 0) & (numpy.abs(top_scores) > 1e-8)
+    # move the remaining hits to the front of each row, keeping them sorted by score
+    order = numpy.argsort(~found, axis=1, kind='mergesort')
+    top_ids = numpy.take_along_axis(top_ids, order, axis=1)
+    top_scores = numpy.take_along_axis(top_scores, order, axis=1)
+    found = numpy.take_along_axis(found, order, axis=1)
+    return numpy.where(found, top_ids, numpy.nan), numpy.where(found, top_scores, numpy.nan)
+
+
+class IVFIndex():
+    '''approximate nearest-neighbour index (inverted file) for dense vectors such as LSI topics;
+    vectors are clustered with spherical k-means and stored contiguously by cluster, so a query only scans the
+    n_probe clusters whose centroids are nearest to it. Raising n_probe trades latency for recall (n_probe = n_clusters
+    is an exact search). Vectors added after the index is built are assigned to the existing centroids and written to
+    a new shard. All arrays are saved as .npy files and loaded memory-mapped'''
+
+    def __init__(self, filepath, n_clusters=1024, n_probe=8, n_train_iters=10, chunk_size=100000):
+        self.filepath = filepath
+        self.n_clusters = n_clusters
+        self.n_probe = n_probe
+        self.n_train_iters = n_train_iters
+        self.chunk_size = chunk_size
+        self.shards = []
+
+        if not os.path.isdir(self.filepath):
+            os.mkdir(self.filepath)
+
+        self.centroids_filepath = self.filepath + "/centroids.npy"
+
+    def get_shard_filepaths(self, shard_idx):
+        suffix = "." + str(shard_idx) if shard_idx else ""
+        return {'vecs': self.filepath + "/vectors" + suffix + ".npy",
+                'ids': self.filepath + "/ids" + suffix + ".npy",
+                'offsets': self.filepath + "/offsets" + suffix + ".npy"}
+
+    def exists(self):
+        return os.path.exists(self.get_shard_filepaths(0)['offsets'])
+
+    def __len__(self):
+        return sum([shard['offsets'][-1] for shard in self.shards])
+
+    def load_shard(self, shard_idx):
+        shard_filepaths = self.get_shard_filepaths(shard_idx)
+        return {'vecs': numpy.load(shard_filepaths['vecs'], mmap_mode='r'),
+                'ids': numpy.load(shard_filepaths['ids'], mmap_mode='r'),
+                'offsets': numpy.load(shard_filepaths['offsets'])}
+
+    def load(self):
+        print "loading ann index from", self.filepath
+        self.centroids = numpy.load(self.centroids_filepath)
+        self.n_clusters = len(self.centroids)
+        self.shards = []
+        while os.path.exists(self.get_shard_filepaths(len(self.shards))['offsets']):
+            self.shards.append(self.load_shard(len(self.shards)))
+
+    def train_centroids(self, vecs):
+        '''spherical k-means on a random sample of the vectors'''
+        n_train = min(len(vecs), self.n_clusters * 50)
+        train_vecs = normalize_vecs(numpy.array(vecs[numpy.sort(rng.choice(len(vecs), size=n_train, replace=False))]))
+        centroids = train_vecs[rng.choice(n_train, size=self.n_clusters, replace=False)]
+        for iter_idx in range(self.n_train_iters):
+            assignments = numpy.argmax(numpy.dot(train_vecs, centroids.T), axis=1)
+            members = sparse.csr_matrix((numpy.ones(n_train, dtype='float32'), (assignments, numpy.arange(n_train))),
+                                        shape=(self.n_clusters, n_train))
+            sums = members.dot(train_vecs)
+            nonempty = numpy.bincount(assignments, minlength=self.n_clusters) > 0  # empty clusters keep old centroid
+            centroids[nonempty] = normalize_vecs(sums[nonempty])
+        return centroids
+
+    def assign(self, vecs):
+        assignments = numpy.zeros((len(vecs),), dtype='int64')
+        for idx in range(0, len(vecs), self.chunk_size):
+            assignments[idx:idx + self.chunk_size] = numpy.argmax(
+                numpy.dot(normalize_vecs(vecs[idx:idx + self.chunk_size]), self.centroids.T), axis=1)
+        return assignments
+
+    def make_shard(self, vecs, first_id=0):
+        '''write vecs to a new shard, grouped by their nearest centroid; vecs get the ids first_id, first_id + 1, ...'''
+        shard_idx = len(self.shards)
+        shard_filepaths = self.get_shard_filepaths(shard_idx)
+        assignments = self.assign(vecs)
+        order = numpy.argsort(assignments, kind='mergesort')  # group vectors by cluster
+        offsets = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(assignments, minlength=self.n_clusters))])
+
+        sorted_vecs = numpy.lib.format.open_memmap(shard_filepaths['vecs'], mode='w+', dtype='float32',
+                                                   shape=vecs.shape)
+        for idx in range(0, len(order), self.chunk_size):
+            chunk_idxs = order[idx:idx + self.chunk_size]
+            # read rows in file order, then put them back in cluster order
+            chunk_ranks = numpy.argsort(numpy.argsort(chunk_idxs))
+            sorted_vecs[idx:idx + self.chunk_size] = normalize_vecs(vecs[numpy.sort(chunk_idxs)])[chunk_ranks]
+        sorted_vecs.flush()
+        del sorted_vecs
+
+        numpy.save(shard_filepaths['ids'], order + first_id)
+        # offsets are written last, since their presence marks the shard as complete
+        numpy.save(shard_filepaths['offsets'], offsets)
+        self.shards.append(self.load_shard(shard_idx))
+
+    def make(self, vecs):
+        '''vecs is an (n_vecs, n_dim) array (can be memory-mapped); vectors are stored normalized so scores are cosines'''
+        print "building ann index for", len(vecs), "vectors"
+        self.n_clusters = min(self.n_clusters, len(vecs))
+        self.centroids = self.train_centroids(vecs)
+        numpy.save(self.centroids_filepath, self.centroids)
+        self.shards = []
+        self.make_shard(vecs)
+        print "saved ann index to", self.filepath
+
+    def add(self, vecs):
+        '''append vecs to the index as a new shard, using the existing centroids'''
+        self.make_shard(vecs, first_id=len(self))
+        print "added", len(vecs), "vectors to ann index in shard", len(self.shards) - 1
+
+    def query_shard(self, shard, vecs, probes, n_best):
+        best_scores = numpy.full((len(vecs), n_best), -numpy.inf, dtype='float32')
+        best_idxs = numpy.full((len(vecs), n_best), -1, dtype='int64')
+        for cluster in numpy.unique(probes):
+            start, end = shard['offsets'][cluster], shard['offsets'][cluster + 1]
+            if start == end:
+                continue
+            query_idxs = numpy.where(numpy.any(probes == cluster, axis=1))[0]
+            scores = numpy.dot(vecs[query_idxs], shard['vecs'][start:end].T)
+            idxs = numpy.broadcast_to(numpy.arange(start, end), scores.shape)
+            # merge scores for this cluster with the best scores found so far
+            scores = numpy.concatenate([best_scores[query_idxs], scores], axis=1)
+            idxs = numpy.concatenate([best_idxs[query_idxs], idxs], axis=1)
+            top = numpy.argpartition(-scores, n_best - 1, axis=1)[:, :n_best]
+            best_scores[query_idxs] = numpy.take_along_axis(scores, top, axis=1)
+            best_idxs[query_idxs] = numpy.take_along_axis(idxs, top, axis=1)
+        found = best_idxs >= 0
+        best_ids = numpy.full(best_idxs.shape, -1, dtype='int64')
+        best_ids[found] = shard['ids'][best_idxs[found]]  # map positions in cluster order back to document ids
+        return best_ids, best_scores
+
+    def query(self, vecs, n_best=5, n_probe=None, pool=None):
+        '''return (n_vecs, n_best) arrays of indices and cosine scores of the nearest indexed vectors, padded with NaN;
+        queries are processed as a batch, so each probed cluster is read once for all the queries that probe it;
+        if a (thread) pool is given, the shards are searched in parallel'''
+        if not n_probe:
+            n_probe = self.n_probe
+        n_probe = min(n_probe, self.n_clusters)
+        vecs = normalize_vecs(numpy.asarray(vecs, dtype='float32'))
+        centroid_scores = numpy.dot(vecs, self.centroids.T)
+        probes = numpy.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+
+        if pool is not None and len(self.shards) > 1:
+            shard_results = pool.map(lambda shard: self.query_shard(shard, vecs, probes, n_best), self.shards)
+        else:
+            shard_results = [self.query_shard(shard, vecs, probes, n_best) for shard in self.shards]
+        return merge_top_n(shard_results, n_best)
+
+
+class ShardedCorpus():
+    '''bag-of-words corpus stored as a list of MmCorpus files, iterated in order'''
+
+    def __init__(self, filepaths):
+        self.shards = [corpora.MmCorpus(filepath) for filepath in filepaths]
+
+    def __iter__(self):
+        for shard in self.shards:
+            for seq in shard:
+                yield seq
+
+    def __len__(self):
+        return sum([len(shard) for shard in self.shards])
+
+
+class TokSeqSpill():
+    '''tokenized sequences written one at a time to a temporary file and read back from it on each iteration, so they
+    can be read several times (e.g. for the lexicon and then the corpus) without being kept in memory'''
+
+    def __init__(self, filepath, tok_seqs):
+        self.filepath = filepath
+        self.n_seqs = 0
+        self.n_tokens = 0
+        with open(self.filepath, 'wb') as f:
+            for seq in tok_seqs:
+                pickle.dump(list(seq), f, protocol=pickle.HIGHEST_PROTOCOL)
+                self.n_seqs += 1
+                self.n_tokens += len(seq)
+
+    def __iter__(self):
+        with open(self.filepath, 'rb') as f:
+            for _ in range(self.n_seqs):
+                yield pickle.load(f)
+
+    def __len__(self):
+        return self.n_seqs
+
+    def remove(self):
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+
 class SimilarityIndex():
-    def __init__(self, seqs, filepath, min_freq=1, use_tfidf=True, use_lsi=False, n_lsi_dim=500):
+    def __init__(self, seqs, filepath, min_freq=1, use_tfidf=True, use_lsi=False, n_lsi_dim=500, tokenized=False,
+                 use_ann=False, n_clusters=1024, n_probe=8, n_threads=None):
+        '''if tokenized=True, seqs are already lists of tokens (e.g. from SequenceTransformer.text_to_tok_seqs)
+        and won't be parsed again; otherwise each seq is tokenized exactly once (see get_tok_seqs()) and the resulting
+        bag-of-words corpus is serialized so the tfidf, lsi and index models can all be built from it; seqs can be any
+        iterable, including a generator that can only be read once;
+        if use_ann=True (requires use_lsi=True), the LSI vectors are searched with an IVFIndex instead of a brute-force scan;
+        n_threads is the number of threads used to search index shards in parallel (default is one per cpu)'''
+        assert (use_lsi or not use_ann)
         self.min_freq = min_freq
         self.use_tfidf = use_tfidf
         self.use_lsi = use_lsi
         self.n_lsi_dim = n_lsi_dim
         self.filepath = filepath
+        self.tokenized = tokenized
+        self.use_ann = use_ann
+        self.n_clusters = n_clusters
+        self.n_probe = n_probe
+        self.n_threads = n_threads
+        self.pool = None
+        self.lock = threading.RLock()
+        self.n_readers = {}  # number of running queries using each generation
+        self.retired_generations = set()  # generations superseded by compact(), removed once no query uses them
 
         if not os.path.isdir(self.filepath):
             os.mkdir(self.filepath)
 
         self.lexicon_filepath = self.filepath + "/lexicon"
+        self.manifest_filepath = self.filepath + "/manifest.pkl"
+
+        if os.path.exists(self.manifest_filepath):
+            self.load_manifest()
+        else:
+            self.manifest = {'generation': 0, 'n_added_shards': 0, 'shards': []}
+        self.set_filepaths(self.manifest['generation'])
 
         if os.path.exists(self.lexicon_filepath):
             self.load_lexicon()
         else:
-            self.make_lexicon(seqs)
+            self.make_lexicon(self.get_tok_seqs(seqs))
 
         self.min_freq = min(self.lexicon.dfs.values())
 
         if self.use_tfidf:
-            self.tfidf_filepath = self.filepath + "/tfidf"
             if os.path.exists(self.tfidf_filepath):
                 self.load_tfidf_model()
             else:
-                self.make_tfidf_model(seqs)
+                self.make_tfidf_model(self.get_corpus(seqs))
 
         if self.use_lsi:
-            self.index_dir_filepath = self.filepath + "/lsi-index"
-            self.lsi_filepath = self.filepath + "/lsi"
             if os.path.exists(self.lsi_filepath):
                 self.load_lsi_model()
             else:
-                self.make_lsi_model(seqs)
+                self.make_lsi_model(self.get_corpus(seqs))
             self.n_lsi_dim = self.lsi_model.num_topics
+
+        if self.use_ann:
+            self.index = IVFIndex(self.index_dir_filepath, n_clusters=self.n_clusters, n_probe=self.n_probe)
+            if self.index.exists():
+                self.index.load()
+            else:
+                self.make_ann_index(self.get_corpus(seqs))
         else:
-            self.index_dir_filepath = self.filepath + "/index"
+            if os.path.exists(self.index_filepath):
+                self.load_index()
+            else:
+                if not os.path.isdir(self.index_dir_filepath):
+                    os.mkdir(self.index_dir_filepath)
+                self.make_index(self.get_corpus(seqs))
 
-        self.index_filepath = self.index_dir_filepath + "/index"
-        if os.path.exists(self.index_filepath):
-            self.load_index()
+        if not self.manifest['shards'] and os.path.exists(self.corpus_filepath):
+            # index was built before shards were tracked, so it consists of the original corpus only
+            self.manifest['shards'].append({'corpus_filepath': self.corpus_filepath,
+                                            'n_seqs': len(self.get_corpus(seqs)), 'n_tokens': None, 'n_oov': 0})
+            self.save_manifest()
+
+        if getattr(self, 'tok_seqs', None) is not None:  # only needed while building
+            if isinstance(self.tok_seqs, TokSeqSpill):
+                self.tok_seqs.remove()
+            del self.tok_seqs
+
+    def set_filepaths(self, generation):
+        '''the lexicon is shared by all generations; the corpus and the tfidf, lsi and index models of
+        generation 0 are stored directly in filepath, those of later generations (see compact()) in subdirectories'''
+        self.generation_filepath = self.filepath
+        if generation:
+            self.generation_filepath = self.filepath + "/generation-" + str(generation)
+            if not os.path.isdir(self.generation_filepath):
+                os.mkdir(self.generation_filepath)
+        self.corpus_filepath = self.generation_filepath + "/corpus.mm"
+        self.tfidf_filepath = self.generation_filepath + "/tfidf"
+        self.lsi_filepath = self.generation_filepath + "/lsi"
+        if self.use_ann:
+            self.index_dir_filepath = self.generation_filepath + "/lsi-ann-index"
+        elif self.use_lsi:
+            self.index_dir_filepath = self.generation_filepath + "/lsi-index"
         else:
-            if not os.path.isdir(self.index_dir_filepath):
-                os.mkdir(self.index_dir_filepath)
-            self.make_index(seqs)
+            self.index_dir_filepath = self.generation_filepath + "/index"
+        self.index_filepath = self.index_dir_filepath + "/index"
+
+    def load_manifest(self):
+        with open(self.manifest_filepath, 'rb') as f:
+            self.manifest = pickle.load(f)
+
+    def save_manifest(self):
+        with open(self.manifest_filepath, 'wb') as f:
+            pickle.dump(self.manifest, f)
+
+    def get_manifest(self):
+        '''return the current generation and the list of corpus shards in the index, each with its number of
+        sequences and the number of its tokens that were out of the lexicon when it was added'''
+        with self.lock:
+            return copy.deepcopy(self.manifest)
+
+    def get_n_oov(self):
+        return sum([shard['n_oov'] for shard in self.manifest['shards']])
+
+    def get_tok_seqs(self, seqs):
+        '''tokenize seqs in a single pass and spill the tokens to a temporary file, which the lexicon and corpus are then
+        read from, so the tokenized seqs are never all kept in memory; already tokenized seqs given as a list are used
+        as they are, while other iterables (which may only be readable once) are spilled as well'''
+        if getattr(self, 'tok_seqs', None) is None:
+            if self.tokenized and isinstance(seqs, (list, tuple)):
+                self.tok_seqs = seqs
+            else:
+                if not self.tokenized:
+                    seqs = (tokenize(seq) for seq in seqs)
+                self.tok_seqs = TokSeqSpill(self.filepath + "/tok_seqs.tmp", seqs)
+        return self.tok_seqs
+
+    def load_corpus(self):
+        print "loading corpus from", self.corpus_filepath
+        self.corpus = corpora.MmCorpus(self.corpus_filepath)
+
+    def make_corpus(self, seqs):
+        n_tokens = [0]  # counted while the corpus is serialized, so the seqs are only read once
+
+        def get_bows():
+            for seq in self.get_tok_seqs(seqs):
+                n_tokens[0] += len(seq)
+                yield self.lexicon.doc2bow(seq)
+
+        corpora.MmCorpus.serialize(self.corpus_filepath, get_bows())
+        print "saved corpus to", self.corpus_filepath
+        self.load_corpus()
+        self.manifest['shards'] = [{'corpus_filepath': self.corpus_filepath, 'n_seqs': len(self.corpus),
+                                    'n_tokens': n_tokens[0], 'n_oov': 0}]  # lexicon is built from this corpus
+        self.save_manifest()
+
+    def get_corpus(self, seqs):
+        '''bag-of-words corpus shared by the tfidf, lsi and index models'''
+        if not hasattr(self, 'corpus'):
+            if os.path.exists(self.corpus_filepath):
+                self.load_corpus()
+            else:
+                self.make_corpus(seqs)
+        return self.corpus
 
     def load_lexicon(self):
         print "loading lexicon from", self.lexicon_filepath
         self.lexicon = corpora.Dictionary.load(self.lexicon_filepath)
 
     def make_lexicon(self, seqs):
-        self.lexicon = corpora.Dictionary(tokenize(seq) for seq in seqs)
+        self.lexicon = corpora.Dictionary(seqs)
         self.lexicon.filter_extremes(no_below=self.min_freq)
         print "generated lexicon of", len(self.lexicon.keys()), "words with frequency >=", self.min_freq
         self.lexicon.compactify()
@@ -67,8 +411,8 @@ class SimilarityIndex():
         print "loading tfidf from", self.tfidf_filepath
         self.tfidf_model = models.TfidfModel.load(self.tfidf_filepath, mmap='r')
 
-    def make_tfidf_model(self, seqs):
-        self.tfidf_model = models.TfidfModel((self.lexicon.doc2bow(tokenize(seq)) for seq in seqs))
+    def make_tfidf_model(self, corpus):
+        self.tfidf_model = models.TfidfModel(corpus)
         self.tfidf_model.save(self.tfidf_filepath)
         print "saved tfidf to", self.tfidf_filepath
 
@@ -76,11 +420,11 @@ class SimilarityIndex():
         print "loading lsi model from", self.lsi_filepath
         self.lsi_model = models.LsiModel.load(self.lsi_filepath, mmap='r')
 
-    def make_lsi_model(self, seqs):
+    def make_lsi_model(self, corpus):
         if self.use_tfidf:
-            seqs = (self.tfidf_model[self.lexicon.doc2bow(tokenize(seq))] for seq in seqs)
+            seqs = self.tfidf_model[corpus]
         else:
-            seqs = (self.lexicon.doc2bow(tokenize(seq)) for seq in seqs)
+            seqs = corpus
         self.lsi_model = models.LsiModel(seqs, num_topics=self.n_lsi_dim, id2word=self.lexicon)
         self.lsi_model.save(self.lsi_filepath)
         print "saved lsi model to", self.lsi_filepath
@@ -89,20 +433,17 @@ class SimilarityIndex():
         print "loading index from", self.index_filepath
         self.index = similarities.Similarity.load(self.index_filepath, mmap='r')
     
-    def make_index(self, seqs):
+    def make_index(self, corpus):
         print "building index for sequences"
         #import pdb;pdb.set_trace()
+        if self.use_tfidf:
+            seqs = self.tfidf_model[corpus]
+        else:
+            seqs = corpus
         if self.use_lsi:
-            if self.use_tfidf:
-                seqs = (self.lsi_model[self.tfidf_model[self.lexicon.doc2bow(tokenize(seq))]] for seq in seqs)
-            else:
-                seqs = (self.lsi_model[self.lexicon.doc2bow(tokenize(seq))] for seq in seqs)
+            seqs = self.lsi_model[seqs]
             num_features = self.lsi_model.num_topics
         else:
-            if self.use_tfidf:
-                seqs = (self.tfidf_model[self.lexicon.doc2bow(tokenize(seq))] for seq in seqs)
-            else:
-                seqs = (self.lexicon.doc2bow(tokenize(seq)) for seq in seqs)
             num_features = len(self.lexicon.keys())
 
         self.index = similarities.Similarity(output_prefix=self.index_filepath, corpus=None, num_features=num_features)
@@ -111,27 +452,232 @@ class SimilarityIndex():
         self.index.save(self.index_filepath)
         print "saved index to", self.index_filepath
 
-    def get_sim_seq_idxs(self, seqs, n_best=5):
-        if type(seqs) in (unicode, str):
-            seqs = [seqs]
-        #import pdb;pdb.set_trace()
-        self.index.num_best = n_best
+    def make_ann_index(self, corpus):
+        '''write the LSI vectors of the corpus to a memory-mapped array and build the IVFIndex from it'''
         if self.use_tfidf:
-            seqs = [self.tfidf_model[self.lexicon.doc2bow(tokenize(seq))] for seq in seqs]
+            seqs = self.tfidf_model[corpus]
         else:
-            seqs = [self.lexicon.doc2bow(tokenize(seq)) for seq in seqs]
+            seqs = corpus
+        seqs = self.lsi_model[seqs]
+        lsi_vecs_filepath = self.index_dir_filepath + "/lsi-vectors.npy"
+        lsi_vecs = numpy.lib.format.open_memmap(lsi_vecs_filepath, mode='w+', dtype='float32',
+                                                shape=(len(corpus), self.n_lsi_dim))
+        chunk = []
+        seq_idx = 0
+        for seq in seqs:
+            chunk.append(seq)
+            if len(chunk) == self.index.chunk_size:
+                lsi_vecs[seq_idx:seq_idx + len(chunk)] = corpus2dense(chunk, num_terms=self.n_lsi_dim).T
+                seq_idx += len(chunk)
+                chunk = []
+        if chunk:
+            lsi_vecs[seq_idx:seq_idx + len(chunk)] = corpus2dense(chunk, num_terms=self.n_lsi_dim).T
+        self.index.make(lsi_vecs)
+        del lsi_vecs
+        os.remove(lsi_vecs_filepath)
+
+    def add_corpus_to_index(self, corpus):
+        if self.use_tfidf:
+            seqs = self.tfidf_model[corpus]
+        else:
+            seqs = corpus
         if self.use_lsi:
             seqs = self.lsi_model[seqs]
-        sim_seqs = self.index[seqs]
-        sim_idxs = [[sim_seq[0] for sim_seq in n_best_seqs] for n_best_seqs in sim_seqs]
-        sim_idxs = numpy.array([idxs + [numpy.nan] * (n_best - len(idxs)) for idxs in sim_idxs]) # in some weird cases, fewer than n_best sequence IDs will be returned
-        sim_scores = [[sim_seq[1] for sim_seq in n_best_seqs] for n_best_seqs in sim_seqs]
-        sim_scores = numpy.array([scores + [numpy.nan] * (n_best - len(scores)) for scores in sim_scores]) # in some weird cases, fewer than n_best sequence IDs will be returned
+        if self.use_ann:
+            self.index.add(corpus2dense(seqs, num_terms=self.n_lsi_dim, num_docs=len(corpus)).T)
+        else:
+            self.index.add_documents(seqs)
+            self.index.save(self.index_filepath)  # saving closes the current shard of the index
+
+    def add_seqs(self, seqs, tokenized=False):
+        '''append seqs to the index without rebuilding it: they are mapped to the existing lexicon, weighted by the
+        existing tfidf (and lsi) models and saved as a new corpus shard; tokens that are not in the lexicon are counted
+        in the manifest. New seqs get the ids following the ones already in the index. Run compact() to refit
+        the weights on all seqs'''
+        if not tokenized:
+            seqs = [tokenize(seq) for seq in seqs]
+        bows = []
+        n_oov = 0
+        for seq in seqs:
+            bow, oov_counts = self.lexicon.doc2bow(seq, return_missing=True)
+            bows.append(bow)
+            n_oov += sum(oov_counts.values())
+        shard = {'n_seqs': len(bows), 'n_tokens': sum([len(seq) for seq in seqs]), 'n_oov': n_oov}
+
+        with self.lock:
+            self.manifest['n_added_shards'] += 1
+            shard['corpus_filepath'] = self.filepath + "/corpus-shard-" + str(self.manifest['n_added_shards']) + ".mm"
+            corpora.MmCorpus.serialize(shard['corpus_filepath'], bows)
+            self.add_corpus_to_index(bows)
+            self.manifest['shards'].append(shard)
+            self.save_manifest()
+        print "added", shard['n_seqs'], "sequences to index,", n_oov, "of", shard['n_tokens'], "tokens not in lexicon"
+
+    def compact(self, background=False):
+        '''merge all corpus shards into one corpus, refit the tfidf (and lsi) models on it and rebuild the index,
+        as a new generation; the current models keep answering queries until the new ones are swapped in, and seqs
+        added in the meantime are carried over. With background=True this runs in a thread, which is returned'''
+        if background:
+            thread = threading.Thread(target=self.compact)
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        with self.lock:
+            shards = list(self.manifest['shards'])
+            old_generation = self.manifest['generation']
+            assert (sum([shard['n_seqs'] for shard in shards]) == len(self.index))  # corpus must cover the whole index
+        generation = old_generation + 1
+        print "compacting", len(shards), "corpus shards into generation", generation
+
+        builder = copy.copy(self)  # builds the new generation without touching the models being queried
+        builder.set_filepaths(generation)
+        corpora.MmCorpus.serialize(builder.corpus_filepath,
+                                   ShardedCorpus([shard['corpus_filepath'] for shard in shards]))
+        builder.load_corpus()
+        if self.use_tfidf:
+            builder.make_tfidf_model(builder.corpus)
+        if self.use_lsi:
+            builder.make_lsi_model(builder.corpus)
+        os.mkdir(builder.index_dir_filepath)
+        if self.use_ann:
+            builder.index = IVFIndex(builder.index_dir_filepath, n_clusters=self.n_clusters, n_probe=self.n_probe)
+            builder.make_ann_index(builder.corpus)
+        else:
+            builder.make_index(builder.corpus)
+
+        with self.lock:
+            added_shards = self.manifest['shards'][len(shards):]
+            for shard in added_shards:
+                builder.add_corpus_to_index(corpora.MmCorpus(shard['corpus_filepath']))
+            for attr in ('generation_filepath', 'corpus_filepath', 'tfidf_filepath', 'lsi_filepath',
+                         'index_dir_filepath', 'index_filepath', 'corpus', 'index'):
+                setattr(self, attr, getattr(builder, attr))
+            if self.use_tfidf:
+                self.tfidf_model = builder.tfidf_model
+            if self.use_lsi:
+                self.lsi_model = builder.lsi_model
+            self.manifest['generation'] = generation
+            self.manifest['shards'] = [{'corpus_filepath': self.corpus_filepath, 'n_seqs': len(self.corpus),
+                                        'n_tokens': sum([shard['n_tokens'] or 0 for shard in shards]),
+                                        'n_oov': sum([shard['n_oov'] for shard in shards])}] + added_shards
+            self.save_manifest()
+
+        # the original build (generation 0) is kept; superseded later generations are removed once the queries still
+        # using them are done (their index shards may be opened lazily), and merged shards are removed now
+        if old_generation:
+            with self.lock:
+                self.retired_generations.add(old_generation)
+            self.remove_unused_generations()
+        for shard in shards:
+            if os.path.basename(shard['corpus_filepath']).startswith("corpus-shard-"):
+                for shard_filepath in glob.glob(shard['corpus_filepath'] + "*"):
+                    os.remove(shard_filepath)
+        print "compacted index into generation", generation
+
+    def acquire_generation(self):
+        '''register a query using the current generation, and return that generation'''
+        with self.lock:
+            generation = self.manifest['generation']
+            self.n_readers[generation] = self.n_readers.get(generation, 0) + 1
+            return generation
+
+    def release_generation(self, generation):
+        with self.lock:
+            self.n_readers[generation] -= 1
+        self.remove_unused_generations()
+
+    def remove_unused_generations(self):
+        with self.lock:
+            unused_generations = [generation for generation in self.retired_generations
+                                  if not self.n_readers.get(generation)]
+            self.retired_generations.difference_update(unused_generations)
+        for generation in unused_generations:
+            shutil.rmtree(self.filepath + "/generation-" + str(generation))
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(processes=self.n_threads)
+        return self.pool
+
+    def get_idfs(self, tfidf_model):
+        '''idf weights of tfidf_model as an array aligned with the lexicon ids'''
+        if not hasattr(self, 'idfs') or self.idfs[0] is not tfidf_model:
+            idfs = numpy.zeros((len(self.lexicon),), dtype='float32')
+            term_ids, term_idfs = zip(*tfidf_model.idfs.items())
+            idfs[list(term_ids)] = term_idfs
+            self.idfs = (tfidf_model, idfs)
+        return self.idfs[1]
+
+    def seqs_to_matrix(self, seqs, tfidf_model=None, lsi_model=None):
+        '''transform tokenized seqs into a single (n_seqs, n_features) matrix of L2-normalized rows: a sparse
+        (tfidf-weighted) bag-of-words matrix, or a dense matrix of lsi topics; same result as applying the gensim
+        models one seq at a time'''
+        bows = [self.lexicon.doc2bow(seq) for seq in seqs]
+        indptr = numpy.concatenate([[0], numpy.cumsum([len(bow) for bow in bows])]).astype('int64')
+        term_ids = numpy.array([term_id for bow in bows for term_id, count in bow], dtype='int64')
+        counts = numpy.array([count for bow in bows for term_id, count in bow], dtype='float32')
+        matrix = sparse.csr_matrix((counts, term_ids, indptr), shape=(len(bows), len(self.lexicon)))
+        if tfidf_model is not None:
+            matrix = normalize_sparse_vecs(matrix.multiply(self.get_idfs(tfidf_model)[None]).tocsr())
+        if lsi_model is not None:
+            matrix = normalize_vecs(numpy.asarray(matrix.dot(lsi_model.projection.u[:, :lsi_model.num_topics]),
+                                                  dtype='float32'))
+        elif tfidf_model is None:
+            matrix = normalize_sparse_vecs(matrix)
+        return matrix
+
+    def query_index_shard(self, shard, first_id, query, n_best):
+        scores = numpy.asarray(shard.get_index().get_similarities(query)).reshape(query.shape[0], -1)
+        return get_top_n(scores, n_best, first_id=first_id)
+
+    def get_sim_seq_idxs(self, seqs, n_best=5, tokenized=False, n_probe=None, batch_size=1000):
+        '''return (n_seqs, n_best) arrays with the ids and cosine scores of the most similar indexed seqs, padded with
+        NaN (only seqs with a non-zero score are returned); seqs are transformed batch_size at a time into one matrix, and the index shards are searched in parallel on
+        a thread pool (numpy/scipy release the GIL). n_probe only applies to the ann index; it overrides the number of
+        clusters searched per query'''
+        if type(seqs) in (unicode, str) or (tokenized and seqs and type(seqs[0]) in (unicode, str)):
+            seqs = [seqs]
+        if not tokenized:
+            seqs = [tokenize(seq) for seq in seqs]
+        with self.lock:
+            # queries use one consistent set of models, even if compact() swaps in new ones meanwhile; their
+            # generation isn't removed until the query is done
+            tfidf_model = self.tfidf_model if self.use_tfidf else None
+            lsi_model = self.lsi_model if self.use_lsi else None
+            index = self.index
+            if not self.use_ann and index.fresh_docs:
+                index.close_shard()
+            if not self.use_ann:
+                shards = list(index.shards)
+                shard_first_ids = numpy.cumsum([0] + [len(shard) for shard in shards])
+            generation = self.acquire_generation()
+
+        try:
+            sim_idxs = numpy.full((len(seqs), n_best), numpy.nan)
+            sim_scores = numpy.full((len(seqs), n_best), numpy.nan)
+            pool = self.get_pool()
+            for batch_idx in range(0, len(seqs), batch_size):
+                query = self.seqs_to_matrix(seqs[batch_idx:batch_idx + batch_size],
+                                            tfidf_model=tfidf_model, lsi_model=lsi_model)
+                if self.use_ann:
+                    batch_idxs, batch_scores = index.query(query, n_best=n_best, n_probe=n_probe, pool=pool)
+                else:
+                    shard_results = pool.map(lambda shard_idx: self.query_index_shard(shards[shard_idx],
+                                                                                      shard_first_ids[shard_idx],
+                                                                                      query, n_best),
+                                             range(len(shards)))
+                    batch_idxs, batch_scores = merge_top_n(shard_results, n_best)
+                sim_idxs[batch_idx:batch_idx + batch_size] = batch_idxs
+                sim_scores[batch_idx:batch_idx + batch_size] = batch_scores
+        finally:
+            self.release_generation(generation)
         return sim_idxs, sim_scores
 
     @classmethod
-    def load(cls, filepath, use_tfidf=True, use_lsi=False):
-        sim_index = SimilarityIndex(seqs=None, filepath=filepath, use_tfidf=use_tfidf, use_lsi=use_lsi)
+    def load(cls, filepath, use_tfidf=True, use_lsi=False, tokenized=False, use_ann=False, n_probe=8, n_threads=None):
+        sim_index = SimilarityIndex(seqs=None, filepath=filepath, use_tfidf=use_tfidf, use_lsi=use_lsi,
+                                    tokenized=tokenized, use_ann=use_ann, n_probe=n_probe, n_threads=n_threads)
         return sim_index
 
 
@@ -1,7 +1,9 @@
 from __future__ import print_function
-import numpy, os, spacy, pickle, sys, re, random
+import numpy, os, spacy, pickle, sys, re, random, hashlib
 from itertools import *
 import multiprocessing
+from scipy import sparse
+from spacy.attrs import DEP, HEAD
 
 # load spacy model for nlp tools
 encoder = spacy.load('en_core_web_md')
@@ -15,42 +17,68 @@ pos_tag_idxs = {'#': 1, '$': 2, "''": 3, '(': 4, ')': 5, ',': 6, '-LRB-': 7, '-P
                 'VBP': 50, 'VBZ': 51, 'WDT': 52, 'WP': 53, 'WP$': 54, 'WRB': 55, 'XX': 56, '``': 57, '""': 58,
                 '-RRB-': 59}
 
+# dependency labels of words that start a clause, and the labels their heads must have (see get_clause_spans())
+clause_dep_ids = numpy.array([encoder.vocab.strings[dep] for dep in ('advcl', 'conj', 'pcomp')], dtype='uint64')
+clause_head_dep_ids = numpy.array([encoder.vocab.strings[dep] for dep in ('ccomp', 'conj', 'ROOT', 'xcomp')],
+                                  dtype='uint64')  # , 'prep', 'relcl','acomp'): #'prep', 'relcl','acomp' newly added
+
 rng = numpy.random.RandomState(0)
 
 
-def segment(seq, clauses=False):
+def segment(seq, clauses=False, as_spans=False):
+    '''if as_spans=True, return the sentences (or clauses) as spans of a single parse of seq instead of strings'''
     if clauses:
-        seq = segment_into_clauses(seq)  # segment into clauses rather than just sentences
+        seq = segment_into_clauses(seq, as_spans=as_spans)  # segment into clauses rather than just sentences
+    elif as_spans:
+        seq = list(encoder(seq).sents)
     else:
         seq = [sent.string.strip() for sent in encoder(seq).sents]
     return seq
 
 
+def is_parsed_word(word):
+    '''true for spacy tokens and spans, false for words that are already strings (e.g. phrases combined by
+    combine_phrases_in_seq() or entities replaced by parse_ents_in_seq())'''
+    return isinstance(word, (spacy.tokens.Token, spacy.tokens.Span))
+
+
+def get_word_string(word):
+    return word.string.strip() if is_parsed_word(word) else word
+
+
 def tokenize(seq, lowercase=True, recognize_ents=False, lemmatize=False, include_tags=[], include_pos=[],
-             prepend_start=False):
-    seq = encoder(seq)  # 用spacy
+             prepend_start=False, phrase_trie=None):
+    '''seq can be a string, a parsed spacy Doc or Span (e.g. a clause given by segment_into_clauses()), or a list of
+    spacy tokens and strings from the same parse (as given by combine_phrases_in_seq()); if phrase_trie is given,
+    phrases are combined into single tokens without parsing seq again'''
+    if not isinstance(seq, (spacy.tokens.Doc, spacy.tokens.Span, list)):  # seq may already be parsed
+        seq = encoder(seq)  # 用spacy
     if recognize_ents:  # merge named entities into single tokens
-        ent_start_idxs = {ent.start: ent for ent in seq.ents if ent.string.strip()}
+        ent_start_idxs = {ent.start: ent for ent in seq.ents if ent.string.strip()}  # ent.start indexes the whole doc
         # combine each ent into a single token; this is pretty hard to read, but it works
-        seq = [ent_start_idxs[word_idx] if word_idx in ent_start_idxs else word
-               for word_idx, word in enumerate(seq)
-               if (not word.ent_type_ or word_idx in ent_start_idxs)]
-    # Don't apply POS filtering to phrases (words with underscores)
+        seq = [ent_start_idxs[word.i] if word.i in ent_start_idxs else word
+               for word in seq
+               if (not word.ent_type_ or word.i in ent_start_idxs)]
+    if phrase_trie:
+        seq = combine_phrases_in_seq(seq, lemmatized=lemmatize, phrase_trie=phrase_trie)
+    # Don't apply POS filtering to phrases (words with underscores) or to words that are already strings
     if include_tags:
         # fine-grained POS tags
-        seq = [word for word in seq if ("_" in word.string or word.tag_ in include_tags)]
+        seq = [word for word in seq if (not is_parsed_word(word) or "_" in word.string or word.tag_ in include_tags)]
     if include_pos:
         # coarse-grained POS tags
-        seq = [word for word in seq if ("_" in word.string or word.pos_ in include_pos)]
+        seq = [word for word in seq if (not is_parsed_word(word) or "_" in word.string or word.pos_ in include_pos)]
     if lemmatize:
-        seq = [word.lemma_ if not word.string.startswith('ENT_') else word.string.strip() for word in seq]
+        seq = [word.lemma_ if is_parsed_word(word) and not word.string.startswith('ENT_') else get_word_string(word)
+               for word in seq]
     elif lowercase:
         # don't lowercase if token is an entity (entities will be of type span instead of token;
         # or will be prefixed with 'ENT_' if already transformed to types)
-        seq = [word.string.strip().lower() if (type(word) == spacy.tokens.token.Token and not word.string.startswith('ENT_'))
-               else word.string.strip() for word in seq]
+        seq = [get_word_string(word).lower() if (type(word) != spacy.tokens.span.Span
+                                                 and not get_word_string(word).startswith('ENT_'))
+               else get_word_string(word) for word in seq]
     else:
-        seq = [word.string.strip() for word in seq]
+        seq = [get_word_string(word) for word in seq]
     seq = [word for word in seq if word]  # some words may be empty strings, so filter
     if prepend_start:
         seq.insert(0, u"<START>")
@@ -82,9 +110,11 @@ def get_ents(seq, include_ent_types=('PERSON', 'NORP', 'ORG', 'GPE'), recognize_
         for gender, filename in gender_filenames.items():
             with open(filename) as f:
                 names_gender[gender] = pickle.load(f)
+    if not isinstance(seq, spacy.tokens.Doc):  # seq may already be parsed
+        seq = encoder(seq)
     ents = {}
     ent_counts = {}
-    for ent in encoder(seq).ents:
+    for ent in seq.ents:
         ent_type = ent.label_
         if ent_type in include_ent_types:
             ent = ent.string.strip()
@@ -108,16 +138,21 @@ def get_ents(seq, include_ent_types=('PERSON', 'NORP', 'ORG', 'GPE'), recognize_
     return ents, ent_counts
 
 
-def number_ents(ents, ent_counts):
+def number_ents(ents, ent_counts, ent_bounds=None):
     '''return dict of all entities in seq mapped to their entity types, 
-    with numerical suffixes to distinguish entities of the same type'''
+    with numerical suffixes to distinguish entities of the same type;
+    ent_bounds can map each entity to its (first word, last word), otherwise these are found by tokenizing the entity'''
+    if ent_bounds is None:
+        ent_bounds = {}
+        for ent in ents:
+            ent_words = tokenize(ent, lowercase=False)
+            ent_bounds[ent] = (ent_words[0], ent_words[-1])
     ent_counts = sorted([(count, ent, ents[ent]) for ent, count in ent_counts.items()])[::-1]
     ent_type_counts = {}
     num_ents = {}
     for count, ent, ent_type in ent_counts:
         coref_ent = [num_ent for num_ent in num_ents if
-                     (tokenize(num_ent, lowercase=False)[0] == tokenize(ent, lowercase=False)[0]
-                      or tokenize(num_ent, lowercase=False)[-1] == tokenize(ent, lowercase=False)[-1])
+                     (ent_bounds[num_ent][0] == ent_bounds[ent][0] or ent_bounds[num_ent][1] == ent_bounds[ent][1])
                      and ents[num_ent] == ent_type]  # treat ents with same first or last word as co-referring
         if coref_ent:
             num_ents[ent] = num_ents[coref_ent[0]]
@@ -173,6 +208,44 @@ def adapt_tok_seq_ents(seq, ents={}, sub_ent_probs={}):
     return seq
 
 
+# rules for transforming a sentence of whitespace-separated tokens back into formatted text, applied in order;
+# compiled once rather than each time a sequence is detokenized
+detok_rules = [
+    (re.compile("\'"), "'"),
+
+    # capitalize first-person "I" pronoun
+    (re.compile(" i "), " I "),
+
+    # rules for contractions
+    (re.compile(" n\'\s*t "), "n\'t "),
+    (re.compile(" \'\s*d "), "\'d "),
+    (re.compile(" \'\s*s "), "\'s "),
+    (re.compile(" \'\s*ve "), "\'ve "),
+    (re.compile(" \'\s*ll "), "\'ll "),
+    (re.compile(" \'\s*m "), "\'m "),
+    (re.compile(" \'\s*re "), "\'re "),
+
+    # rules for formatting punctuation
+    (re.compile(" \."), "."),
+    (re.compile(" \!"), "!"),
+    (re.compile(" \?"), "?"),
+    (re.compile(" ,"), ","),
+    (re.compile(" \- "), "-"),
+    (re.compile(" :"), ":"),
+    (re.compile(" ;"), ";"),
+    (re.compile("\$ "), "$"),
+    (re.compile("\' \'"), "\'\'"),
+    (re.compile("\` \`"), "\`\`"),
+
+    # replace repeated single quotes with double quotation mark.
+    (re.compile("\'\'"), "\""),
+    (re.compile("\`\`"), "\""),
+
+    # filter repetitive characters
+    (re.compile("([\"\']\s*){2,}"), "\" "),
+]
+
+
 def detokenize_tok_seq(seq, ents=[]):
     '''use simple rules for transforming list of tokens back into string
     ents is optional list of words (named entities) that should be capitalized'''
@@ -198,38 +271,8 @@ def detokenize_tok_seq(seq, ents=[]):
 
         detok_sent = " ".join(sent)
 
-        detok_sent = re.sub("\'", "'", detok_sent)
-
-        # capitalize first-person "I" pronoun
-        detok_sent = re.sub(" i ", " I ", detok_sent)
-
-        # rules for contractions
-        detok_sent = re.sub(" n\'\s*t ", "n\'t ", detok_sent)
-        detok_sent = re.sub(" \'\s*d ", "\'d ", detok_sent)
-        detok_sent = re.sub(" \'\s*s ", "\'s ", detok_sent)
-        detok_sent = re.sub(" \'\s*ve ", "\'ve ", detok_sent)
-        detok_sent = re.sub(" \'\s*ll ", "\'ll ", detok_sent)
-        detok_sent = re.sub(" \'\s*m ", "\'m ", detok_sent)
-        detok_sent = re.sub(" \'\s*re ", "\'re ", detok_sent)
-
-        # rules for formatting punctuation
-        detok_sent = re.sub(" \.", ".", detok_sent)
-        detok_sent = re.sub(" \!", "!", detok_sent)
-        detok_sent = re.sub(" \?", "?", detok_sent)
-        detok_sent = re.sub(" ,", ",", detok_sent)
-        detok_sent = re.sub(" \- ", "-", detok_sent)
-        detok_sent = re.sub(" :", ":", detok_sent)
-        detok_sent = re.sub(" ;", ";", detok_sent)
-        detok_sent = re.sub("\$ ", "$", detok_sent)
-        detok_sent = re.sub("\' \'", "\'\'", detok_sent)
-        detok_sent = re.sub("\` \`", "\`\`", detok_sent)
-
-        # replace repeated single quotes with double quotation mark.
-        detok_sent = re.sub("\'\'", "\"", detok_sent)
-        detok_sent = re.sub("\`\`", "\"", detok_sent)
-
-        # filter repetitive characters
-        detok_sent = re.sub("([\"\']\s*){2,}", "\" ", detok_sent)
+        for pattern, repl in detok_rules:
+            detok_sent = pattern.sub(repl, detok_sent)
 
         punc_pairs = {"\'": "\'", "\'": "\'", "`": "\'", "\"": "\"", "(": ")",
                       "[": "]"}  # map each opening puncutation mark to closing mark
@@ -280,26 +323,57 @@ def get_word_pairs(tok_seq1, tok_seq2):
     return pairs
 
 
-def get_adj_pair(seq, segment_clauses=False, max_distance=1, reverse=False, max_sent_length=25):
+def get_word_pair_idxs(lengths1, lengths2):
+    '''vectorized version of get_word_pairs() for many sequence pairs at once: given the lengths of each seq1 and seq2,
+    return indices of each word pair into the concatenated seqs1 and concatenated seqs2 (in the same order as
+    get_word_pairs()), plus the index of the first pair of each sequence pair and the number of pairs per sequence pair'''
+    lengths1 = numpy.asarray(lengths1, dtype='int64')
+    lengths2 = numpy.asarray(lengths2, dtype='int64')
+    n_pairs = lengths1 * lengths2
+    pair_starts = numpy.cumsum(n_pairs) - n_pairs
+    seq_ids = numpy.repeat(numpy.arange(len(n_pairs)), n_pairs)  # segment id of each word pair
+    pair_idxs = numpy.arange(numpy.sum(n_pairs)) - pair_starts[seq_ids]  # position of word pair within its segment
+    word1_idxs = (numpy.cumsum(lengths1) - lengths1)[seq_ids] + pair_idxs // lengths2[seq_ids]
+    word2_idxs = (numpy.cumsum(lengths2) - lengths2)[seq_ids] + pair_idxs % lengths2[seq_ids]
+    return word1_idxs, word2_idxs, pair_starts, n_pairs
+
+
+# transformer that get_adj_pair() tokenizes pairs with in get_adj_sent_pairs() worker processes
+pair_transformer = None
+
+
+def set_pair_transformer(transformer):
+    global pair_transformer
+    pair_transformer = transformer
+
+
+def get_adj_pair(seq, segment_clauses=False, max_distance=1, reverse=False, max_sent_length=25, transformer=None):
+    '''if seq is a string, it is parsed once and its sentences or clauses are kept as spans of that parse; if transformer
+    is given, the paired spans are tokenized with transformer.text_to_tok_seq() directly, so pairs are token lists
+    that transformer.text_to_nums() takes without parsing them again'''
+    if transformer is None:
+        transformer = pair_transformer
     if type(seq) in (str, bytes):
-        seq = segment(seq, clauses=segment_clauses)  # segment the seq into sentences or clauses
+        seq = segment(seq, clauses=segment_clauses, as_spans=True)  # segment the seq into sentences or clauses
+
+    seq_lengths = [len(tokenize(sent)) if type(sent) in (str, bytes, spacy.tokens.Span) else len(sent) for sent in seq]
+    if transformer is not None:
+        seq = [transformer.text_to_tok_seq(sent) if type(sent) in (str, bytes, spacy.tokens.Span) else sent
+               for sent in seq]
+    else:  # spans are given as strings, as from segment()
+        seq = [(sent.string if segment_clauses else sent.string.strip()) if type(sent) == spacy.tokens.Span else sent
+               for sent in seq]
 
     adj_pairs = []
     for sent_idx in range(len(seq) - 1):
         sent1 = seq[sent_idx]
-        if type(sent1) in (str, bytes):
-            len_sent1 = len(tokenize(sent1))
-        else:
-            len_sent1 = len(sent1)
+        len_sent1 = seq_lengths[sent_idx]
         if len_sent1 and len_sent1 <= max_sent_length:
             for window_idx in range(max_distance):
                 if sent_idx + window_idx == len(seq) - 1:  # sent_idx 句子在seq的位置，window_idx 邻居句子的偏移
                     break
                 sent2 = seq[sent_idx + window_idx + 1]
-                if type(sent2) in (str, bytes):
-                    len_sent2 = len(tokenize(sent2))
-                else:
-                    len_sent2 = len(sent2)
+                len_sent2 = seq_lengths[sent_idx + window_idx + 1]
                 if len_sent2 and len_sent2 <= max_sent_length:  # filter sentences that are too long
                     if reverse:
                         adj_pairs.append((sent2, sent1))  # if reverse=True, reverse order of sentence pair
@@ -309,13 +383,17 @@ def get_adj_pair(seq, segment_clauses=False, max_distance=1, reverse=False, max_
     return adj_pairs
 
 
-def get_adj_sent_pairs(seqs, segment_clauses=False, max_distance=1, reverse=False, max_sent_length=25):
+def get_adj_sent_pairs(seqs, segment_clauses=False, max_distance=1, reverse=False, max_sent_length=25,
+                       transformer=None):
     '''sequences can be string or transformer into numbers;
     if segment clauses=True, split sequences by clause boundaries rather than sentence boundaries,
     max distance indicates clause window within which pairs will be found
-    (e.g. when max_distance = 2, both neighboring clauses and those separated by one other clause will be paired'''
+    (e.g. when max_distance = 2, both neighboring clauses and those separated by one other clause will be paired);
+    if transformer is given, pairs are token lists taken from the same parse that segmented them (see get_adj_pair())'''
     results = []
-    pool = multiprocessing.Pool(processes=int(multiprocessing.cpu_count()))
+    # the transformer is passed to each worker once rather than with every seq
+    pool = multiprocessing.Pool(processes=int(multiprocessing.cpu_count()),
+                                initializer=set_pair_transformer, initargs=(transformer,))
     for seq in seqs:
         results.append(pool.apply_async(get_adj_pair, (seq, segment_clauses, max_distance, reverse, max_sent_length,)))
     pool.close()
@@ -339,62 +417,128 @@ def randomize_pairs(pairs):
     return random_pairs
 
 
-def segment_into_clauses(seq):
-    '''applies a set of heuristics to segment a sequence (one or more sentences) into clauses
-    the clauses are those that would useful for splitting causal events, so not all types clauses will be recognized'''
-    clauses = []
-    sents = segment(seq)  # 分子句前先分句
-    for sent in sents:
-        sent = encoder(sent)
+def get_clause_spans(doc):
+    '''applies a set of heuristics to segment a parsed spacy Doc (one or more sentences) into clauses, returned as
+    (start, end) token offsets into doc; the dependency labels and heads of all tokens are read with one doc.to_array()
+    call, so only the tokens that start a clause are inspected individually'''
+    dep_labels, head_offsets = doc.to_array([DEP, HEAD]).T
+    head_idxs = numpy.arange(len(doc)) + head_offsets.astype('int64')  # heads are stored relative to each token
+    is_clause = numpy.isin(dep_labels, clause_dep_ids) & numpy.isin(dep_labels[head_idxs], clause_head_dep_ids)
+    clause_word_idxs = numpy.flatnonzero(is_clause)
+    clause_spans = []
+    for sent in doc.sents:
         clause_bound_idxs = []
-        for word in sent:
-            if word.dep_ in ('advcl', 'conj', 'pcomp') and word.head.dep_ in ('ccomp', 'conj', 'ROOT', 'xcomp'):
-                # , 'prep', 'relcl','acomp'): #'prep', 'relcl','acomp' newly added
-                if clause_bound_idxs and clause_bound_idxs[-1] >= word.left_edge.i:
-                    clause_bound_idxs[-1] = word.left_edge.i  # ensure no overlap in clauses
-                if not clause_bound_idxs or clause_bound_idxs[-1] + 1 < word.left_edge.i:
-                    clause_bound_idxs.append(word.left_edge.i)  # attach single words to previous clause
-                clause_bound_idxs.append(word.right_edge.i + 1)
-        if clause_bound_idxs and clause_bound_idxs[0] == 1:
-            clause_bound_idxs[0] = 0  # merge first word in first clause if split out
-        if not clause_bound_idxs or clause_bound_idxs[0]:
-            clause_bound_idxs.insert(0, 0)
-        if clause_bound_idxs[-1] < len(sent):
-            clause_bound_idxs.append(len(sent))  # set clause boundary at end of sentence
-        sent_clauses = []
+        sent_word_idxs = clause_word_idxs[(clause_word_idxs >= sent.start) & (clause_word_idxs < sent.end)]
+        for word_idx in sent_word_idxs:
+            word = doc[word_idx]
+            if clause_bound_idxs and clause_bound_idxs[-1] >= word.left_edge.i:
+                clause_bound_idxs[-1] = word.left_edge.i  # ensure no overlap in clauses
+            if not clause_bound_idxs or clause_bound_idxs[-1] + 1 < word.left_edge.i:
+                clause_bound_idxs.append(word.left_edge.i)  # attach single words to previous clause
+            clause_bound_idxs.append(word.right_edge.i + 1)
+        if clause_bound_idxs and clause_bound_idxs[0] == sent.start + 1:
+            clause_bound_idxs[0] = sent.start  # merge first word in first clause if split out
+        if not clause_bound_idxs or clause_bound_idxs[0] > sent.start:
+            clause_bound_idxs.insert(0, sent.start)
+        if clause_bound_idxs[-1] < sent.end:
+            clause_bound_idxs.append(sent.end)  # set clause boundary at end of sentence
+        sent_spans = []
         for idx, next_idx in zip(clause_bound_idxs, clause_bound_idxs[1:]):
-            clause = sent[idx:next_idx]  # .string
-            if sent_clauses and len(clause) == 1 and clause[-1].pos_ == 'PUNCT':
+            if sent_spans and next_idx - idx == 1 and doc[idx].pos_ == 'PUNCT':
                 # if clause is punctuation, append it to previous clause
-                sent_clauses[-1] = sent_clauses[-1] + clause.string
+                sent_spans[-1] = (sent_spans[-1][0], next_idx)
             else:
-                sent_clauses.append(clause.string)
-        clauses.extend(sent_clauses)
+                sent_spans.append((idx, next_idx))
+        clause_spans.extend(sent_spans)
+    return clause_spans
+
+
+def segment_into_clauses(seq, as_spans=False):
+    '''applies a set of heuristics to segment a sequence (one or more sentences) into clauses
+    the clauses are those that would useful for splitting causal events, so not all types clauses will be recognized;
+    seq can be a string or an already parsed spacy Doc, which is then not parsed again. If as_spans=True, the clauses
+    are returned as spacy spans of that parse, which tokenize() takes without parsing them again'''
+    if not isinstance(seq, spacy.tokens.Doc):
+        seq = encoder(seq)  # sentences are split from the same parse
+    clauses = [seq[start:end] for start, end in get_clause_spans(seq)]
+    if not as_spans:
+        clauses = [clause.string for clause in clauses]
     return clauses
 
 
-def combine_phrases_in_seq(seq, phrases, lemmatized=False):
+def make_phrase_trie(phrases):
+    '''build a token trie from phrases whose words are joined by underscores (e.g. "ice_cream"); each node is a dict
+    from the next word to the child node, and a None key marks that the words so far form a complete phrase'''
+    phrase_trie = {}
+    for phrase in phrases:
+        words = phrase.split("_")
+        if len(words) < 2:
+            continue
+        node = phrase_trie
+        for word in words:
+            node = node.setdefault(word, {})
+        node[None] = True
+    return phrase_trie
+
+
+def match_phrase(words, start_idx, phrase_trie):
+    '''return the end index of the longest phrase in phrase_trie starting at words[start_idx], or None if there is none'''
+    node = phrase_trie
+    end_idx = None
+    for idx in range(start_idx, len(words)):
+        node = node.get(words[idx])
+        if node is None:
+            break
+        if None in node:
+            end_idx = idx + 1
+    return end_idx
+
+
+def combine_phrases_in_seq(seq, phrases=None, lemmatized=False, phrase_trie=None):
+    '''join the words of each phrase in seq with underscores, preferring the longest phrase at each position; if
+    lemmatized=True (phrases are lemmatized) phrases are matched against the lemmas. seq is parsed once (it can also be
+    a parsed Doc or a list of tokens); the result is a list of the spacy tokens outside phrases and the phrase strings,
+    which tokenize() takes as it is'''
+    if phrase_trie is None:
+        phrase_trie = make_phrase_trie(phrases)
+    if not isinstance(seq, (spacy.tokens.Doc, spacy.tokens.Span, list)):
+        seq = encoder(seq)
+    tokens = [word for word in seq if get_word_string(word)]
+    words = [get_word_string(word) for word in tokens]
+    match_words = [word.lemma_ if is_parsed_word(word) else word for word in tokens] if lemmatized else words
     phrased_seq = []
-    seq = tokenize(seq, lowercase=False)
     idx = 0
-    while idx < len(seq):
-        if lemmatized:  # if phrases are lemmatized; if so, lemmatize sequence when tokenizing
-            possible_phrase = [word.lemma_ for word in encoder(" ".join(seq[idx:idx + 3]))]
+    while idx < len(words):
+        end_idx = match_phrase(match_words, idx, phrase_trie)
+        if end_idx:
+            phrased_seq.append("_".join(match_words[idx:end_idx]))
+            idx = end_idx
         else:
-            possible_phrase = seq[idx:idx + 3]
-        if "_".join(possible_phrase) in phrases:  # first try matching 3 word phrase
-            phrased_seq.append("_".join(possible_phrase))
-            idx += 3
-        elif "_".join(possible_phrase[:-1]) in phrases:  # then back off to 2 words
-            phrased_seq.append("_".join(possible_phrase[:-1]))
-            idx += 2
-        else:
-            phrased_seq.append(seq[idx])  # just add word if word not part of phrase
+            phrased_seq.append(tokens[idx])  # just add word if word not part of phrase
             idx += 1
-    phrased_seq = " ".join(phrased_seq)  # return as string
     return phrased_seq
 
 
+def get_spacy_vector(word):
+    '''spacy vector of a single-token word, or zeros if spacy has none; the word is looked up by its hash, so unlike
+    encoder(word) or encoder.vocab[word] this doesn't add unseen strings to the spacy vocab'''
+    key = encoder.vocab.strings[word]
+    if key in encoder.vocab.vectors:
+        return encoder.vocab.vectors[key]
+    return numpy.zeros((encoder.vocab.vectors_length,), dtype='float32')
+
+
+def replace_file(src_filepath, dst_filepath):
+    '''move src_filepath to dst_filepath, replacing dst_filepath if it exists (os.replace is not available in
+    python 2, and os.rename does not overwrite files on Windows)'''
+    if hasattr(os, 'replace'):
+        os.replace(src_filepath, dst_filepath)
+    else:
+        if os.name == 'nt' and os.path.exists(dst_filepath):
+            os.remove(dst_filepath)
+        os.rename(src_filepath, dst_filepath)
+
+
 def load_seqs(filepath, memmap=False, shape=None):
     if memmap:
         # file was saved as memmap
@@ -406,6 +550,8 @@ def load_seqs(filepath, memmap=False, shape=None):
 
 
 class SequenceTransformer():
+    max_ent_cache_size = 100000  # max number of seqs whose parse_ents_in_seq() results are kept
+
     def __init__(self, min_freq=1, lexicon=[], lemmatize=False, prepend_start=False, include_tags=[], verbose=1,
                  unk_word=u"<UNK>", word_embs=None, use_spacy_embs=False, generalize_ents=False, phrases=None, filepath=None):
         self.unk_word = unk_word  # string representation for unknown words in lexicon
@@ -445,7 +591,7 @@ class SequenceTransformer():
         for idx, seq in enumerate(seqs):
             print('seq {}...'.format(idx))
             if self.generalize_ents:  # reduce vocab by mapping all named entities to entity labels (e.g. "PERSON_0")
-                ents, ent_counts = get_ents(seq)  # first get named entities
+                ents, _, _, seq = self.parse_ents_in_seq(seq)  # get named entities and tokens with them replaced
                 # build a dictionary of entities that can be substituted when a generated entity isn't resolved
                 for ent, ent_type in ents.items():
                     if ent_type not in self.ent_counts:
@@ -454,12 +600,8 @@ class SequenceTransformer():
                         self.ent_counts[ent_type][ent] = 1
                     else:
                         self.ent_counts[ent_type][ent] += 1
-                seq = self.replace_ents_in_seq(seq)
-            if hasattr(self, 'phrases') and self.phrases is not None:  # add given phrases to word counts
-                # if sequences will be lemmatized, assume that given phrases are lemmatized
-                seq = combine_phrases_in_seq(seq, self.phrases, lemmatized=self.lemmatize)
-            seq = tokenize(seq, lemmatize=self.lemmatize, include_tags=self.include_tags,
-                           prepend_start=self.prepend_start)  # 给每个故事分词 词形还原 词性标注
+            else:
+                seq = self.text_to_tok_seq(seq)  # 给每个故事分词 词形还原 词性标注 (given phrases are added to word counts)
             for word in seq:
                 if word not in self.word_counts:  # 词频词典
                     self.word_counts[word] = 1
@@ -473,8 +615,10 @@ class SequenceTransformer():
                 self.lexicon[word] = max(self.lexicon.values()) + 1
 
         self.lexicon_size = len(self.lexicon.keys())
+        self.emb_row_idxs = None  # lexicon changed, so map to embeddings must be recomputed
         self.lexicon_lookup = [None] + [word for index, word in sorted([(index, word) for word, index in
                                         self.lexicon.items()])]  # insert entry for empty timeslot in lexicon lookup
+        self.lexicon_lookup_array = None
         assert (len(self.lexicon_lookup) == self.lexicon_size + 1)
 
         if self.generalize_ents:
@@ -487,19 +631,57 @@ class SequenceTransformer():
         if hasattr(self, 'phrases') and self.phrases is not None:
             # only keep phrases that are in the lexicon
             self.phrases = set([phrase for phrase in list(self.phrases) if phrase in self.lexicon])
+            self.phrase_trie = None  # phrases changed, so trie must be rebuilt
+            self.ent_cache = None  # and cached tokens may contain phrases that were dropped
+        if self.use_spacy_embs:
+            self.make_spacy_embs()
         if self.verbose:
             print("added lexicon of", self.lexicon_size, "words with frequency >=", self.min_freq)
         if self.filepath:  # if filepath given, save transformer
             self.save()
 
+    def parse_ents_in_seq(self, seq):
+        '''parse seq once and return its entities (as given by get_ents()), the entities numbered by type (as given by
+        number_ents()), seq with entities replaced by their numbered types, and the tokens of that seq (as given by
+        text_to_tok_seq(), taken from the same parse, so text_to_nums() can use them directly); results are cached by
+        seq, so e.g. fitting a pipeline after make_lexicon() doesn't parse the same seqs again'''
+        if getattr(self, 'ent_cache', None) is None:
+            self.ent_cache = {}
+        if seq in self.ent_cache:
+            return self.ent_cache[seq]
+        doc = encoder(seq)
+        ents, ent_counts = get_ents(doc)
+        ent_bounds = {}
+        for ent in doc.ents:
+            ent_words = [word.string.strip() for word in ent if word.string.strip()]
+            if ent_words:
+                ent_bounds[ent.string.strip()] = (ent_words[0], ent_words[-1])
+        num_ents = number_ents(ents, ent_counts, ent_bounds=ent_bounds)
+        # replace numbered entities (and other words that refer to them) with their types; the words of other
+        # entities are kept as they were parsed
+        ent_start_idxs = {ent.start: ent for ent in doc.ents if ent.string.strip()}
+        ent_words = []
+        for word_idx, word in enumerate(doc):
+            if word_idx in ent_start_idxs:
+                ent = ent_start_idxs[word_idx]
+                if ent.string.strip() in num_ents:
+                    ent_words.append('ENT_' + num_ents[ent.string.strip()])
+                else:
+                    ent_words.extend(ent)
+            elif not word.ent_type_:
+                if word.string.strip() in num_ents:
+                    ent_words.append('ENT_' + num_ents[word.string.strip()])
+                else:
+                    ent_words.append(word)
+        ent_seq = " ".join([get_word_string(word) for word in ent_words if get_word_string(word)])
+        tok_seq = self.text_to_tok_seq(ent_words)
+        if len(self.ent_cache) < self.max_ent_cache_size:
+            self.ent_cache[seq] = (ents, num_ents, ent_seq, tok_seq)
+        return ents, num_ents, ent_seq, tok_seq
+
     def replace_ents_in_seq(self, seq):
         '''extract entities from seq and replace them with their entity types'''
-        ents, ent_counts = get_ents(seq)
-        ents = number_ents(ents, ent_counts)
-        seq = tokenize(seq, lowercase=False, recognize_ents=True)
-        seq = ['ENT_' + ents[word] if word in ents else word for word in seq]
-        seq = " ".join(seq)
-        return seq
+        return self.parse_ents_in_seq(seq)[2]
 
     def tok_seq_to_nums(self, seq):
         assert (type(seq) == list)
@@ -519,6 +701,20 @@ class SequenceTransformer():
         assert (len(seqs) == len(num_seqs))
         return num_seqs
 
+    def get_phrase_trie(self):
+        '''trie of self.phrases used to match phrases in combine_phrases_in_seq(); built once per set of phrases'''
+        if getattr(self, 'phrase_trie', None) is None:
+            self.phrase_trie = make_phrase_trie(self.phrases)
+        return self.phrase_trie
+
+    def text_to_tok_seq(self, seq):
+        '''tokenize a string sequence with a single parse, combining the words of phrases (if given) into single tokens;
+        if sequences will be lemmatized, assume that given phrases are lemmatized. seq can also be a list of parsed
+        words (see tokenize())'''
+        phrase_trie = self.get_phrase_trie() if getattr(self, 'phrases', None) is not None else None
+        return tokenize(seq, lemmatize=self.lemmatize, include_tags=self.include_tags,
+                        prepend_start=self.prepend_start, phrase_trie=phrase_trie)
+
     def text_to_tok_seqs(self, seqs):
         seqs = [
             tokenize(seq, lemmatize=self.lemmatize, include_tags=self.include_tags, prepend_start=self.prepend_start)
@@ -526,14 +722,13 @@ class SequenceTransformer():
         return seqs
 
     def text_to_nums(self, seqs):
-        '''tokenize string sequences and convert to list of word indices'''
+        '''tokenize string sequences and convert to list of word indices; seqs that are already token lists (e.g. from
+        parse_ents_in_seq()) are not tokenized again'''
         # import pdb;pdb.set_trace()
         num_seqs = []
         for seq in seqs:
-            if hasattr(self, 'phrases') and self.phrases is not None:
-                seq = combine_phrases_in_seq(seq, self.phrases, lemmatized=self.lemmatize)
-            seq = tokenize(seq, lemmatize=self.lemmatize, include_tags=self.include_tags,
-                           prepend_start=self.prepend_start)
+            if not isinstance(seq, list):
+                seq = self.text_to_tok_seq(seq)
             seq = self.tok_seq_to_nums(seq)
             if not seq:
                 seq.append(1)  # if seq is blank, represent with single unknown word
@@ -541,6 +736,48 @@ class SequenceTransformer():
         assert (len(seqs) == len(num_seqs))
         return num_seqs
 
+    def make_spacy_embs(self):
+        '''copy the spacy vector of each lexicon word into a table aligned with the lexicon indices, so embedding
+        lookups don't have to go through spacy; saved as spacy_embs.npy next to transformer.pkl if filepath given'''
+        shape = (self.lexicon_size + 1, encoder.vocab.vectors_length)
+        if self.filepath:
+            if not os.path.isdir(self.filepath):
+                os.mkdir(self.filepath)
+            spacy_embs = numpy.lib.format.open_memmap(self.filepath + '/spacy_embs.npy', mode='w+',
+                                                      dtype='float32', shape=shape)
+        else:
+            spacy_embs = numpy.zeros(shape, dtype='float32')
+        for idx, word in enumerate(self.lexicon_lookup):
+            if word is not None and word != self.unk_word:  # padding and unknown words stay all zeros
+                spacy_embs[idx] = get_spacy_vector(word)
+        if self.filepath:
+            spacy_embs.flush()
+            del spacy_embs
+            self.load_spacy_embs(self.filepath)
+        else:
+            self.spacy_embs = spacy_embs
+
+    def load_spacy_embs(self, filepath):
+        if os.path.exists(filepath + '/spacy_embs.npy'):
+            self.spacy_embs = numpy.load(filepath + '/spacy_embs.npy', mmap_mode='r')
+
+    def words_to_spacy_embs(self, words):
+        '''return array of spacy vectors for a list of words; words in the lexicon are gathered from the table built
+        by make_spacy_embs(), other words are looked up directly in the spacy vectors (without running the pipeline); the
+        words are tokens, so each has a single vector'''
+        spacy_embs = getattr(self, 'spacy_embs', None)
+        embs = numpy.zeros((len(words), encoder.vocab.vectors_length), dtype='float32')
+        if spacy_embs is not None:
+            idxs = numpy.array([self.lexicon.get(word, 0) for word in words], dtype='int64')
+        else:
+            idxs = numpy.zeros((len(words),), dtype='int64')
+        in_lexicon = idxs > 1  # 0 is padding, 1 is the unknown word
+        if numpy.any(in_lexicon):
+            embs[in_lexicon] = spacy_embs[idxs[in_lexicon]]
+        for word_idx in numpy.where(~in_lexicon)[0]:
+            embs[word_idx] = get_spacy_vector(words[word_idx])
+        return embs
+
     def tok_seq_to_embs(self, seq, reduce_emb_mode=None):
         assert (type(seq) == list)
         if not seq:
@@ -550,15 +787,12 @@ class SequenceTransformer():
                 seq = [word for token in seq for word in
                        token.split("_")]  # join phrases with white space so each word in phrase is given an embedding
             if self.use_spacy_embs and self.word_embs is not None:  # concatenate spacy vectors and vectors for given word embeddings
-                seq = numpy.array([numpy.concatenate(
-                    [self.word_embs[word] if word in self.word_embs else numpy.zeros((self.word_embs.vector_size)),
-                     encoder(word).vector], axis=-1) for word in seq])
+                seq = numpy.concatenate([self.word_embs.gather(self.word_embs.get_rows(seq)),
+                                         self.words_to_spacy_embs(seq)], axis=-1)
             elif self.use_spacy_embs:
-                seq = numpy.array([encoder(word).vector for word in seq])
+                seq = self.words_to_spacy_embs(seq)
             elif self.word_embs is not None:
-                seq = numpy.array(
-                    [self.word_embs[word] if word in self.word_embs else numpy.zeros((self.n_embedding_nodes))
-                     for word in seq])
+                seq = self.word_embs.gather(self.word_embs.get_rows(seq))
         if reduce_emb_mode:  # combine embeddings of each sequence by averaging or summing them
             if reduce_emb_mode == 'mean':
                 seq = numpy.mean(seq, axis=0)
@@ -582,11 +816,8 @@ class SequenceTransformer():
         if separate word embeddings given, use these embeddings; otherwise use existing self.word_embs'''
         embedded_seqs = []
         for seq in seqs:
-            if hasattr(self, 'phrases') and self.phrases is not None:
-                seq = combine_phrases_in_seq(seq, self.phrases,
-                                             lemmatized=self.lemmatize)  # if sequences will be lemmatized, assume that given phrases are lemmatized
-            seq = tokenize(seq, lemmatize=self.lemmatize, include_tags=self.include_tags,
-                           prepend_start=self.prepend_start)
+            if not isinstance(seq, list):  # seq may already be tokenized (see text_to_nums())
+                seq = self.text_to_tok_seq(seq)
             seq = self.tok_seq_to_embs(seq, reduce_emb_mode=reduce_emb_mode)
             embedded_seqs.append(seq)
         assert (len(seqs) == len(embedded_seqs))
@@ -594,14 +825,19 @@ class SequenceTransformer():
             embedded_seqs = numpy.array(embedded_seqs)
         return embedded_seqs
 
-    def num_seqs_to_bow(self, seqs):
-        '''takes sequences of word indices as input and returns word count vectors'''
-        count_vecs = []
-        for seq in seqs:
-            count_vec = numpy.bincount(numpy.array(seq), minlength=self.lexicon_size + 1)
-            count_vecs.append(count_vec)
-        count_vecs = numpy.array(count_vecs)
-        count_vecs[:, 0] = 0  # don't include 0s in vector (0's are words that are not part of context)
+    def num_seqs_to_bow(self, seqs, dtype='int64', sparse_output=False):
+        '''takes sequences of word indices as input and returns word count vectors, built in one pass as a scipy CSR
+        matrix; returned as a dense array unless sparse_output=True'''
+        lengths = numpy.array([len(seq) for seq in seqs], dtype='int64')
+        words = numpy.concatenate([numpy.array(seq, dtype='int64') for seq in seqs] + [numpy.zeros((0,), dtype='int64')])
+        count_vecs = sparse.csr_matrix((numpy.ones(len(words), dtype=dtype), words,
+                                        numpy.concatenate([[0], numpy.cumsum(lengths)])),
+                                       shape=(len(seqs), self.lexicon_size + 1))
+        count_vecs.sum_duplicates()
+        count_vecs.data[count_vecs.indices == 0] = 0  # don't include 0s in vector (0's are words that are not part of context)
+        count_vecs.eliminate_zeros()
+        if not sparse_output:
+            count_vecs = count_vecs.toarray()
         return count_vecs
 
     def text_to_bow(self, seqs):
@@ -611,17 +847,44 @@ class SequenceTransformer():
         bow_seqs = self.num_seqs_to_bow(seqs)
         return bow_seqs
 
+    def get_lexicon_lookup_array(self):
+        '''lexicon_lookup as a numpy object array, with the unknown word in place of empty entries, so that a sequence of
+        word indices can be decoded with a single fancy-indexing step; computed once per lexicon'''
+        if getattr(self, 'lexicon_lookup_array', None) is None:
+            self.lexicon_lookup_array = numpy.array([word if word else self.unk_word for word in self.lexicon_lookup],
+                                                    dtype=object)
+        return self.lexicon_lookup_array
+
+    def get_lexicon_counts(self):
+        '''return the training count of each word as an array indexed by word index (words not in the lexicon are
+        counted as the unknown word, index 0 is padding and has no count); used for unigram sampling of output words'''
+        counts = numpy.zeros((self.lexicon_size + 1,), dtype='int64')
+        for word, count in self.word_counts.items():
+            counts[self.lexicon.get(word, 1)] += count
+        return counts
+
     def decode_num_seqs(self, seqs, n_sents_per_seq=None, eos_tokens=[], detokenize=False, ents=[],
                         capitalize_ents=False, adapt_ents=False):
         if type(seqs[0]) not in (list, numpy.ndarray, tuple):
             seqs = [seqs]
-        decoded_seqs = []
+        lexicon_lookup = self.get_lexicon_lookup_array()
+        if eos_tokens:
+            eos_idxs = numpy.array([self.lexicon[token] for token in eos_tokens if token in self.lexicon], dtype='int64')
         # transform numerical seq back into string
-        for seq_idx, seq in enumerate(seqs):
-            seq = [self.lexicon_lookup[word] if self.lexicon_lookup[word] else self.unk_word for word in seq]
-            if ents and adapt_ents:  # replace generated entities with those given in ents
-                seq = adapt_tok_seq_ents(seq, ents=ents[seq_idx],
-                                         sub_ent_probs=ent_counts_to_probs(self.filtered_ent_counts))
+        tok_seqs = []
+        for seq in seqs:
+            seq = numpy.asarray(seq, dtype='int64')
+            if eos_tokens:  # cut off sequence at first occurrence of one of the end-of-sentence tokens
+                eos_positions = numpy.flatnonzero(numpy.isin(seq, eos_idxs))
+                if len(eos_positions):
+                    seq = seq[:eos_positions[0] + 1]
+            tok_seqs.append(lexicon_lookup[seq].tolist())
+        if ents and adapt_ents:  # replace generated entities with those given in ents
+            sub_ent_probs = ent_counts_to_probs(self.filtered_ent_counts)  # computed once for all seqs
+            tok_seqs = [adapt_tok_seq_ents(seq, ents=ents[seq_idx], sub_ent_probs=sub_ent_probs)
+                        for seq_idx, seq in enumerate(tok_seqs)]
+        decoded_seqs = []
+        for seq_idx, seq in enumerate(tok_seqs):
             if detokenize:  # apply rules for transforming token list into formatted sequence
                 if ents and capitalize_ents:
                     seq = detokenize_tok_seq(seq, ents=ents[
@@ -630,40 +893,55 @@ class SequenceTransformer():
                     seq = detokenize_tok_seq(seq, ents=[])
             else:
                 seq = " ".join(seq)  # otherwise just join tokens with whitespace between each
-            if eos_tokens:  # if filter_n_sents is a number, filter generated sequence to only the first N=filter_n_sents sentences
-                seq = filter_gen_seq(seq, eos_tokens=eos_tokens)
-            elif n_sents_per_seq:
+            if n_sents_per_seq and not eos_tokens:  # filter generated sequence to only the first N=n_sents_per_seq sentences
                 seq = filter_gen_seq(seq, n_sents=n_sents_per_seq)
             decoded_seqs.append(seq)
         return decoded_seqs
 
+    def get_emb_row_idxs(self):
+        '''map each lexicon index to its row in self.word_embs (-1 if the word has no embedding);
+        computed once per lexicon and set of embeddings'''
+        if getattr(self, 'emb_row_idxs', None) is None:
+            self.emb_row_idxs = self.word_embs.get_rows(self.lexicon_lookup)
+        return self.emb_row_idxs
+
+    def nums_to_padded_embs(self, seqs, max_length=None):
+        '''convert a batch of word index sequences into a (n_seqs, max_length, n_embedding_nodes) array of word
+        embeddings with one gather; sequences are padded at the end, and padding and words without an embedding
+        are represented with all zeros'''
+        lengths = numpy.array([len(seq) for seq in seqs], dtype='int64')
+        if not max_length:
+            max_length = max([len(seq) for seq in seqs] + [1])
+        lengths = numpy.minimum(lengths, max_length)
+        num_seqs = numpy.zeros((len(seqs), max_length), dtype='int64')
+        num_seqs[numpy.arange(max_length)[None] < lengths[:, None]] = numpy.concatenate(
+            [numpy.array(seq[:max_length], dtype='int64') for seq in seqs] + [numpy.zeros((0,), dtype='int64')])
+        padded_seqs = numpy.zeros((len(seqs), max_length, self.word_embs.vector_size), dtype=self.word_embs.embs.dtype)
+        return self.word_embs.gather(self.get_emb_row_idxs()[num_seqs], out=padded_seqs)
+
     def nums_to_embs(self, seqs, reduce_emb_mode=None):  # , word_embs=None):
-        embedded_seqs = []
-        for seq in seqs:
-            # convert to vectors rather than indices - if word not in lexicon represent with all zeros
-            seq = [self.word_embs[self.lexicon_lookup[word]]
-                   if self.lexicon_lookup[word] in self.word_embs
-                   else numpy.zeros((self.n_embedding_nodes))
-                   for word in seq]
-            seq = numpy.array(seq)
-            if reduce_emb_mode:  # combine embeddings of each sequence by averaging or summing them
-                if reduce_emb_mode == 'mean':
-                    seq = numpy.mean(seq, axis=0)
-                elif reduce_emb_mode == 'sum':
-                    seq = numpy.sum(seq, axis=0)
-            embedded_seqs.append(seq)
-        if reduce_emb_mode:
-            embedded_seqs = numpy.array(embedded_seqs)
+        # convert to vectors rather than indices - if word not in lexicon represent with all zeros
+        lengths = numpy.array([len(seq) for seq in seqs])
+        padded_seqs = self.nums_to_padded_embs(seqs)
+        if reduce_emb_mode:  # combine embeddings of each sequence by averaging or summing them
+            embedded_seqs = numpy.sum(padded_seqs, axis=1)
+            if reduce_emb_mode == 'mean':
+                embedded_seqs = embedded_seqs / lengths[:, None]
+        else:
+            embedded_seqs = [padded_seq[:length] for padded_seq, length in zip(padded_seqs, lengths)]
         return embedded_seqs
 
-    def pad_embs(self, seqs, max_length=None):
+    def pad_embs(self, seqs, max_length=None, dtype='float32'):
+        '''pad sequences of word embeddings at the end into a (n_seqs, max_length, n_embedding_nodes) array, filled with
+        a single scatter of all word vectors'''
+        lengths = numpy.array([len(seq) for seq in seqs], dtype='int64')
         if not max_length:
-            max_length = max([len(seq) for seq in seqs])
+            max_length = max(lengths)
+        lengths = numpy.minimum(lengths, max_length)
 
-        padded_seqs = numpy.zeros((len(seqs), max_length, self.n_embedding_nodes))
-        for seq_idx, seq in enumerate(seqs):
-            for word_idx, word in enumerate(seq):
-                padded_seqs[seq_idx, word_idx] = word
+        padded_seqs = numpy.zeros((len(seqs), max_length, self.n_embedding_nodes), dtype=dtype)
+        padded_seqs[numpy.arange(max_length)[None] < lengths[:, None]] = numpy.concatenate(
+            [numpy.reshape(seq, (-1, self.n_embedding_nodes))[:max_length] for seq in seqs])
 
         return padded_seqs
 
@@ -698,7 +976,9 @@ class SequenceTransformer():
 
     def __getstate__(self):
         # don't save embeddings
-        state = dict((k, v) for (k, v) in self.__dict__.items() if k not in ('word_embs'))
+        state = dict((k, v) for (k, v) in self.__dict__.items()
+                     if k not in ('word_embs', 'emb_row_idxs', 'spacy_embs', 'phrase_trie', 'lexicon_lookup_array',
+                                  'ent_cache'))
         state.update({'word_embs': None})
         return state
 
@@ -707,17 +987,25 @@ class SequenceTransformer():
         with open(filepath + '/transformer.pkl', 'rb') as f:
             transformer = pickle.load(f)
         transformer.word_embs = word_embs
+        transformer.emb_row_idxs = None
+        if transformer.use_spacy_embs:
+            transformer.load_spacy_embs(filepath)
         print('loaded transformer with', transformer.lexicon_size, 'words from', str(filepath) + '/transformer.pkl')
         return transformer
 
 
 class SkipthoughtsTransformer(SequenceTransformer):
-    def __init__(self, filepath, verbose=True):
+    def __init__(self, filepath, verbose=True, cache_filepath=None, dtype='float32', chunk_size=500000):
         self.import_skipthoughts(filepath)
         self.filepath = filepath
         self.encoder = self.skipthoughts_module.load_model()
         self.encoder_dim = self.encoder['uoptions']['dim'] + 2 * self.encoder['boptions']['dim']
         self.verbose = verbose
+        self.dtype = dtype  # precision of returned vectors ('float32' or 'float16')
+        self.chunk_size = chunk_size  # number of sentences encoded at once
+        self.cache_filepath = cache_filepath  # if given, directory where encoded sentences are kept across calls and runs
+        if self.cache_filepath:
+            self.load_cache()
 
     def import_skipthoughts(self, filepath):
         '''Import the skipthoughts model from the given directory filepath'''
@@ -727,6 +1015,74 @@ class SkipthoughtsTransformer(SequenceTransformer):
         except:
             print("Could not locate skipthoughts model in filepath", filepath)
 
+    def load_cache(self):
+        '''load the sentence vector cache: vectors.dat is a float32 matrix with one row per sentence encoded so far
+        (memory-mapped), index.pkl maps the hash of each of these sentences to its row'''
+        if not os.path.isdir(self.cache_filepath):
+            os.mkdir(self.cache_filepath)
+        self.cache_index = {}
+        if os.path.exists(self.cache_filepath + '/index.pkl'):
+            with open(self.cache_filepath + '/index.pkl', 'rb') as f:
+                self.cache_index = pickle.load(f)
+        self.cache_vectors = None
+        if self.cache_index:
+            self.cache_vectors = numpy.memmap(self.cache_filepath + '/vectors.dat', dtype='float32', mode='r',
+                                              shape=(len(self.cache_index), self.encoder_dim))
+        if self.verbose:
+            print("loaded", len(self.cache_index), "cached sentence vectors from", self.cache_filepath)
+
+    def get_cache_key(self, sent):
+        if not isinstance(sent, bytes):
+            sent = sent.encode('utf-8')
+        return hashlib.md5(sent).digest()
+
+    def add_to_cache(self, keys, vectors):
+        '''append vectors for new sentence keys to the cache; vectors are written before the index, so the index never
+        points to rows that are missing from vectors.dat'''
+        n_cached = len(self.cache_index)
+        with open(self.cache_filepath + '/vectors.dat', 'ab') as f:
+            f.truncate(n_cached * self.encoder_dim * 4)  # drop any rows written after the index was last saved
+            f.write(numpy.ascontiguousarray(vectors, dtype='float32').tobytes())
+        for row, key in enumerate(keys, n_cached):
+            self.cache_index[key] = row
+        with open(self.cache_filepath + '/index.pkl.tmp', 'wb') as f:
+            pickle.dump(self.cache_index, f)
+        replace_file(self.cache_filepath + '/index.pkl.tmp', self.cache_filepath + '/index.pkl')
+        self.cache_vectors = numpy.memmap(self.cache_filepath + '/vectors.dat', dtype='float32', mode='r',
+                                          shape=(len(self.cache_index), self.encoder_dim))
+
+    def encode_sents(self, sents, embedded_sents):
+        '''write the vector of each sentence into embedded_sents; if there is a cache, only sentences not already in the
+        cache are encoded (in chunks of self.chunk_size, since encoding a large number of stories gives memory errors)'''
+        chunk_size = self.chunk_size
+        if not self.cache_filepath:
+            for sent_idx in range(0, len(sents), chunk_size):
+                embedded_sents[sent_idx:sent_idx + chunk_size] = self.skipthoughts_module.encode(
+                    self.encoder, sents[sent_idx:sent_idx + chunk_size], verbose=self.verbose)
+                if hasattr(embedded_sents, 'flush'):  # stream each chunk to disk rather than keeping it in memory
+                    embedded_sents.flush()
+            return
+
+        keys = [self.get_cache_key(sent) for sent in sents]
+        new_sents = {}  # unique sentences that still need to be encoded, by key
+        for key, sent in zip(keys, sents):
+            if key not in self.cache_index and key not in new_sents:
+                new_sents[key] = sent
+        if self.verbose:
+            print("encoding", len(new_sents), "of", len(sents), "sentences not found in cache")
+        new_keys = list(new_sents.keys())
+        for key_idx in range(0, len(new_keys), chunk_size):
+            chunk_keys = new_keys[key_idx:key_idx + chunk_size]
+            self.add_to_cache(chunk_keys, self.skipthoughts_module.encode(self.encoder,
+                                                                          [new_sents[key] for key in chunk_keys],
+                                                                          verbose=self.verbose))
+
+        rows = numpy.array([self.cache_index[key] for key in keys], dtype='int64')
+        for sent_idx in range(0, len(sents), chunk_size):
+            embedded_sents[sent_idx:sent_idx + chunk_size] = self.cache_vectors[rows[sent_idx:sent_idx + chunk_size]]
+            if hasattr(embedded_sents, 'flush'):
+                embedded_sents.flush()
+
     def text_to_embs(self, seqs, seqs_filepath=None):
         n_seqs = len(seqs)
         if type(seqs[0]) in (list, tuple):
@@ -739,23 +1095,18 @@ class SkipthoughtsTransformer(SequenceTransformer):
         else:
             seq_length = 1
         seqs_shape = (len(seqs), self.encoder_dim)
-        if seqs_filepath:
-            embedded_seqs = numpy.memmap(seqs_filepath, dtype='float',
-                                         mode='w+', shape=seqs_shape)
+        if seqs_filepath:  # .npy file, so it can be reopened later with numpy.load(seqs_filepath, mmap_mode='r')
+            embedded_seqs = numpy.lib.format.open_memmap(seqs_filepath, dtype=self.dtype,
+                                                         mode='w+', shape=seqs_shape)
         else:
-            embedded_seqs = numpy.zeros(seqs_shape)
+            embedded_seqs = numpy.empty(seqs_shape, dtype=self.dtype)
 
-        chunk_size = 500000
-        for seq_idx in range(0, len(seqs), chunk_size):
-            # memory errors if encoding a large number of stories
-            embedded_seqs[seq_idx:seq_idx + chunk_size] = self.skipthoughts_module.encode(self.encoder, seqs[
-                                                                                                        seq_idx:seq_idx + chunk_size],
-                                                                                          verbose=self.verbose)
+        self.encode_sents(seqs, embedded_seqs)
 
         if type(seq_length) in (list, tuple, numpy.ndarray):
-            # different lengths per sequence
-            idxs = [numpy.sum(seq_length[:idx]) for idx in range(len(seq_length))] + [None]  # add -1 for last entry
-            embedded_seqs = [embedded_seqs[idxs[start]:idxs[start + 1]] for start in range(len(idxs) - 1)]
+            # different lengths per sequence: return a view of the rows of each sequence
+            offsets = numpy.concatenate([[0], numpy.cumsum(seq_length)])
+            embedded_seqs = [embedded_seqs[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
         else:
             embedded_seqs = embedded_seqs.reshape(n_seqs, seq_length, self.encoder_dim)
 
@@ -776,6 +1127,21 @@ class WordEmbeddings():
         word_emb = self.embs[self.lexicon[word]]
         return word_emb
 
+    def get_rows(self, words):
+        '''return array of the row index of each word in the embeddings matrix, or -1 if the word isn't in the lexicon'''
+        return numpy.array([self.lexicon.get(word, -1) if word is not None else -1 for word in words], dtype='int64')
+
+    def gather(self, rows, out=None):
+        '''look up embeddings for an array of row indices (any shape) with one sorted read of the memory-mapped matrix;
+        rows equal to -1 get all-zero vectors. Result has shape rows.shape + (vector_size,)'''
+        rows = numpy.asarray(rows, dtype='int64')
+        unique_rows, inverse = numpy.unique(rows, return_inverse=True)
+        known = unique_rows >= 0
+        table = numpy.zeros((len(unique_rows) + 1, self.vector_size), dtype=self.embs.dtype)  # row 0 is for unknown words
+        table[1:][known] = self.embs[unique_rows[known]]
+        table_idxs = numpy.where(known[inverse], inverse + 1, 0).reshape(rows.shape)
+        return numpy.take(table, table_idxs, axis=0, out=out)
+
     def __contains__(self, word):
         return word in self.lexicon
 
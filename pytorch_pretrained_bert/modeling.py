@@ -851,10 +851,13 @@ class BertForSequenceClassification(PreTrainedBertModel):
             a batch has varying length sentences.
         `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
             with indices selected in [0, ..., num_labels].
+        `return_logits`: if `labels` is not `None`, also output the classification logits, so the
+            loss and the logits are computed in a single forward pass. Default: `False`.
 
     Outputs:
         if `labels` is not `None`:
-            Outputs the CrossEntropy classification loss of the output with the labels.
+            Outputs the CrossEntropy classification loss of the output with the labels,
+            or a tuple of the loss and the logits if `return_logits` is `True`.
         if `labels` is `None`:
             Outputs the classification logits of shape [batch_size, num_labels].
 
@@ -882,7 +885,7 @@ class BertForSequenceClassification(PreTrainedBertModel):
         self.classifier = nn.Linear(config.hidden_size, num_labels)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None, return_logits=False):
         _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
@@ -890,6 +893,8 @@ class BertForSequenceClassification(PreTrainedBertModel):
         if labels is not None:
             loss_fct = CrossEntropyLoss()
             loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+            if return_logits:
+                return loss, logits
             return loss
         else:
             return logits
@@ -917,10 +922,13 @@ class BertForMultipleChoice(PreTrainedBertModel):
             a batch has varying length sentences.
         `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
             with indices selected in [0, ..., num_choices].
+        `return_logits`: if `labels` is not `None`, also output the classification logits, so the
+            loss and the logits are computed in a single forward pass. Default: `False`.
 
     Outputs:
         if `labels` is not `None`:
-            Outputs the CrossEntropy classification loss of the output with the labels.
+            Outputs the classification loss of the output with the labels,
+            or a tuple of the loss and the logits if `return_logits` is `True`.
         if `labels` is `None`:
             Outputs the classification logits of shape [batch_size, num_labels].
 
@@ -951,7 +959,7 @@ class BertForMultipleChoice(PreTrainedBertModel):
         # self.linear_two=nn.Linear(config.hidden_size//2,1,bias=True)
 
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None, return_logits=False):
         flat_input_ids = input_ids.view(-1, input_ids.size(-1))
         flat_token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1))
         flat_attention_mask = attention_mask.view(-1, attention_mask.size(-1))
@@ -965,6 +973,8 @@ class BertForMultipleChoice(PreTrainedBertModel):
         if labels is not None:
             loss_fct = CrossEntropyLoss()
             loss = loss_fct(reshaped_logits, labels)
+            if return_logits:
+                return loss, reshaped_logits
             return loss
         else:
             return reshaped_logits
@@ -991,10 +1001,13 @@ class BertForMultipleChoiceSCT(PreTrainedBertModel):
             a batch has varying length sentences.
         `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
             with indices selected in [0, ..., num_choices].
+        `return_logits`: if `labels` is not `None`, also output the classification logits, so the
+            loss and the logits are computed in a single forward pass. Default: `False`.
 
     Outputs:
         if `labels` is not `None`:
-            Outputs the CrossEntropy classification loss of the output with the labels.
+            Outputs the classification loss of the output with the labels,
+            or a tuple of the loss and the logits if `return_logits` is `True`.
         if `labels` is `None`:
             Outputs the classification logits of shape [batch_size, num_labels].
 
@@ -1026,7 +1039,7 @@ class BertForMultipleChoiceSCT(PreTrainedBertModel):
         # self.linear_two=nn.Linear(config.hidden_size//2,1,bias=True)
 
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None, return_logits=False):
         flat_input_ids = input_ids.view(-1, input_ids.size(-1))
         flat_token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1))
         flat_attention_mask = attention_mask.view(-1, attention_mask.size(-1))
@@ -1042,6 +1055,8 @@ class BertForMultipleChoiceSCT(PreTrainedBertModel):
         if labels is not None:
             loss_fct = CrossEntropyLoss()
             loss = loss_fct(reshaped_logits, labels)
+            if return_logits:
+                return loss, reshaped_logits
             return loss
         else:
             return reshaped_logits
@@ -1068,10 +1083,13 @@ class BertForMultipleChoiceMarginLoss(PreTrainedBertModel):
             a batch has varying length sentences.
         `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
             with indices selected in [0, ..., num_choices].
+        `return_logits`: if `labels` is not `None`, also output the classification logits, so the
+            loss and the logits are computed in a single forward pass. Default: `False`.
 
     Outputs:
         if `labels` is not `None`:
-            Outputs the CrossEntropy classification loss of the output with the labels.
+            Outputs the classification loss of the output with the labels,
+            or a tuple of the loss and the logits if `return_logits` is `True`.
         if `labels` is `None`:
             Outputs the classification logits of shape [batch_size, num_labels].
 
@@ -1100,7 +1118,7 @@ class BertForMultipleChoiceMarginLoss(PreTrainedBertModel):
         self.classifier = nn.Linear(config.hidden_size, 1)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None, return_logits=False):
         flat_input_ids = input_ids.view(-1, input_ids.size(-1))
         flat_token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1))
         flat_attention_mask = attention_mask.view(-1, attention_mask.size(-1))
@@ -1112,6 +1130,8 @@ class BertForMultipleChoiceMarginLoss(PreTrainedBertModel):
         if labels is not None:
             loss_fct = MultiMarginLoss(p=self.p, margin=self.margin)
             loss = loss_fct(reshaped_logits, labels)
+            if return_logits:
+                return loss, reshaped_logits
             return loss
         else:
             return reshaped_logits
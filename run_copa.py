@@ -25,7 +25,7 @@ import xml.etree.ElementTree as ET
 from pprint import pprint
 import numpy as np
 import torch, pickle
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler, Sampler
 from torch.utils.data.distributed import DistributedSampler
 
 from pytorch_pretrained_bert.tokenization import BertTokenizer
@@ -56,7 +56,7 @@ class CopaExample(object):
             RandomFifthSentenceQuiz1,
             RandomFifthSentenceQuiz2,
         ]
-        self.label = AnswerRightEnding - 1
+        self.label = AnswerRightEnding - 1 if AnswerRightEnding is not None else None
 
     def __str__(self):
         return self.__repr__()
@@ -241,6 +241,55 @@ def select_field(features, field):
     ]
 
 
+def pad_choices_features(features):
+    """Stacks the input_ids, input_mask and segment_ids of all choices of `features` into
+    [batch_size, num_choices, length] tensors, where length is that of the longest sequence in the batch."""
+    max_length = max(sum(choice['input_mask']) for feature in features for choice in feature.choices_features)
+    return tuple(torch.tensor([[choice[field][:max_length] for choice in feature.choices_features]
+                               for feature in features], dtype=torch.long)
+                 for field in ('input_ids', 'input_mask', 'segment_ids'))
+
+
+def collate_to_longest(batch):
+    """Collates (input_ids, input_mask, segment_ids, label) examples into batch tensors whose
+    sequence dimension is cut to the longest sequence in the batch instead of max_seq_length."""
+    input_ids, input_mask, segment_ids, labels = (torch.stack(field) for field in zip(*batch))
+    max_length = int(input_mask.sum(-1).max())
+    return (input_ids[..., :max_length].contiguous(), input_mask[..., :max_length].contiguous(),
+            segment_ids[..., :max_length].contiguous(), labels)
+
+
+class BucketBatchSampler(Sampler):
+    """Yields batches of example indices such that each batch holds examples of similar length.
+    The examples are shuffled and split into buckets of `bucket_size` batches; each bucket is sorted
+    by length and cut into batches, and the batches of all buckets are shuffled. If `bucket_size` is
+    not given, it is chosen so that an epoch has at least `min_buckets` buckets (and buckets have at
+    most 50 batches), so that batches still change from one epoch to the next on small datasets."""
+
+    def __init__(self, lengths, batch_size, bucket_size=None, min_buckets=8):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        if not bucket_size:
+            n_batches = (len(lengths) + batch_size - 1) // batch_size
+            bucket_size = min(50, max(1, n_batches // min_buckets))
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        random.shuffle(indices)
+        batches = []
+        n_bucket_examples = self.batch_size * self.bucket_size
+        for bucket_start in range(0, len(indices), n_bucket_examples):
+            bucket = sorted(indices[bucket_start:bucket_start + n_bucket_examples], key=lambda idx: self.lengths[idx])
+            batches.extend(bucket[batch_start:batch_start + self.batch_size]
+                           for batch_start in range(0, len(bucket), self.batch_size))
+        random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
 def write_result_to_file(args, result):
     output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
     with open(output_eval_file, "a") as writer:
@@ -293,13 +342,11 @@ def do_evaluation(model, eval_dataloader, args, is_training=False):
             input_mask = input_mask.cuda()
             segment_ids = segment_ids.cuda()
             label_ids = label_ids.cuda()
-            tmp_eval_loss = model(input_ids, segment_ids, input_mask, label_ids)
-            logits = model(input_ids, segment_ids, input_mask)
+            tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids, return_logits=True)
             logits = logits.detach().cpu().numpy()
-            if logits_all is None:
-                logits_all = logits.copy()
-            else:
-                logits_all = np.vstack((logits_all, logits))
+            if logits_all is None:  # one row per example, filled in batch by batch
+                logits_all = np.empty((len(eval_dataloader.dataset), logits.shape[1]), dtype=logits.dtype)
+            logits_all[nb_eval_examples:nb_eval_examples + len(logits)] = logits
             label_ids = label_ids.to('cpu').numpy()
             tmp_eval_accuracy = accuracy(logits, label_ids)
             eval_loss += tmp_eval_loss.mean().item()
@@ -385,6 +432,11 @@ def main(start_index=0, end_index=0):
                         default=40,
                         type=int,
                         help="Total batch size for training.")
+    parser.add_argument("--bucket_size",
+                        default=0,
+                        type=int,
+                        help="Number of training batches per length bucket (see BucketBatchSampler). "
+                             "0 picks a size that gives at least 8 buckets per epoch.")
     parser.add_argument("--eval_batch_size",
                         default=100,
                         type=int,
@@ -554,7 +606,8 @@ def main(start_index=0, end_index=0):
         eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
         # Run prediction for full data
         eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size,
+                                     collate_fn=collate_to_longest)
         # logger.info("***** Loading evaluation data done *****")
         # logger.info("  Num examples = %d", len(eval_examples))
         # logger.info("  Batch size = %d", args.eval_batch_size)
@@ -571,7 +624,8 @@ def main(start_index=0, end_index=0):
         test_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
         # Run prediction for full data
         test_sampler = SequentialSampler(test_data)
-        test_dataloader = DataLoader(test_data, sampler=test_sampler, batch_size=args.eval_batch_size)
+        test_dataloader = DataLoader(test_data, sampler=test_sampler, batch_size=args.eval_batch_size,
+                                     collate_fn=collate_to_longest)
         # logger.info("***** Loading evaluation data done *****")
         # logger.info("  Num examples = %d", len(eval_examples))
         # logger.info("  Batch size = %d", args.eval_batch_size)
@@ -595,11 +649,16 @@ def main(start_index=0, end_index=0):
         all_label = torch.tensor([f.label for f in train_features], dtype=torch.long)
         train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
         if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+            # batch examples of similar length so that little padding is left after collate_to_longest
+            train_lengths = [max(sum(choice['input_mask']) for choice in f.choices_features) for f in train_features]
+            train_dataloader = DataLoader(train_data, collate_fn=collate_to_longest,
+                                          batch_sampler=BucketBatchSampler(train_lengths, args.train_batch_size,
+                                                                           bucket_size=args.bucket_size))
         else:
             train_sampler = DistributedSampler(train_data)
-        # train_sampler = SequentialSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+            # train_sampler = SequentialSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size,
+                                          collate_fn=collate_to_longest)
 
         best_eval_acc = 0.0
         best_test_acc = 0.0